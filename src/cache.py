@@ -0,0 +1,170 @@
+import asyncio
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+from decouple import config
+
+from src.definitions.definitions import FILES_DIR
+
+CACHE_DIR = FILES_DIR + 'cache/'
+
+# Maximum size of the audio cache, in megabytes
+AUDIO_CACHE_SIZE = config("AUDIO_CACHE_SIZE", default=1024, cast=int)
+
+
+class AudioCache:
+    """
+    Content-addressed cache of downloaded audio files, keyed by e.g. video ID and format.
+    Each entry is a file plus a JSON sidecar with its metadata. When the cache grows past 'max_size' bytes, the least
+    recently used entries are evicted. Entries are used from the event loop only.
+    Fetching a key that is already being downloaded joins that download instead of starting another one.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_size: int = AUDIO_CACHE_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+        # key -> (file path, size), least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._pinned = {}
+        self._inflight = {}
+        self._subscribers = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    async def fetch(self, key: str, download, destination: str, on_progress=None) -> dict:
+        """
+        Copies the cached file of a key to 'destination', downloading it first if it's not cached yet.
+        @param key: cache key.
+        @param download: coroutine function called with a progress callback, returning (file path, metadata dict) of
+        the downloaded file. The file is moved into the cache.
+        @param destination: path to copy the cached file to.
+        @param on_progress: function called with the download progress, if the file has to be downloaded.
+        @return: metadata dict of the cached file.
+        """
+        if key not in self._entries:
+            await self._download(key, download, on_progress)
+
+        path, _ = self._entries[key]
+        self._entries.move_to_end(key)
+
+        # The entry is pinned so it's not evicted while being copied
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _touch_and_copy, path, destination)
+            return self._read_metadata(key)
+        finally:
+            self._pinned[key] -= 1
+            if self._pinned[key] == 0:
+                del self._pinned[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    async def _download(self, key: str, download, on_progress):
+        subscribers = self._subscribers.setdefault(key, [])
+        if on_progress is not None:
+            subscribers.append(on_progress)
+
+        if key not in self._inflight:
+            def report(value):
+                for subscriber in self._subscribers.get(key, []):
+                    subscriber(value)
+
+            self._inflight[key] = asyncio.ensure_future(self._download_and_store(key, download, report))
+
+        # Shielded so a cancelled request doesn't cancel the download other requests are waiting for
+        await asyncio.shield(self._inflight[key])
+
+    async def _download_and_store(self, key: str, download, report):
+        try:
+            path, metadata = await download(report)
+            self._store(key, path, metadata)
+        finally:
+            del self._inflight[key]
+            self._subscribers.pop(key, None)
+
+    def _store(self, key: str, path: str, metadata: dict):
+        cached_path = self._file_path(key, os.path.splitext(path)[1])
+        os.replace(path, cached_path)
+
+        with open(self._metadata_path(key), 'w') as file:
+            json.dump({**metadata, 'file': os.path.basename(cached_path)}, file)
+
+        self._add(key, cached_path)
+        self._evict()
+
+    def _add(self, key: str, path: str):
+        size = os.path.getsize(path)
+        self._entries[key] = (path, size)
+        self._entries.move_to_end(key)
+        self._size += size
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._size <= self.max_size:
+                break
+
+            # Pinned entries and the most recent one are never evicted
+            if key in self._pinned or key == next(reversed(self._entries)):
+                continue
+
+            path, size = self._entries.pop(key)
+            self._size -= size
+            _remove(path)
+            _remove(self._metadata_path(key))
+
+    def _load(self):
+        # Entries from previous runs, least recently used first
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+
+            key = name[:-len('.json')]
+            try:
+                with open(self._metadata_path(key)) as file:
+                    path = os.path.join(self.directory, json.load(file)['file'])
+                entries.append((os.path.getmtime(path), key, path))
+            except (OSError, ValueError, KeyError):
+                _remove(self._metadata_path(key))
+
+        for _, key, path in sorted(entries):
+            self._add(key, path)
+
+        self._evict()
+
+    def _read_metadata(self, key: str) -> dict:
+        with open(self._metadata_path(key)) as file:
+            metadata = json.load(file)
+
+        del metadata['file']
+        return metadata
+
+    def _file_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, key + extension)
+
+    def _metadata_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+
+def _touch_and_copy(path: str, destination: str):
+    # The modification time keeps track of the last use across restarts
+    os.utime(path)
+    shutil.copyfile(path, destination)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,165 @@
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+from src.definitions.definitions import DATA_DIR
+from src.models import File, Action
+
+# Number of button records kept in memory, on top of the ones on disk
+CALLBACK_CACHE_SIZE = config("CALLBACK_CACHE_SIZE", default=1024, cast=int)
+
+# Seconds the buttons of a message keep working for
+CALLBACK_TTL = config("CALLBACK_TTL", default=7 * 24 * 3600, cast=int)
+
+# Expired records are removed from disk every this many new records
+PURGE_EVERY = 100
+
+# Separates the record key and the action in the callback data of a button, e.g. 'k7Fq3x0aZ1w:shazam'
+SEPARATOR = ':'
+
+_callback_store = None
+_callback_store_lock = threading.Lock()
+
+
+class CallbackRecord:
+    """
+    Audio file the buttons of a message act on. All the buttons of the message share one record.
+    """
+
+    __slots__ = ('file_title', 'file_id', 'mime_type', 'chat_id', 'file_unique_id', 'duration')
+
+    def __init__(self, file_title: str, file_id: str, mime_type: str, chat_id, file_unique_id: str = None,
+                 duration: int = None):
+        self.file_title = file_title
+        self.file_id = file_id
+        self.mime_type = mime_type
+        self.chat_id = chat_id
+        self.file_unique_id = file_unique_id
+        self.duration = duration
+
+    def to_file(self, action: Action) -> File:
+        return File(action, self.file_title, self.file_id, self.mime_type, self.chat_id, self.file_unique_id,
+                    self.duration)
+
+    def to_row(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class CallbackStore:
+    """
+    Store of the records the inline buttons act on, so buttons only carry a short key in their callback data.
+    Records are stored on disk, so buttons keep working after a restart, with the most recently used ones also kept in
+    memory. They expire after 'ttl' seconds.
+    """
+
+    def __init__(self, path: str, max_entries: int = CALLBACK_CACHE_SIZE, ttl: int = CALLBACK_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # key -> (CallbackRecord object, expiry time), least recently used first
+        self._entries = OrderedDict()
+        self._added = 0
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS callbacks (
+                    key TEXT PRIMARY KEY,
+                    file_title TEXT,
+                    file_id TEXT NOT NULL,
+                    mime_type TEXT,
+                    chat_id INTEGER,
+                    file_unique_id TEXT,
+                    duration INTEGER,
+                    expires REAL NOT NULL
+                )""")
+
+    def add(self, record: CallbackRecord) -> str:
+        """
+        Stores a record.
+        @param record: CallbackRecord object.
+        @return: key of the record.
+        """
+        key = secrets.token_urlsafe(8)
+        expires = time.time() + self.ttl
+
+        with self._lock:
+            self._connection.execute("INSERT INTO callbacks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (key, *record.to_row(), expires))
+            self._remember(key, (record, expires))
+
+            self._added += 1
+            if self._added % PURGE_EVERY == 0:
+                self._connection.execute("DELETE FROM callbacks WHERE expires <= ?", (time.time(),))
+
+        return key
+
+    def get(self, key: str):
+        """
+        Gets a record.
+        @param key: key of the record.
+        @return: CallbackRecord object. Returns None if there's no record with the key or it expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                row = self._connection.execute("SELECT file_title, file_id, mime_type, chat_id, file_unique_id, "
+                                               "duration, expires FROM callbacks WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                entry = (CallbackRecord(*row[:-1]), row[-1])
+
+            if entry[1] <= time.time():
+                self._entries.pop(key, None)
+                self._connection.execute("DELETE FROM callbacks WHERE key = ?", (key,))
+                return None
+
+            self._remember(key, entry)
+            return entry[0]
+
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def get_callback_store() -> CallbackStore:
+    """
+    Gets the store of button records, creating it on first use.
+    @return: CallbackStore object.
+    """
+    global _callback_store
+
+    with _callback_store_lock:
+        if _callback_store is None:
+            _callback_store = CallbackStore(DATA_DIR + 'callbacks.sqlite3')
+
+    return _callback_store
+
+
+def callback_data(key: str, action: Action) -> str:
+    """
+    Gets the callback data of a button.
+    @param key: key of the record the button acts on.
+    @param action: action of the button.
+    @return: callback data.
+    """
+    return key + SEPARATOR + action.value
+
+
+def parse_callback_data(data: str) -> tuple:
+    """
+    Gets the record key and the action of a button from its callback data.
+    @param data: callback data.
+    @return: (key, action value) tuple.
+    """
+    key, _, action = data.rpartition(SEPARATOR)
+    return key, action
@@ -5,3 +5,4 @@ FILES_DIR = ROOT_DIR + '/files/'
 AUTH_DIR = ROOT_DIR + '/auth/'
 TESTS_DIR = ROOT_DIR + '/tests/'
 SRC_DIR = ROOT_DIR + '/src/'
+DATA_DIR = ROOT_DIR + '/data/'
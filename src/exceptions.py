@@ -12,6 +12,10 @@ class TrackNotFound(Exception):
     pass
 
 
+class AudioDecodeFail(Exception):
+    pass
+
+
 # Google Drive Exceptions --------------
 class GoogleDriveClientSecretNotFound(Exception):
     pass
@@ -29,6 +33,35 @@ class GoogleDriveCreateFolderFail(Exception):
     pass
 
 
+class StreamRewindError(Exception):
+    pass
+
+
 # Youtube exceptions -----------------
 class YoutubeAudioDownloadFail(Exception):
     pass
+
+
+# Worker exceptions ------------------
+class JobTimeout(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    pass
+
+
+class TaskRateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+
+        # Seconds until the job can be queued
+        self.retry_after = retry_after
+
+
+class TaskDeferred(Exception):
+    def __init__(self, delay: float):
+        super().__init__(delay)
+
+        # Seconds until the task can go on
+        self.delay = delay
@@ -1,20 +1,54 @@
 import re
 import asyncio
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import ParseMode
+import logging
+import math
+import uuid
+from dataclasses import asdict, replace
+from datetime import datetime
+
+from decouple import config
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, Message, Chat
+from telegram.constants import ParseMode, MessageLimit
 from telegram.ext import (
     ContextTypes
 )
 
-from src.exceptions import YoutubeAudioDownloadFail, GoogleDriveUploadFail
-from src.services.gdrive import upload_to_drive
-from src.services.youtube import url_is_youtube_valid, download_youtube_audio
+from src.callbacks import CallbackRecord, get_callback_store, callback_data, parse_callback_data
+from src.exceptions import YoutubeAudioDownloadFail, GoogleDriveUploadFail, TaskRateLimited, TaskDeferred
+from src.progress import BatchProgress, ProgressReporter
+from src.services.gdrive import upload_to_drive, stream_to_drive, pipe_to_drive, get_or_create_drive_folder, \
+    upload_executor
+from src.services.youtube import url_is_youtube_valid, download_youtube_audio, url_is_youtube_playlist, \
+    list_youtube_playlist, can_pipe_youtube_audio, resolve_youtube_audio, transcode_youtube_audio, expected_audio_size
+from src.storage import get_scratch_space
+from src.tasks import get_checkpoints, get_user_limits, get_song_slots
 
 from src.models import File, Action, ShazamTrack, Metadata
-from src.services.shazam import shazam
-from src.exceptions import TrackNotFound
-from src.utils import get_metadata_from_message
+from src.services.shazam import shazam, shazam_excerpt, cached_recognition, recognize_tracklist, \
+    SHAZAM_EXCERPT_SECONDS, TRACKLIST_STEP_SECONDS
+from src.exceptions import TrackNotFound, AudioDecodeFail
+from src.utils import get_metadata_from_message, format_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Kinds of tasks queued by the handlers
+YOUTUBE_TASK = "youtube"
+DRIVE_UPLOAD_TASK = "drive_upload"
+YOUTUBE_BATCH_TASK = "youtube_batch"
+YOUTUBE_PLAYLIST_TASK = "youtube_playlist"
+TRACKLIST_TASK = "tracklist"
+
+# Maximum number of songs of a batch downloaded and uploaded at the same time
+BATCH_MAX_CONCURRENCY = config("BATCH_MAX_CONCURRENCY", default=3, cast=int)
+
+# Checkpoint prefix of the songs of a batch that failed, so they're not attempted again when the batch is deferred
+FAILED_CHECKPOINT = "failed:"
+
+# Maximum number of songs of a playlist shown on its status message at the same time
+PLAYLIST_PROGRESS_LINES = 5
+
+# Provider patterns
+YOUTUBE_PATTERN = re.compile("(?:https?:\/\/)?(?:youtu\.be\/|(?:www\.|m\.)?youtube\.com\/?)")
 
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -49,16 +83,60 @@ async def url_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # TODO Organize code, get more detailed metadata from URLs
     # TODO create filter for known providers : Spotify, Apple Music, SoundCloud, etc
 
-    # Provider patterns
-    youtube_pattern = re.compile("(?:https?:\/\/)?(?:youtu\.be\/|(?:www\.|m\.)?youtube\.com\/?)")
-
     # Regex for the tag and url ( text <tag> <url>)
     message_metadata: Metadata = get_metadata_from_message(update.message.text)
 
+    # Several Youtube videos are downloaded and uploaded together, as a batch
+    video_urls = get_youtube_video_urls(message_metadata.urls)
+    if len(video_urls) > 1:
+        # Songs are taken from the user's rate limit as they're processed
+        position = await admit_job(update, context, cost=0)
+        if position is None:
+            return
+
+        msg = await context.bot.send_message(chat_id=update.effective_chat.id,
+                                             text=f"Got it! Going to download {len(video_urls)} songs and upload them to Google Drive ⌛!"
+                                                  + queue_position_text(position))
+
+        await context.bot_data['tasks'].enqueue(YOUTUBE_BATCH_TASK, {
+            "chat_id": update.effective_chat.id,
+            "chat_type": update.effective_chat.type,
+            "message_id": msg.message_id,
+            "reply_to_message_id": update.message.message_id,
+            "metadata": asdict(message_metadata),
+            "urls": video_urls,
+            "user_id": update.effective_user.id,
+        }, chat_id=update.effective_chat.id, user_id=update.effective_user.id)
+        return
+
+    # A single Youtube video is processed even if the message has another (unsupported) link before it
+    if video_urls and not url_is_youtube_playlist(message_metadata.url or ""):
+        message_metadata = replace(message_metadata, url=video_urls[0])
+
     if message_metadata.url:
 
+        # Youtube playlists ------
+        if url_is_youtube_playlist(message_metadata.url) and not url_is_youtube_valid(message_metadata.url):
+            position = await admit_job(update, context, cost=0)
+            if position is None:
+                return
+
+            msg = await context.bot.send_message(chat_id=update.effective_chat.id,
+                                                 text="Got it! Going to download this playlist and upload it to Google Drive ⌛!"
+                                                      + queue_position_text(position))
+
+            await context.bot_data['tasks'].enqueue(YOUTUBE_PLAYLIST_TASK, {
+                "chat_id": update.effective_chat.id,
+                "chat_type": update.effective_chat.type,
+                "message_id": msg.message_id,
+                "reply_to_message_id": update.message.message_id,
+                "metadata": asdict(message_metadata),
+                "job_id": uuid.uuid4().hex,
+                "user_id": update.effective_user.id,
+            }, chat_id=update.effective_chat.id, user_id=update.effective_user.id)
+
         # Youtube ------
-        if bool(youtube_pattern.search(message_metadata.url)):
+        elif bool(YOUTUBE_PATTERN.search(message_metadata.url)):
 
             # Check if it is a video that can be downloaded
             if not url_is_youtube_valid(message_metadata.url):
@@ -66,28 +144,24 @@ async def url_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                                           parse_mode=ParseMode.MARKDOWN)
                 return
 
-            # Begin download
-            msg = await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text="Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!",
-                                           parse_mode=ParseMode.MARKDOWN)
-
-            try:
-                track = await download_youtube_audio(message_metadata, msg)
-            except YoutubeAudioDownloadFail:
-                msg.edit_text("There was a problem downloading the audio from this Youtube link ❌.",
-                              parse_mode=ParseMode.MARKDOWN)
+            # Queue download and upload
+            position = await admit_job(update, context)
+            if position is None:
                 return
 
-            # Upload to Google Drive
-            try:
-                await upload_to_drive(track.filepath, track.file_title, track.mimetype, msg, message_metadata.folder)
-            except GoogleDriveUploadFail:
-                msg.edit_text("We managed to download the audio but failed to upload on Google Drive ❌.",
-                              parse_mode=ParseMode.MARKDOWN)
-                return
+            msg = await context.bot.send_message(chat_id=update.effective_chat.id,
+                                           text="Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!"
+                                                + queue_position_text(position),
+                                           parse_mode=ParseMode.MARKDOWN)
 
-            await update.message.reply_text("Your song *" + track.file_title + "* has been uploaded ✅.",
-                                      parse_mode=ParseMode.MARKDOWN)
+            await context.bot_data['tasks'].enqueue(YOUTUBE_TASK, {
+                "chat_id": update.effective_chat.id,
+                "chat_type": update.effective_chat.type,
+                "message_id": msg.message_id,
+                "reply_to_message_id": update.message.message_id,
+                "metadata": asdict(message_metadata),
+                "user_id": update.effective_user.id,
+            }, chat_id=update.effective_chat.id, user_id=update.effective_user.id)
 
         # Other providers ------
         else:
@@ -110,40 +184,32 @@ async def audio_file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         message_type = "voice"
 
     if message_type == "audio":
-        shazam_obj: File = File(Action.SHAZAM,
-                                update.message.audio.title,
-                                update.message.audio.file_id,
-                                update.message.audio.mime_type,
-                                update.effective_chat.id)
-
-        direct_obj: File = File(Action.GDRIVE_UPLOAD,
-                                update.message.audio.title,
-                                update.message.audio.file_id,
-                                update.message.audio.mime_type,
-                                update.effective_chat.id)
+        audio = update.message.audio
+        record = CallbackRecord(audio.title, audio.file_id, audio.mime_type, update.effective_chat.id,
+                                audio.file_unique_id, audio.duration)
 
     elif message_type == "voice":
-        shazam_obj: File = File(Action.SHAZAM,
-                                update.message.voice.file_unique_id,
-                                update.message.voice.file_id,
-                                update.message.voice.mime_type,
-                                update.effective_chat.id)
-
-        direct_obj: File = File(Action.GDRIVE_UPLOAD,
-                                update.message.voice.file_unique_id,
-                                update.message.voice.file_id,
-                                update.message.voice.mime_type,
-                                update.effective_chat.id)
+        voice = update.message.voice
+        record = CallbackRecord(voice.file_unique_id, voice.file_id, voice.mime_type, update.effective_chat.id,
+                                voice.file_unique_id, voice.duration)
 
     else:
         return None
 
+    # The buttons only carry the key of the file's record and their action. The store is on disk, so it's used off
+    # the event loop.
+    key = await asyncio.get_running_loop().run_in_executor(None, lambda: get_callback_store().add(record))
+
     keyboard = [
         [
             InlineKeyboardButton("Shazam ⚡",
-                                 callback_data=shazam_obj),
+                                 callback_data=callback_data(key, Action.SHAZAM)),
             InlineKeyboardButton("Drive Upload ⬆",
-                                 callback_data=direct_obj),
+                                 callback_data=callback_data(key, Action.GDRIVE_UPLOAD)),
+        ],
+        [
+            InlineKeyboardButton("Tracklist 📜",
+                                 callback_data=callback_data(key, Action.TRACKLIST)),
         ]
     ]
 
@@ -164,18 +230,43 @@ async def audio_file_handler_button(update: Update, context: ContextTypes.DEFAUL
     # CallbackQueries need to be answered, even if no notification to the user is needed
     await query.answer()
 
-    answer_file: File = query.data
+    key, action = parse_callback_data(query.data)
+    record = await asyncio.get_running_loop().run_in_executor(None, lambda: get_callback_store().get(key))
 
-    # Download file locally
-    file = await context.bot.getFile(answer_file.file_id)
-    await file.download_to_drive(answer_file.get_file_location())
+    if record is None:
+        await query.edit_message_text("These buttons have expired, please send the audio file again 🙁")
+        return
+
+    try:
+        answer_file: File = record.to_file(Action(action))
+    except ValueError:
+        await query.edit_message_text("That action is not permitted 🙁")
+        return
 
     # Check if the user wants to Shazam or directly upload the file to the Google Drive account
     if answer_file.action is Action.SHAZAM:
         await query.edit_message_text("Please wait while we detect the song ⌛")
 
         try:
-            track: ShazamTrack = await shazam(answer_file, context)
+            # The file is only downloaded if it wasn't recognized before
+            track: ShazamTrack = await cached_recognition(answer_file)
+
+            if track is None:
+                file = await context.bot.getFile(answer_file.file_id)
+
+                # Only a few seconds of the file are fetched, unless they can't be decoded
+                if SHAZAM_EXCERPT_SECONDS:
+                    try:
+                        track = await shazam_excerpt(answer_file, file.file_path)
+                    except AudioDecodeFail:
+                        logger.warning("Couldn't decode an excerpt of %s, recognizing the whole file.",
+                                       answer_file.file_id, exc_info=True)
+
+            if track is None:
+                async with get_scratch_space().job(file.file_size) as job:
+                    file_location = job.path(answer_file.file_title)
+                    await file.download_to_drive(file_location)
+                    track = await shazam(answer_file, context, file_location)
 
             await query.edit_message_text("We found a track! 🎉")
 
@@ -188,11 +279,512 @@ async def audio_file_handler_button(update: Update, context: ContextTypes.DEFAUL
             await query.edit_message_text(f'Unfortunately we couldn\'t detect a song ☹')
 
     elif answer_file.action is Action.GDRIVE_UPLOAD:
-        await query.edit_message_text("Please wait while we upload the song ⌛")
+        # The buttons are kept if the user can't queue the upload yet
+        position = await admit_job(update, context)
+        if position is None:
+            return
+
+        await query.edit_message_text("Please wait while we upload the song ⌛" + queue_position_text(position))
+
+        await context.bot_data['tasks'].enqueue(DRIVE_UPLOAD_TASK, {
+            "chat_id": update.effective_chat.id,
+            "chat_type": update.effective_chat.type,
+            "message_id": query.message.message_id,
+            "file": {**asdict(answer_file), "action": answer_file.action.value},
+        }, chat_id=update.effective_chat.id, user_id=update.effective_user.id)
+
+    elif answer_file.action is Action.TRACKLIST:
+        position = await admit_job(update, context)
+        if position is None:
+            return
+
+        await query.edit_message_text("Please wait while we make the tracklist of this mix ⌛"
+                                      + queue_position_text(position))
+
+        await context.bot_data['tasks'].enqueue(TRACKLIST_TASK, {
+            "chat_id": update.effective_chat.id,
+            "chat_type": update.effective_chat.type,
+            "message_id": query.message.message_id,
+            "file": {**asdict(answer_file), "action": answer_file.action.value},
+        }, chat_id=update.effective_chat.id, user_id=update.effective_user.id)
+
+    else:
+        await query.edit_message_text("That action is not permitted 🙁")
+
+
+# Task handlers ------------------
+
+async def youtube_task(bot: Bot, payload: dict) -> None:
+    """
+    Downloads the audio of a Youtube link and uploads it to Google Drive. Queued by the URL handler.
+    @param bot: Bot object.
+    @param payload: task payload, with the chat and status message IDs and the message metadata.
+    @return: nothing.
+    """
+    msg = get_status_message(bot, payload)
+    message_metadata = Metadata(**payload['metadata'])
+
+    file_title, drive_file = await youtube_to_drive(message_metadata, msg)
+
+    if drive_file.existing:
+        text = "Your song *" + file_title + "* is already on Google Drive ✅."
+    else:
+        text = "Your song *" + file_title + "* has been uploaded ✅."
+
+    await bot.send_message(chat_id=payload['chat_id'],
+                           text=text,
+                           reply_to_message_id=payload['reply_to_message_id'],
+                           parse_mode=ParseMode.MARKDOWN)
+
+
+async def youtube_to_drive(metadata: Metadata, message: Message) -> tuple:
+    """
+    Downloads the audio of a Youtube link and uploads it to Google Drive.
+    On pipelined mode the audio is transcoded straight into the upload, so both run at the same time. If that fails,
+    the audio is downloaded and then uploaded.
+    @param metadata: metadata of the song.
+    @param message: message showing the progress.
+    @return: (title of the song, DriveFile object) tuple.
+    """
+    if can_pipe_youtube_audio(metadata.url):
+        try:
+            source = await resolve_youtube_audio(metadata)
+            drive_file = await pipe_to_drive(lambda: transcode_youtube_audio(source, metadata),
+                                             expected_audio_size(source), source.title, "audio/mpeg", message,
+                                             metadata.folder, video_id=source.video_id)
+            return source.title, drive_file
+        except (YoutubeAudioDownloadFail, GoogleDriveUploadFail):
+            logger.exception("Couldn't pipe %s to Google Drive, downloading it first.", metadata.url)
+
+    async with get_scratch_space().job() as job:
+        track = await download_youtube_audio(metadata, message, job.directory)
+
+        # Upload to Google Drive
+        drive_file = await upload_to_drive(track.filepath, track.file_title, track.mimetype, message,
+                                           metadata.folder, video_id=track.video_id)
+
+    return track.file_title, drive_file
+
+
+async def youtube_task_failed(bot: Bot, payload: dict, error: Exception) -> None:
+    """
+    Lets the user know a Youtube link couldn't be processed.
+    @param bot: Bot object.
+    @param payload: task payload.
+    @param error: error that made the task fail.
+    @return: nothing.
+    """
+    if isinstance(error, YoutubeAudioDownloadFail):
+        text = "There was a problem downloading the audio from this Youtube link ❌."
+    elif isinstance(error, GoogleDriveUploadFail):
+        text = "We managed to download the audio but failed to upload on Google Drive ❌."
+    else:
+        text = "Something went wrong while processing this Youtube link ❌."
+
+    await get_status_message(bot, payload).edit_text(text, parse_mode=ParseMode.MARKDOWN)
+
+
+async def youtube_batch_task(bot: Bot, payload: dict) -> None:
+    """
+    Downloads the audio of several Youtube links and uploads them to Google Drive, a few at a time.
+    Queued by the URL handler when a message has more than one Youtube link. Songs take turns with the songs of other
+    users' batches and playlists. The progress of every song is shown on the same status message, which ends with a
+    summary.
+    Every song counts against the user's rate limit as it's processed. Once the user runs out of it, the task is
+    deferred until the rate limit is refilled, and the songs already processed are checkpointed so they're skipped.
+    @param bot: Bot object.
+    @param payload: task payload, with the chat and status message IDs, the message metadata and the links.
+    @return: nothing.
+    """
+    msg = get_status_message(bot, payload)
+    message_metadata = Metadata(**payload['metadata'])
+    urls = payload['urls']
+    job_id = batch_job_id(payload)
+    user_id = payload.get('user_id')
+    video_ids = [url_is_youtube_valid(url).group(1) for url in urls]
+    checkpoints = get_checkpoints()
+    loop = asyncio.get_running_loop()
+
+    progress = BatchProgress(msg, f"Downloading {len(urls)} songs and uploading them to Google Drive ⌛", video_ids)
+
+    await prepare_drive_folder(message_metadata.folder)
+
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    slots = get_song_slots()
+    deferred = 0
+
+    async def process(index: int, url: str) -> bool:
+        nonlocal deferred
+        async with semaphore:
+            # Songs processed before the task was deferred
+            if await loop.run_in_executor(None, checkpoints.contains, job_id, video_ids[index]):
+                progress.set(index, "already uploaded ✅", finished=True)
+                return True
+            if await loop.run_in_executor(None, checkpoints.contains, job_id, FAILED_CHECKPOINT + video_ids[index]):
+                progress.set(index, "Failed ❌", finished=True)
+                return False
+
+            deferred = deferred or take_song(user_id)
+            if deferred:
+                return False
+
+            async with slots.slot(payload['chat_id'], user_id):
+                uploaded = await process_batch_song(progress, index, message_metadata, url)
+
+        await loop.run_in_executor(None, checkpoints.add, job_id,
+                                   video_ids[index] if uploaded else FAILED_CHECKPOINT + video_ids[index])
+        return uploaded
+
+    results = await asyncio.gather(*[process(i, url) for i, url in enumerate(urls)])
+
+    if deferred:
+        await progress.finish(f"{sum(results)} of {len(urls)} songs are on Google Drive so far. You're queueing songs "
+                              f"too fast 🐢, going on with the rest in {math.ceil(deferred)} seconds.")
+        raise TaskDeferred(deferred)
+
+    await loop.run_in_executor(None, checkpoints.clear, job_id)
+    await progress.finish(f"Done! {sum(results)} of {len(urls)} songs are on Google Drive.")
+
+
+def batch_job_id(payload: dict) -> str:
+    """
+    Gets the ID the songs of a batch are checkpointed under. A batch has its own status message, so it's made from it.
+    @param payload: task payload of the batch.
+    @return: job ID.
+    """
+    return "batch:{}:{}".format(payload['chat_id'], payload['message_id'])
+
+
+def take_song(user_id: int) -> float:
+    """
+    Takes a song of a batch or playlist from the user's rate limit.
+    @param user_id: ID of the user that queued the batch or playlist.
+    @raise TaskRateLimited: if the user can never have more songs processed.
+    @return: 0 if it was taken. Otherwise, seconds the task is deferred for - until the rate limit is refilled, so the
+    next run processes a few songs.
+    """
+    limits = get_user_limits()
+    if not limits.take(user_id):
+        return 0
+
+    delay = limits.wait_time(user_id, limits.capacity)
+    if math.isinf(delay):
+        raise TaskRateLimited(delay)
+
+    return delay
+
 
-        upload_to_drive(answer_file.get_file_location(), answer_file.file_title, answer_file.mime_type)
+async def youtube_playlist_task(bot: Bot, payload: dict) -> None:
+    """
+    Downloads the audio of the videos of a Youtube playlist and uploads them to Google Drive.
+    Queued by the URL handler. Videos are processed as the playlist is listed, a few at a time, and the ones already
+    uploaded are checkpointed, so a retried task only processes the rest. If any video fails, the task fails once the
+    whole playlist is processed, so it's retried.
+    Every video counts against the user's rate limit as it's listed. Once the user runs out of it, listing stops and
+    the task is deferred until the rate limit is refilled, picking up from the checkpoints. Videos take turns with the
+    songs of other users' batches and playlists.
+    @param bot: Bot object.
+    @param payload: task payload, with the chat and status message IDs, the message metadata and the job ID.
+    @return: nothing.
+    """
+    msg = get_status_message(bot, payload)
+    message_metadata = Metadata(**payload['metadata'])
+    job_id = payload['job_id']
+    user_id = payload.get('user_id')
+    checkpoints = get_checkpoints()
+    slots = get_song_slots()
+    loop = asyncio.get_running_loop()
+
+    progress = BatchProgress(msg, "Downloading the playlist and uploading it to Google Drive ⌛",
+                             max_lines=PLAYLIST_PROGRESS_LINES)
+
+    await prepare_drive_folder(message_metadata.folder)
+
+    entries = asyncio.Queue(maxsize=BATCH_MAX_CONCURRENCY)
+    failed = 0
+
+    async def work():
+        nonlocal failed
+        while True:
+            entry = await entries.get()
+            if entry is None:
+                return
+
+            index = progress.add(entry['title'])
+            try:
+                async with slots.slot(payload['chat_id'], user_id):
+                    uploaded = await process_batch_song(progress, index, message_metadata, entry['url'])
+            except Exception:
+                # Workers keep going, otherwise the listing would wait for them forever
+                logger.exception("Problem processing %s.", entry['url'])
+                progress.set(index, "Failed ❌", finished=True)
+                uploaded = False
+
+            if uploaded:
+                await loop.run_in_executor(None, checkpoints.add, job_id, entry['id'])
+            else:
+                failed += 1
+
+    workers = [asyncio.create_task(work()) for _ in range(BATCH_MAX_CONCURRENCY)]
+    playlist = list_youtube_playlist(message_metadata.url)
+    deferred = 0
+
+    try:
+        async for entry in playlist:
+            if await loop.run_in_executor(None, checkpoints.contains, job_id, entry['id']):
+                progress.set(progress.add(entry['title']), "already uploaded ✅", finished=True)
+                continue
+
+            deferred = take_song(user_id)
+            if deferred:
+                break
+
+            await entries.put(entry)
+
+        for _ in workers:
+            await entries.put(None)
+        await asyncio.gather(*workers)
+
+    finally:
+        # Stops the listing if it's left before the end
+        await playlist.aclose()
+        for worker in workers:
+            worker.cancel()
+
+    if deferred:
+        await progress.finish(f"{progress.count - failed} songs are on Google Drive so far. You're queueing songs "
+                              f"too fast 🐢, going on with the rest in {math.ceil(deferred)} seconds.")
+        raise TaskDeferred(deferred)
+
+    if failed:
+        await progress.finish(f"{progress.count - failed} of {progress.count} songs are on Google Drive, "
+                              f"trying the other {failed} again later.")
+        raise YoutubeAudioDownloadFail(f"{failed} songs of the playlist failed.")
+
+    await loop.run_in_executor(None, checkpoints.clear, job_id)
+    await progress.finish(f"Done! {progress.count} songs are on Google Drive.")
+
+
+async def youtube_playlist_task_failed(bot: Bot, payload: dict, error: Exception) -> None:
+    """
+    Lets the user know a Youtube playlist couldn't be (fully) processed.
+    @param bot: Bot object.
+    @param payload: task payload.
+    @param error: error that made the task fail.
+    @return: nothing.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, get_checkpoints().clear, payload['job_id'])
+
+    await get_status_message(bot, payload).edit_text(
+        "There was a problem downloading some of the songs of this Youtube playlist ❌.",
+        parse_mode=ParseMode.MARKDOWN)
+
+
+async def prepare_drive_folder(folder: str) -> None:
+    """
+    Looks up (or creates) the Google Drive folder songs are uploaded to, so it's done once for a batch of songs.
+    @param folder: name of the folder. Nothing is done if None.
+    @return: nothing.
+    """
+    if not folder:
+        return
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(upload_executor, get_or_create_drive_folder, folder)
+    except Exception:
+        raise GoogleDriveUploadFail("Problem getting the Google Drive folder.")
+
+
+async def process_batch_song(progress: BatchProgress, index: int, message_metadata: Metadata, url: str) -> bool:
+    """
+    Downloads the audio of a Youtube link of a batch and uploads it to Google Drive, showing its progress.
+    @param progress: BatchProgress object of the batch.
+    @param index: index of the song in the batch.
+    @param message_metadata: metadata of the message.
+    @param url: Youtube link.
+    @return: True if the song is on Google Drive.
+    """
+    # Titles and track numbers are specific to a song, so they're not set on every song of the batch
+    metadata = replace(message_metadata, url=url, urls=[url], title="", track="")
+    item_message = progress.item(index)
 
-        await query.edit_message_text(text=f"Song uploaded!")
+    try:
+        file_title, drive_file = await youtube_to_drive(metadata, item_message)
+    except YoutubeAudioDownloadFail:
+        progress.set(index, "Download failed ❌", finished=True)
+        return False
+    except GoogleDriveUploadFail:
+        progress.set(index, "Upload failed ❌", finished=True)
+        return False
 
+    progress.set(index, file_title + (" - already on Google Drive ✅" if drive_file.existing
+                                      else " - uploaded ✅"), finished=True)
+    return True
+
+
+async def youtube_batch_task_failed(bot: Bot, payload: dict, error: Exception) -> None:
+    """
+    Lets the user know a batch of Youtube links couldn't be processed.
+    @param bot: Bot object.
+    @param payload: task payload.
+    @param error: error that made the task fail.
+    @return: nothing.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, get_checkpoints().clear, batch_job_id(payload))
+
+    if isinstance(error, GoogleDriveUploadFail):
+        text = "We couldn't get the Google Drive folder to upload these songs to ❌."
+    else:
+        text = "Something went wrong while processing these Youtube links ❌."
+
+    await get_status_message(bot, payload).edit_text(text, parse_mode=ParseMode.MARKDOWN)
+
+
+async def drive_upload_task(bot: Bot, payload: dict) -> None:
+    """
+    Streams an audio file sent to the chat to Google Drive. Queued by the audio file button handler.
+    @param bot: Bot object.
+    @param payload: task payload, with the chat and status message IDs and the File object.
+    @return: nothing.
+    """
+    msg = get_status_message(bot, payload)
+    answer_file = File(**{**payload['file'], "action": Action(payload['file']['action'])})
+
+    # Stream the file from Telegram to Google Drive
+    file = await bot.getFile(answer_file.file_id)
+    drive_file = await stream_to_drive(file.file_path, file.file_size, answer_file.file_title, answer_file.mime_type,
+                                       msg, telegram_id=file.file_unique_id)
+
+    if drive_file.existing:
+        await msg.edit_text(text=f"Song is already on Google Drive!")
     else:
-        await query.edit_message_text("That action is not permitted 🙁")
\ No newline at end of file
+        await msg.edit_text(text=f"Song uploaded!")
+
+
+async def drive_upload_task_failed(bot: Bot, payload: dict, error: Exception) -> None:
+    """
+    Lets the user know an audio file couldn't be uploaded.
+    @param bot: Bot object.
+    @param payload: task payload.
+    @param error: error that made the task fail.
+    @return: nothing.
+    """
+    await get_status_message(bot, payload).edit_text("We failed to upload this song on Google Drive ❌.")
+
+
+async def tracklist_task(bot: Bot, payload: dict) -> None:
+    """
+    Makes the tracklist of a mix sent to the chat. Queued by the audio file button handler.
+    @param bot: Bot object.
+    @param payload: task payload, with the chat and status message IDs and the File object.
+    @return: nothing.
+    """
+    msg = get_status_message(bot, payload)
+    answer_file = File(**{**payload['file'], "action": Action(payload['file']['action'])})
+
+    # Windows of the mix, roughly, as Telegram's durations are rounded
+    windows = max(1, math.ceil((answer_file.duration or 0) / TRACKLIST_STEP_SECONDS))
+    progress = ProgressReporter(msg)
+
+    file = await bot.getFile(answer_file.file_id)
+    try:
+        entries = await recognize_tracklist(
+            file.file_path, on_progress=lambda done: progress.post(
+                f"Listening to the mix... {min(done, windows)}/{windows} 🎧"))
+    finally:
+        progress.close()
+
+    if not entries:
+        await msg.edit_text(text="Unfortunately we couldn't detect any song in this mix ☹")
+        return
+
+    await msg.edit_text(text=format_tracklist(entries))
+
+
+async def tracklist_task_failed(bot: Bot, payload: dict, error: Exception) -> None:
+    """
+    Lets the user know the tracklist of a mix couldn't be made.
+    @param bot: Bot object.
+    @param payload: task payload.
+    @param error: error that made the task fail.
+    @return: nothing.
+    """
+    await get_status_message(bot, payload).edit_text("We failed to make the tracklist of this mix ❌.")
+
+
+async def admit_job(update: Update, context: ContextTypes.DEFAULT_TYPE, cost: int = 1):
+    """
+    Checks if the user can queue a job, telling them when to try again if they're queueing them too fast.
+    @param update: Update object.
+    @param context: Context object.
+    @param cost: number of jobs it counts as. 0 for batches and playlists, whose songs are counted as they're
+    processed.
+    @return: estimated position of the job on the queue (0 if it starts right away). None if it can't be queued.
+    """
+    try:
+        return await context.bot_data['tasks'].admit(update.effective_chat.id, update.effective_user.id, cost)
+    except TaskRateLimited as e:
+        if math.isinf(e.retry_after):
+            wait = "later"
+        else:
+            wait = f"in {math.ceil(e.retry_after)} seconds"
+
+        await update.effective_message.reply_text(f"You're queueing songs too fast 🐢. Please try again {wait}.")
+        return None
+
+
+def queue_position_text(position: int) -> str:
+    """
+    Gets the line of a status message telling the position of its job on the queue.
+    @param position: estimated position of the job. 0 if it starts right away.
+    @return: text to append to the status message.
+    """
+    if position == 0:
+        return ""
+
+    return f"\nQueued, position {position} ⏳"
+
+
+def get_status_message(bot: Bot, payload: dict) -> Message:
+    """
+    Rebuilds the status message of a task from its chat and message IDs, so it can be edited.
+    @param bot: Bot object.
+    @param payload: task payload.
+    @return: Message object.
+    """
+    message = Message(message_id=payload['message_id'],
+                      date=datetime.now(),
+                      chat=Chat(id=payload['chat_id'], type=payload['chat_type']))
+    message.set_bot(bot)
+    return message
+
+
+def get_youtube_video_urls(urls: list) -> list:
+    """
+    Gets the links to Youtube videos from a list of links, without repeating videos.
+    @param urls: list of links.
+    @return: list of Youtube video links.
+    """
+    video_urls = {}
+    for url in urls:
+        video_match = url_is_youtube_valid(url) if YOUTUBE_PATTERN.search(url) else None
+        if video_match:
+            video_urls.setdefault(video_match.group(1), url)
+
+    return list(video_urls.values())
+
+
+def format_tracklist(entries: list) -> str:
+    """
+    Formats a tracklist as one line per song with the time range it plays in, fitting a Telegram message.
+    @param entries: list of TracklistEntry objects.
+    @return: tracklist text.
+    """
+    lines = ["Tracklist 📜"]
+    lines += [f"{format_timestamp(entry.start)} - {format_timestamp(entry.end)}  {entry.subtitle} - {entry.title}"
+              for entry in entries]
+
+    text = "\n".join(lines)
+    if len(text) > MessageLimit.MAX_TEXT_LENGTH:
+        text = text[:MessageLimit.MAX_TEXT_LENGTH - 1] + "…"
+    return text
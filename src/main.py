@@ -1,3 +1,9 @@
+import asyncio
+import importlib
+import logging
+import threading
+from concurrent.futures import Future
+
 from decouple import config
 from telegram.ext import (
     Application,
@@ -7,20 +13,146 @@ from telegram.ext import (
     filters
 )
 
-from src.handlers import start_handler, help_handler, url_handler, audio_file_handler, audio_file_handler_button
-from src.services.gdrive import get_creds
+from src.definitions.definitions import DATA_DIR
+from src.metrics import METRICS_LOG_INTERVAL, log_metrics
+from src.storage import get_scratch_space
+from src.tasks import TaskQueue, TaskWorkers
 
+POLLING_MODE = "polling"
+WEBHOOK_MODE = "webhook"
 
-def exec():
-    """Start the bot."""
-    get_creds()
+# How the bot gets its updates - polling Telegram for them, or on a webhook server Telegram posts them to
+BOT_MODE = config("BOT_MODE", default=POLLING_MODE)
 
+# Module of the handlers. It pulls in the services and their heavy dependencies (yt-dlp, shazamio, the Google API
+# client...), so it's imported on a background thread while the bot connects to Telegram, instead of on startup.
+HANDLERS_MODULE = 'src.handlers'
 
-    # Create the Updater and get application to register handlers
-    application = Application.builder().token(config("BOT_TOKEN")).arbitrary_callback_data(True).build()
-    updater = application.updater
 
-    # Handlers
+class Warmup:
+    """
+    Imports the handlers and validates the Google Drive credentials on a background thread, so both happen while the
+    bot is being initialized. Handlers called before the import is done wait for it.
+    """
+
+    def __init__(self):
+        self.handlers = Future()
+        self.credentials = Future()
+
+    def start(self):
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def _run(self):
+        try:
+            self.handlers.set_result(importlib.import_module(HANDLERS_MODULE))
+        except BaseException as e:
+            self.handlers.set_exception(e)
+            self.credentials.set_exception(e)
+            return
+
+        try:
+            importlib.import_module('src.services.gdrive').drive_client.credentials()
+            self.credentials.set_result(None)
+        except BaseException as e:
+            self.credentials.set_exception(e)
+
+
+_warmup = None
+
+
+async def get_handlers():
+    """
+    Gets the handlers module, waiting for the warm-up to import it (or importing it, if there's no warm-up).
+    @return: handlers module.
+    """
+    if _warmup is not None:
+        return await asyncio.wrap_future(_warmup.handlers)
+
+    return importlib.import_module(HANDLERS_MODULE)
+
+
+def _lazy_handler(name: str):
+    """
+    Gets a handler that calls the handler of the given name once the handlers module is imported.
+    @param name: name of the handler in the handlers module.
+    @return: coroutine function.
+    """
+
+    async def handler(*args, **kwargs):
+        handlers = await get_handlers()
+        return await getattr(handlers, name)(*args, **kwargs)
+
+    handler.__name__ = handler.__qualname__ = name
+    return handler
+
+
+start_handler = _lazy_handler('start_handler')
+help_handler = _lazy_handler('help_handler')
+url_handler = _lazy_handler('url_handler')
+audio_file_handler = _lazy_handler('audio_file_handler')
+audio_file_handler_button = _lazy_handler('audio_file_handler_button')
+
+
+async def post_init(application: Application) -> None:
+    """Start the task workers once the bot is initialized and the handlers are imported."""
+    handlers = await get_handlers()
+    if _warmup is not None:
+        # The bot doesn't start without Google Drive credentials
+        await asyncio.wrap_future(_warmup.credentials)
+
+    workers = TaskWorkers(TaskQueue(DATA_DIR + 'tasks.sqlite3'), application.bot)
+    workers.register(handlers.YOUTUBE_TASK, handlers.youtube_task, handlers.youtube_task_failed)
+    workers.register(handlers.DRIVE_UPLOAD_TASK, handlers.drive_upload_task, handlers.drive_upload_task_failed)
+    workers.register(handlers.YOUTUBE_BATCH_TASK, handlers.youtube_batch_task, handlers.youtube_batch_task_failed)
+    workers.register(handlers.YOUTUBE_PLAYLIST_TASK, handlers.youtube_playlist_task,
+                     handlers.youtube_playlist_task_failed)
+    workers.register(handlers.TRACKLIST_TASK, handlers.tracklist_task, handlers.tracklist_task_failed)
+
+    application.bot_data['tasks'] = workers
+
+    # Removing the files left by the jobs of a previous run, before new ones start
+    get_scratch_space()
+    await workers.start()
+
+    # Metrics are logged on both modes, as polling mode has no health endpoint
+    if METRICS_LOG_INTERVAL > 0:
+        application.bot_data['metrics_log'] = asyncio.create_task(log_metrics(application))
+
+    # Filling the index of uploaded files from Google Drive, e.g. on a new machine
+    from src.services.gdrive import get_drive_index, rebuild_drive_index
+    if get_drive_index().is_empty():
+        try:
+            indexed = await asyncio.get_running_loop().run_in_executor(None, rebuild_drive_index)
+            logging.info("Indexed %d files already on Google Drive.", indexed)
+        except Exception:
+            logging.exception("Couldn't index the files already on Google Drive.")
+
+
+async def post_shutdown(application: Application) -> None:
+    """
+    Stop the metrics log, the task workers and their worker processes, and close the Shazam session. Unfinished tasks
+    are picked up on the next start.
+    """
+    metrics_log = application.bot_data.get('metrics_log')
+    if metrics_log is not None:
+        metrics_log.cancel()
+
+    # There are no workers if the bot failed to start, e.g. without Google Drive credentials
+    workers: TaskWorkers = application.bot_data.get('tasks')
+    if workers is not None:
+        await workers.stop()
+        workers.queue.close()
+
+    from src.services.shazam import close_shazam_client, tracklist_pool
+    from src.services.youtube import download_pool, listing_pool
+    for pool in (download_pool, listing_pool, tracklist_pool):
+        pool.close()
+
+    await close_shazam_client()
+
+
+def add_handlers(application: Application) -> None:
+    """Register the bot handlers."""
     application.add_handler(CommandHandler("start", start_handler))
     application.add_handler(CommandHandler("help", help_handler))
 
@@ -30,8 +162,34 @@ def exec():
 
     application.add_handler(MessageHandler(filters.Entity("url"), url_handler))
 
-    application.run_polling()
-    updater.idle()
+
+def exec():
+    """Start the bot."""
+    global _warmup
+
+    # Importing the handlers and validating the credentials while the bot connects to Telegram
+    _warmup = Warmup()
+    _warmup.start()
+
+    # Create the Updater and get application to register handlers
+    builder = Application.builder().token(config("BOT_TOKEN")).post_init(post_init).post_shutdown(post_shutdown)
+
+    # Updates are posted to the webhook server instead of being fetched by the updater
+    if BOT_MODE == WEBHOOK_MODE:
+        builder = builder.updater(None)
+
+    application = builder.build()
+
+    # Handlers
+    add_handlers(application)
+
+    if BOT_MODE == WEBHOOK_MODE:
+        from src.webhook import run_webhook
+        asyncio.run(run_webhook(application))
+    else:
+        updater = application.updater
+        application.run_polling()
+        updater.idle()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+import asyncio
+import json
+import logging
+
+from decouple import config
+from telegram.ext import Application
+
+from src.storage import get_scratch_space
+
+logger = logging.getLogger(__name__)
+
+# Seconds between logs of the bot metrics, so they can be followed on polling mode too, where there's no health
+# endpoint. 0 disables them.
+METRICS_LOG_INTERVAL = config("METRICS_LOG_INTERVAL", default=300, cast=float)
+
+
+async def collect_metrics(application: Application) -> dict:
+    """
+    Gets the metrics of the bot, e.g. for monitoring.
+    @param application: bot application.
+    @return: dict with the number of updates waiting to be handled, the usage of the scratch space and, once the task
+    workers are started, the task queue metrics.
+    """
+    # Measuring the scratch space walks its directories, so it's done off the event loop
+    scratch = await asyncio.get_running_loop().run_in_executor(None, get_scratch_space().usage)
+    metrics = {'pending_updates': application.update_queue.qsize(), 'scratch': scratch}
+
+    workers = application.bot_data.get('tasks')
+    if workers is not None:
+        metrics['tasks'] = await workers.metrics()
+
+    return metrics
+
+
+async def log_metrics(application: Application, interval: float = METRICS_LOG_INTERVAL):
+    """
+    Logs the metrics of the bot as JSON every 'interval' seconds, until it's cancelled.
+    @param application: bot application.
+    @param interval: seconds between logs.
+    @return:
+    """
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            metrics = await collect_metrics(application)
+        except Exception:
+            logger.exception("Couldn't collect the bot metrics.")
+            continue
+
+        logger.info("Metrics: %s", json.dumps(metrics, sort_keys=True))
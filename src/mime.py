@@ -0,0 +1,89 @@
+import threading
+
+import magic
+
+# MIME types of the audio formats the bot stores, by extension (e.g. the 'opus' of an 'opus-160' format)
+FORMAT_MIME_TYPES = {
+    'mp3': 'audio/mpeg',
+    'm4a': 'audio/mp4',
+    'mp4': 'audio/mp4',
+    'aac': 'audio/aac',
+    'opus': 'audio/ogg',
+    'ogg': 'audio/ogg',
+    'webm': 'audio/webm',
+    'flac': 'audio/flac',
+    'wav': 'audio/wav',
+}
+
+# MIME types that don't tell what a file is, so its content is looked at instead
+GENERIC_MIME_TYPES = {'', 'application/octet-stream', 'binary/octet-stream'}
+
+DEFAULT_MIME_TYPE = 'application/octet-stream'
+
+# Bytes at the start of a file libmagic looks at
+SNIFF_SIZE = 8 * 1024
+
+# Start of an ID3v2 tag
+ID3_MAGIC = b"ID3"
+
+_magic = None
+_magic_lock = threading.Lock()
+
+
+def resolve_mime_type(declared: str = None, audio_format: str = None, head: bytes = None, path: str = None) -> str:
+    """
+    Gets the MIME type of a file, trusting what's already known about it (e.g. the MIME type Telegram gives or the
+    format yt-dlp produced) before looking at its content.
+    @param declared: MIME type the file came with, if any.
+    @param audio_format: format the file was stored in, e.g. 'mp3-320'.
+    @param head: first bytes of the file, if they're in memory.
+    @param path: path of the file. Its first bytes are only read if nothing else tells its MIME type.
+    @return: MIME type of the file. 'application/octet-stream' if it can't be told.
+    """
+    if declared and declared.lower() not in GENERIC_MIME_TYPES:
+        return declared
+
+    if audio_format:
+        mime_type = FORMAT_MIME_TYPES.get(audio_format.split('-')[0].lower())
+        if mime_type is not None:
+            return mime_type
+
+    if head is None and path is not None:
+        with open(path, 'rb') as file:
+            head = file.read(SNIFF_SIZE)
+
+    if head:
+        return sniff_mime_type(head)
+
+    return DEFAULT_MIME_TYPE
+
+
+def sniff_mime_type(head: bytes) -> str:
+    """
+    Gets the MIME type of a file from its first bytes, with the shared libmagic handle.
+    @param head: first bytes of the file (only the first 'SNIFF_SIZE' are looked at).
+    @return: MIME type of the file.
+    """
+    mime_type = get_magic().from_buffer(head[:SNIFF_SIZE])
+
+    # libmagic only tells an MP3 from the frames after its ID3 tag, which can be far bigger than the sniffed bytes
+    # (e.g. with cover art)
+    if mime_type in GENERIC_MIME_TYPES and head.startswith(ID3_MAGIC):
+        return FORMAT_MIME_TYPES['mp3']
+
+    return mime_type
+
+
+def get_magic() -> magic.Magic:
+    """
+    Gets the shared libmagic handle, loading its database on first use. The handle serializes its own calls, so it's
+    safe to use from any thread.
+    @return: Magic object giving MIME types.
+    """
+    global _magic
+
+    with _magic_lock:
+        if _magic is None:
+            _magic = magic.Magic(mime=True)
+
+    return _magic
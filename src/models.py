@@ -1,5 +1,5 @@
 import enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from src.definitions.definitions import FILES_DIR
 from src.exceptions import TrackNotFound
@@ -8,6 +8,7 @@ from src.exceptions import TrackNotFound
 class Action(enum.Enum):
     SHAZAM = "shazam"
     GDRIVE_UPLOAD = "gdrive"
+    TRACKLIST = "tracklist"
 
 
 @dataclass
@@ -17,6 +18,8 @@ class File:
     file_id: str
     mime_type: str
     chat_id: str
+    file_unique_id: str = None
+    duration: int = None
 
     def get_file_location(self) -> str:
         """
@@ -42,12 +45,38 @@ class ShazamTrack:
             raise TrackNotFound
 
 
+@dataclass
+class TracklistEntry:
+    start: float
+    end: float
+    title: str
+    subtitle: str
+
+
 @dataclass
 class YoutubeTrack:
     file_title: str
     video_id: str
     filepath: str
     mimetype: str
+    audio_format: str = None
+
+
+@dataclass
+class YoutubeSource:
+    video_id: str
+    title: str
+    url: str
+    http_headers: dict
+    bitrate: int
+    duration: float = None
+
+
+@dataclass
+class DriveFile:
+    file_id: str
+    link: str
+    existing: bool
 
 
 @dataclass
@@ -60,3 +89,14 @@ class Metadata:
     album: str
     title: str
     folder: str
+    urls: list = field(default_factory=list)
+
+
+@dataclass
+class Task:
+    id: int
+    kind: str
+    payload: dict
+    attempts: int
+    # Seconds the task waited on the queue before it was claimed
+    waited: float = 0
@@ -0,0 +1,191 @@
+import asyncio
+import multiprocessing
+import pickle
+import queue
+import time
+
+from src.exceptions import JobTimeout, JobFailed
+
+# Processes are spawned (not forked) so jobs don't inherit the bot's threads and event loop
+_context = multiprocessing.get_context("spawn")
+
+# Seconds between checks for progress and results of running jobs
+POLL_INTERVAL = 0.1
+
+
+class ProcessPool:
+    """
+    Runs CPU or I/O heavy jobs on other processes, so they don't block the event loop.
+    At most 'size' jobs run at the same time, the others wait for their turn.
+    Worker processes are started as they're needed and kept for the next jobs, so jobs don't pay for starting an
+    interpreter and importing their modules (e.g. yt-dlp) again. A worker whose job is cancelled or takes too long is
+    killed, and a new one takes its place on the next job.
+    """
+
+    def __init__(self, size: int, buffer: int = 0, max_jobs: int = None):
+        """
+        @param size: maximum number of jobs running at the same time.
+        @param buffer: progress values a job can send ahead of the ones handled, before 'report' blocks it. No limit
+        if 0.
+        @param max_jobs: jobs a worker runs before it's replaced by a new one. No limit if None.
+        """
+        self.size = max(1, size)
+        self.buffer = buffer
+        self.max_jobs = max_jobs
+
+        self._idle = []
+        self._semaphore = None
+        self._loop = None
+
+    async def run(self, fn, *args, timeout: float = None, on_progress=None):
+        """
+        Runs 'fn(report, *args)' on a worker process and waits for its result.
+        The job calls 'report(value)' to send progress back, which is handed to 'on_progress(value)' on the event loop.
+        If the job is cancelled or times out, its process is killed.
+        @param fn: module-level function to run (it must be picklable).
+        @param args: arguments of the function (they must be picklable).
+        @param timeout: seconds the job may run for (not counting the time waiting for its turn). None for no limit.
+        @param on_progress: function (or coroutine function) called with each progress value sent by the job. While
+        a coroutine function is running, the job can only send 'buffer' more values.
+        @return: the value returned by the function.
+        """
+        async with self._get_semaphore():
+            worker = self._take_worker()
+            reusable = False
+
+            try:
+                worker.start_job(fn, args)
+                kind, value = await self._wait(worker, timeout, on_progress)
+
+                # The job is over (even if it raised an exception), so the worker can take the next one
+                reusable = self.max_jobs is None or worker.jobs < self.max_jobs
+                if kind == "error":
+                    raise value
+                return value
+
+            finally:
+                if reusable:
+                    self._idle.append(worker)
+                else:
+                    worker.stop()
+
+    def _take_worker(self) -> "_Worker":
+        # Idle workers may have died meanwhile (e.g. killed for memory)
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.process.is_alive():
+                return worker
+            worker.stop()
+
+        return _Worker(self.buffer)
+
+    def close(self):
+        """
+        Stops the idle workers. Workers of running jobs are stopped when their jobs are over.
+        @return:
+        """
+        while self._idle:
+            self._idle.pop().stop()
+
+    async def _wait(self, worker: "_Worker", timeout: float, on_progress) -> tuple:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        while True:
+            # The process might exit right after sending its result, so it's only checked once the queue is empty
+            exited = not worker.process.is_alive()
+
+            try:
+                kind, value = worker.messages.get_nowait()
+            except queue.Empty:
+                if exited:
+                    raise JobFailed("Job process exited with code {}.".format(worker.process.exitcode))
+
+                if deadline is not None and time.monotonic() > deadline:
+                    raise JobTimeout("Job took longer than {} seconds.".format(timeout))
+
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            if kind == "progress":
+                if on_progress is not None:
+                    ret = on_progress(value)
+                    if asyncio.iscoroutine(ret):
+                        await ret
+            else:
+                return kind, value
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # The semaphore is created lazily so it belongs to the running event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.size)
+            self._loop = loop
+
+        return self._semaphore
+
+
+class _Worker:
+    """Worker process of a ProcessPool, running the jobs sent to it one after the other."""
+
+    def __init__(self, buffer: int):
+        self.jobs = 0
+        self._inbox = _context.Queue()
+        self.messages = _context.Queue(maxsize=buffer)
+        self.process = _context.Process(target=_work, args=(self._inbox, self.messages), daemon=True)
+        self.process.start()
+
+    def start_job(self, fn, args):
+        self.jobs += 1
+        self._inbox.put((fn, args))
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+        self._inbox.close()
+        self.messages.close()
+
+
+def _work(inbox, messages):
+    """
+    Entry point of worker processes. Runs the jobs sent through the inbox until None is sent.
+    @param inbox: queue the (function, arguments) tuples of the jobs come through.
+    @param messages: queue to send the progress and results of the jobs through.
+    @return:
+    """
+    for fn, args in iter(inbox.get, None):
+        _run_job(messages, fn, args)
+
+
+def _run_job(messages, fn, args):
+    """
+    Runs a job and sends its progress and result back through the queue.
+    @param messages: queue to send ('progress' | 'result' | 'error', value) tuples through. Sending blocks while the
+    queue is full.
+    @param fn: function to run.
+    @param args: arguments of the function.
+    @return:
+    """
+
+    def report(value):
+        messages.put(("progress", value))
+
+    try:
+        result = fn(report, *args)
+    except Exception as e:
+        # Exceptions that can't be pickled are sent as a generic failure
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = JobFailed(repr(e))
+        messages.put(("error", e))
+        return
+
+    # A result that can't be sent would be lost, leaving the job waiting on a worker that's still alive
+    try:
+        pickle.dumps(result)
+    except Exception as e:
+        messages.put(("error", JobFailed("The result of the job can't be sent back: {!r}".format(e))))
+    else:
+        messages.put(("result", result))
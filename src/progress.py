@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import threading
+import time
+
+from decouple import config
+from telegram import Message
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between two progress edits of the same message
+PROGRESS_EDIT_INTERVAL = config("PROGRESS_EDIT_INTERVAL", default=3, cast=float)
+
+
+class ProgressReporter:
+    """
+    Shows the progress of a job by editing a Telegram message.
+    Updates can be posted from any thread (yt-dlp and Drive upload workers included) and are merged: the message is
+    edited at most once every 'interval' seconds with the latest text, and never with the text it already shows.
+    The final state is always sent.
+    """
+
+    def __init__(self, message: Message, interval: float = PROGRESS_EDIT_INTERVAL, parse_mode=ParseMode.MARKDOWN):
+        self.message = message
+        self.interval = interval
+        self.parse_mode = parse_mode
+
+        self._loop = asyncio.get_running_loop()
+        self._lock = threading.Lock()
+        self._pending = None
+        self._last_text = None
+        self._last_edit_at = None
+        self._flush_task = None
+        self._closed = False
+
+    def post(self, text: str):
+        """
+        Posts a progress update. It's safe to call from any thread.
+        @param text: new text of the message.
+        @return:
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._pending = text
+
+        if _running_loop() is self._loop:
+            self._schedule_flush()
+        else:
+            self._loop.call_soon_threadsafe(self._schedule_flush)
+
+    async def finish(self, text: str):
+        """
+        Sends the final state of the message, regardless of when the last edit was made. Later updates are ignored.
+        Like the progress updates, it's best-effort: a failed edit (e.g. on flood control) is logged, not raised.
+        @param text: final text of the message.
+        @return:
+        """
+        self.close()
+
+        if text != self._last_text:
+            try:
+                await self._edit(text)
+            except TelegramError:
+                logger.warning("Couldn't send the final state of a progress message.", exc_info=True)
+
+    def close(self):
+        """
+        Stops sending progress updates. Pending updates are dropped.
+        @return:
+        """
+        with self._lock:
+            self._closed = True
+            self._pending = None
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    def _schedule_flush(self):
+        if self._flush_task is None and not self._closed:
+            self._flush_task = self._loop.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while True:
+                # Waiting for the end of the throttling window, merging every update posted meanwhile
+                if self._last_edit_at is not None:
+                    await asyncio.sleep(max(0.0, self._last_edit_at + self.interval - time.monotonic()))
+
+                with self._lock:
+                    text, self._pending = self._pending, None
+
+                if text is None:
+                    break
+
+                if text != self._last_text:
+                    # Progress updates are best-effort, a failed edit shouldn't fail the job
+                    try:
+                        await self._edit(text)
+                    except TelegramError:
+                        pass
+        finally:
+            if self._flush_task is asyncio.current_task():
+                self._flush_task = None
+
+    async def _edit(self, text: str):
+        self._last_text = text
+        self._last_edit_at = time.monotonic()
+        await self.message.edit_text(text, parse_mode=self.parse_mode)
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class BatchProgress:
+    """
+    Shows the progress of a batch of jobs on a single Telegram message, with one line per item.
+    Each item gets a message-like object to pass to the functions reporting progress on a message (e.g. Youtube
+    downloads and Drive uploads), so the last line of the texts they send becomes the item's state.
+    Items can be added as they come (e.g. songs of a playlist). With 'max_lines' set, finished items are only counted
+    and at most 'max_lines' unfinished ones are shown, so the message (and memory) doesn't grow with the batch.
+    """
+
+    def __init__(self, message: Message, title: str, items: list = (), interval: float = PROGRESS_EDIT_INTERVAL,
+                 max_lines: int = None):
+        """
+        @param message: Telegram message to edit.
+        @param title: first line of the message.
+        @param items: name of each item.
+        @param interval: minimum seconds between two edits of the message.
+        @param max_lines: maximum number of items shown. All items are shown if None.
+        """
+        self.title = title
+        self.max_lines = max_lines
+        self.count = 0
+        self.finished = 0
+
+        # index -> [name, state] of the shown items
+        self._items = {}
+
+        # Item names are links, which can't be sent as markdown
+        self._reporter = ProgressReporter(message, interval=interval, parse_mode=None)
+
+        for item in items:
+            self.add(item)
+
+    def add(self, item: str) -> int:
+        """
+        Adds an item to the batch.
+        @param item: name of the item.
+        @return: index of the item.
+        """
+        index = self.count
+        self.count += 1
+        self._items[index] = [item, "Waiting ⏳"]
+        return index
+
+    def item(self, index: int) -> "BatchItemMessage":
+        """
+        Gets a message-like object whose edits set the state of an item.
+        @param index: index of the item.
+        @return: BatchItemMessage object.
+        """
+        return BatchItemMessage(self, index)
+
+    def set(self, index: int, state: str, finished: bool = False):
+        """
+        Sets the state of an item.
+        @param index: index of the item.
+        @param state: new state of the item.
+        @param finished: if it's the final state of the item.
+        @return:
+        """
+        if index not in self._items:
+            return
+
+        if finished:
+            self.finished += 1
+
+        if finished and self.max_lines is not None:
+            del self._items[index]
+        else:
+            self._items[index][1] = state
+
+        self._reporter.post(self.render())
+
+    async def finish(self, summary: str):
+        """
+        Sends the final state of the batch, with a summary at the end.
+        @param summary: summary of the batch.
+        @return:
+        """
+        await self._reporter.finish(self.render() + "\n\n" + summary)
+
+    def render(self) -> str:
+        lines = [self.title]
+        if self.max_lines is not None:
+            lines.append(f"{self.finished} of {self.count} done")
+
+        for index, (item, state) in list(self._items.items())[:self.max_lines]:
+            lines.append(f"{index + 1}. {item} - {state}")
+        return "\n".join(lines)
+
+
+class BatchItemMessage:
+    """Stands in for the Telegram message of a single item of a batch, see BatchProgress."""
+
+    def __init__(self, batch: BatchProgress, index: int):
+        self.batch = batch
+        self.index = index
+
+    async def edit_text(self, text: str, *args, **kwargs):
+        self.batch.set(self.index, text.splitlines()[-1] if text else "")
@@ -1,25 +1,99 @@
 from __future__ import print_function
 
+import asyncio
+import contextlib
+import functools
+import hashlib
+import io
+import logging
 import os
+import sqlite3
+import threading
+import time
+
+import httpx
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from telegram import Message
-from telegram.constants import ParseMode
 
 
-from src.definitions.definitions import AUTH_DIR
+from decouple import config
+
+from src.definitions.definitions import AUTH_DIR, DATA_DIR
+from src.mime import resolve_mime_type, sniff_mime_type, GENERIC_MIME_TYPES, SNIFF_SIZE, DEFAULT_MIME_TYPE
+from src.models import DriveFile
+from src.progress import ProgressReporter
+from src.storage import get_scratch_space
 
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, MediaUpload, HttpRequest
 
 from src.exceptions import GoogleDriveClientSecretNotFound, FileDoesNotExist, GoogleDriveInvalidFileMeta, \
-    GoogleDriveUploadFail, GoogleDriveCreateFolderFail
+    GoogleDriveUploadFail, GoogleDriveCreateFolderFail, StreamRewindError
+
+logger = logging.getLogger(__name__)
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+# Credentials are refreshed ahead of time when they are this close to expiring
+REFRESH_MARGIN = timedelta(minutes=5)
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# Seconds a folder ID is kept in cache
+FOLDER_CACHE_TTL = config("DRIVE_FOLDER_CACHE_TTL", default=3600, cast=int)
+
+# Maximum number of uploads running at the same time. Uploads run on their own worker pool, off the event loop.
+MAX_CONCURRENT_UPLOADS = config("DRIVE_MAX_CONCURRENT_UPLOADS", default=3, cast=int)
+upload_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix="drive-upload")
+
+# Metadata requests (folder lookups, file checks...) made within this many seconds of each other are sent together, in
+# batches of up to this many requests (Google Drive takes at most 100)
+BATCH_INTERVAL = config("DRIVE_BATCH_INTERVAL", default=0.05, cast=float)
+BATCH_MAX_SIZE = min(config("DRIVE_BATCH_SIZE", default=100, cast=int), 100)
+
+# Keys of the 'appProperties' set on uploaded files, used to rebuild the index of uploaded files
+APP_PROPERTY_MARKER = 'bangerBot'
+APP_PROPERTY_HASH = 'bangerHash'
+APP_PROPERTY_YOUTUBE_ID = 'bangerYoutubeId'
+APP_PROPERTY_FOLDER = 'bangerFolder'
+APP_PROPERTY_TELEGRAM_ID = 'bangerTelegramId'
+
+# Files up to this size (in bytes) are uploaded in a single request, bigger ones on a resumable upload session
+SIMPLE_UPLOAD_MAX_SIZE = config("DRIVE_SIMPLE_UPLOAD_MAX_SIZE", default=5 * 1024 * 1024, cast=int)
+
+# Size of the uploaded chunks until the upload throughput is measured, which is also how much of a streamed file is
+# kept in memory. Chunk sizes have to be multiples of 256 KB.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+
+# Chunks are sized to take about this many seconds to upload, at the measured throughput, within these bounds
+CHUNK_TARGET_SECONDS = config("DRIVE_UPLOAD_CHUNK_SECONDS", default=4, cast=float)
+MIN_CHUNK_SIZE = CHUNK_SIZE_MULTIPLE
+MAX_CHUNK_SIZE = config("DRIVE_UPLOAD_MAX_CHUNK_SIZE", default=32 * 1024 * 1024, cast=int)
+
+# Seconds a resumable upload session is kept to resume an interrupted upload (Google Drive keeps them for a week)
+UPLOAD_SESSION_TTL = 6 * 24 * 3600
+
+# Times a failing chunk of a streamed upload is sent again (from memory) before giving up
+UPLOAD_CHUNK_RETRIES = config("DRIVE_UPLOAD_CHUNK_RETRIES", default=3, cast=int)
+
+# Bytes read at a time from a streamed download, and seconds to wait for it
+STREAM_READ_SIZE = 64 * 1024
+STREAM_TIMEOUT = 60
+
+_drive_index = None
+_drive_index_lock = threading.Lock()
+
+_upload_sessions = None
+_upload_sessions_lock = threading.Lock()
+
 
 def get_creds(token_path=AUTH_DIR + 'token.json', client_secrets_path=AUTH_DIR + 'client_secrets.json'):
     """
@@ -55,6 +129,265 @@ def get_creds(token_path=AUTH_DIR + 'token.json', client_secrets_path=AUTH_DIR +
     return creds
 
 
+class DriveClient:
+    """
+    Long-lived Google Drive client.
+    Credentials are loaded once and kept in memory, being refreshed only when they are about to expire
+    (the 'token.json' file is only rewritten after a refresh). Each thread gets its own Drive service, which is built
+    once and then reused - it holds the parsed discovery document and its own HTTP transport (httplib2 is not thread-safe).
+    """
+
+    def __init__(self, token_path=AUTH_DIR + 'token.json', client_secrets_path=AUTH_DIR + 'client_secrets.json'):
+        self.token_path = token_path
+        self.client_secrets_path = client_secrets_path
+        self._creds = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def credentials(self):
+        """
+        Gets the in-memory credentials, loading them on first use and refreshing them if they're close to expiry.
+        @return: Google credentials object.
+        """
+        with self._lock:
+            if self._creds is None:
+                self._creds = get_creds(self.token_path, self.client_secrets_path)
+            elif self._needs_refresh():
+                self._creds.refresh(Request())
+
+                # Save the refreshed credentials for the next run
+                with open(self.token_path, 'w') as token:
+                    token.write(self._creds.to_json())
+
+            return self._creds
+
+    def service(self):
+        """
+        Gets the Drive service of the calling thread, building it on first use.
+        @return: Google Drive service object.
+        """
+        creds = self.credentials()
+
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+            self._local.service = service
+
+        return service
+
+    def reset(self):
+        """
+        Drops the cached credentials and services so they're loaded again on next use.
+        @return:
+        """
+        with self._lock:
+            self._creds = None
+            self._local = threading.local()
+
+    def _needs_refresh(self) -> bool:
+        if not self._creds.valid:
+            return True
+
+        # Credentials without expiry (or mocked ones) are never refreshed ahead of time
+        expiry = self._creds.expiry
+        if not isinstance(expiry, datetime):
+            return False
+
+        # google-auth stores expiry as a naive UTC datetime
+        return expiry - datetime.utcnow() < REFRESH_MARGIN
+
+
+drive_client = DriveClient()
+
+
+def get_drive_service():
+    """
+    Gets the shared Drive service of the calling thread.
+    @return: Google Drive service object.
+    """
+    return drive_client.service()
+
+
+class DriveBatcher:
+    """
+    Groups the small Google Drive metadata requests (folder lookups and creation, file checks...) made at about the
+    same time into batch requests, so they take one HTTP round-trip instead of one each.
+    The first request of a batch waits up to 'interval' seconds for others to join it, and a batch is sent right away
+    once it has 'max_size' requests. Batches are sent from the thread of one of their callers, with its own service.
+    """
+
+    def __init__(self, interval: float = BATCH_INTERVAL, max_size: int = BATCH_MAX_SIZE):
+        self.interval = interval
+        self.max_size = max_size
+
+        # (request builder, future) tuples of the batch being filled
+        self._batch = None
+        self._condition = threading.Condition()
+
+    def submit(self, build_request) -> Future:
+        """
+        Adds a request to the current batch. The caller that starts a batch (or fills it) also sends it.
+        @param build_request: function building the request from a Drive service,
+        e.g. lambda service: service.files().get(fileId=file_id).
+        @return: future of the response.
+        """
+        future = Future()
+
+        with self._condition:
+            started = self._batch is None
+            if started:
+                self._batch = []
+
+            batch = self._batch
+            batch.append((build_request, future))
+
+            if len(batch) < self.max_size:
+                if not started:
+                    return future
+
+                self._condition.wait_for(lambda: self._batch is not batch, timeout=self.interval)
+                if self._batch is not batch:
+                    # Filled and sent by another request
+                    return future
+
+            self._batch = None
+            self._condition.notify_all()
+
+        self._send(batch)
+        return future
+
+    def execute(self, build_request):
+        """
+        Sends a request on the current batch, waiting for its response.
+        @param build_request: function building the request from a Drive service.
+        @return: response of the request.
+        """
+        return self.submit(build_request).result()
+
+    @staticmethod
+    def _send(batch: list):
+        try:
+            DriveBatcher._send_batch(batch)
+        except Exception as e:
+            # Every caller waiting on the batch gets the error (e.g. the credentials can't be refreshed)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    @staticmethod
+    def _send_batch(batch: list):
+        service = get_drive_service()
+
+        # A request on its own isn't worth the batch encoding
+        if len(batch) == 1:
+            build_request, future = batch[0]
+            future.set_result(build_request(service).execute())
+            return
+
+        http_batch = service.new_batch_http_request()
+        for build_request, future in batch:
+            try:
+                http_batch.add(build_request(service), callback=functools.partial(_batch_callback, future))
+            except Exception as e:
+                future.set_exception(e)
+
+        http_batch.execute()
+
+
+def _batch_callback(future: Future, request_id: str, response, exception):
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(response)
+
+
+drive_batcher = DriveBatcher()
+
+
+class FolderCache:
+    """
+    Cache of Google Drive folder IDs, keyed by folder name and parent folder ID. Entries expire after 'ttl' seconds.
+    It also hands out one lock per folder so concurrent uploads don't create the same folder twice. A folder's lock is
+    only kept while it's wanted, so the locks don't pile up with every folder ever looked up.
+    """
+
+    def __init__(self, ttl: float = FOLDER_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, folder_name: str, parent_id=None):
+        """
+        Gets the cached ID of a folder.
+        @param folder_name: name of the folder.
+        @param parent_id: ID of the parent folder (None for any folder).
+        @return: ID of the folder. Returns None if it's not cached or the entry has expired.
+        """
+        with self._lock:
+            entry = self._entries.get((parent_id, folder_name))
+            if entry is None:
+                return None
+
+            folder_id, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[(parent_id, folder_name)]
+                return None
+
+            return folder_id
+
+    def set(self, folder_name: str, folder_id: str, parent_id=None):
+        """
+        Caches the ID of a folder.
+        @param folder_name: name of the folder.
+        @param folder_id: ID of the folder.
+        @param parent_id: ID of the parent folder (None for any folder).
+        @return:
+        """
+        with self._lock:
+            self._entries[(parent_id, folder_name)] = (folder_id, time.monotonic() + self.ttl)
+
+    def invalidate(self, folder_name: str = None, parent_id=None):
+        """
+        Removes a folder from the cache. If no folder name is given, the whole cache is cleared.
+        @param folder_name: name of the folder.
+        @param parent_id: ID of the parent folder (None for any folder).
+        @return:
+        """
+        with self._lock:
+            if folder_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((parent_id, folder_name), None)
+
+    @contextlib.contextmanager
+    def lock(self, folder_name: str, parent_id=None):
+        """
+        Holds the lock of a folder, while looking it up and creating it.
+        @param folder_name: name of the folder.
+        @param parent_id: ID of the parent folder (None for any folder).
+        @return: context manager holding the lock of the folder.
+        """
+        key = (parent_id, folder_name)
+
+        # Each lock counts the threads holding or waiting for it, and is dropped once there are none
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+folder_cache = FolderCache()
+
+
 def create_drive_folder(folder_name: str, parent_id=None):
     """
     Creates a new folder on Google Drive with the given name
@@ -64,42 +397,50 @@ def create_drive_folder(folder_name: str, parent_id=None):
     """
 
     try:
-        service = build('drive', 'v3', credentials=get_creds(), cache_discovery=False)
-
         file_metadata = {
             'name': folder_name,
-            'mimeType': "application/vnd.google-apps.folder"
+            'mimeType': FOLDER_MIME_TYPE
         }
         if parent_id:
-            file_metadata['parents'] = [{'id': parent_id}]
+            file_metadata['parents'] = [parent_id]
 
-        root_folder = service.files().create(body=file_metadata).execute()
+        root_folder = drive_batcher.execute(lambda service: service.files().create(body=file_metadata))
 
     except Exception as e:
         raise GoogleDriveCreateFolderFail
 
+    folder_cache.set(folder_name, root_folder['id'], parent_id)
+
     return root_folder['id']
 
 
-def get_drive_folder(folder_name: str):
+def get_drive_folder(folder_name: str, parent_id=None):
     """
-    Fetches the ID of the Google Drive folder of the given name.
+    Fetches the ID of the Google Drive folder of the given name. Folder IDs are cached, so only the first lookup
+    of a folder reaches Google Drive.
     @param folder_name: name of the folder we're looking for
+    @param parent_id: ID of the parent folder, if we're looking for a folder inside a folder.
     @return: ID of the folder. Returns None if no folder was found.
     """
 
     if folder_name is None:
         return None
 
-    service = build('drive', 'v3', credentials=get_creds(), cache_discovery=False)
+    folder_id = folder_cache.get(folder_name, parent_id)
+    if folder_id is not None:
+        return folder_id
+
+    # Filtering by name on the server so we don't have to list every folder
+    query = "mimeType='{}' and name='{}' and trashed=false".format(FOLDER_MIME_TYPE, _escape_query(folder_name))
+    if parent_id:
+        query += " and '{}' in parents".format(_escape_query(parent_id))
 
-    folder_id = None
     page_token = None
     while True and folder_id is None:
-        response = service.files().list(q="mimeType='application/vnd.google-apps.folder'",
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name)',
-                                        pageToken=page_token).execute()
+        response = drive_batcher.execute(lambda service: service.files().list(q=query,
+                                                                              spaces='drive',
+                                                                              fields='nextPageToken, files(id, name)',
+                                                                              pageToken=page_token))
 
         for file in response.get('files', []):
 
@@ -111,21 +452,413 @@ def get_drive_folder(folder_name: str):
         if page_token is None:
             break
 
+    if folder_id is not None:
+        folder_cache.set(folder_name, folder_id, parent_id)
+
     return folder_id
 
 
+def get_or_create_drive_folder(folder_name: str, parent_id=None):
+    """
+    Fetches the ID of the Google Drive folder of the given name, creating it if it doesn't exist.
+    The folder's lock is held throughout so two uploads to a new folder don't both create it.
+    @param folder_name: name of the folder.
+    @param parent_id: ID of the parent folder, if the folder is inside a folder.
+    @return: ID of the folder.
+    """
+    with folder_cache.lock(folder_name, parent_id):
+        folder_id = get_drive_folder(folder_name, parent_id)
+
+        if folder_id is None:
+            folder_id = create_drive_folder(folder_name, parent_id)
+
+    return folder_id
+
+
+def _escape_query(value: str) -> str:
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class DriveIndex:
+    """
+    Local index of the files uploaded by the bot, used to avoid uploading the same song twice to a folder.
+    Files are indexed by content hash and, for Youtube tracks, by video ID. The same keys are stored on the uploaded
+    files' 'appProperties', so the index can be rebuilt from Google Drive in one listing.
+    """
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    key TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    link TEXT,
+                    PRIMARY KEY (key, folder)
+                )""")
+
+    def get(self, keys: list, folder: str):
+        """
+        Looks up a file by any of its keys.
+        @param keys: keys of the file, in lookup order.
+        @param folder: ID of the folder the file is in ('' for the root folder).
+        @return: DriveFile object. Returns None if the file isn't indexed.
+        """
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute("SELECT file_id, link FROM uploads WHERE key = ? AND folder = ?",
+                                               (key, folder)).fetchone()
+                if row is not None:
+                    return DriveFile(file_id=row[0], link=row[1], existing=True)
+
+        return None
+
+    def add(self, keys: list, folder: str, file_id: str, link: str):
+        """
+        Indexes a file under all of its keys.
+        @param keys: keys of the file.
+        @param folder: ID of the folder the file is in ('' for the root folder).
+        @param file_id: ID of the file.
+        @param link: link to the file.
+        @return:
+        """
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                                         [(key, folder, file_id, link) for key in keys])
+
+    def remove(self, file_id: str):
+        """
+        Removes a file from the index.
+        @param file_id: ID of the file.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM uploads").fetchone()[0] == 0
+
+    def rebuild(self, files: list):
+        """
+        Replaces the whole index.
+        @param files: list of (keys, folder, file ID, link) tuples.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.execute("DELETE FROM uploads")
+            self._connection.executemany("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                                         [(key, folder, file_id, link)
+                                          for keys, folder, file_id, link in files for key in keys])
+            self._connection.execute("COMMIT")
+
+
+class UploadSessions:
+    """
+    Resumable upload sessions of the uploads in progress, so an interrupted upload (e.g. the bot was restarted or the
+    task failed) continues from the last byte Google Drive got, instead of starting over.
+    """
+
+    def __init__(self, path: str, ttl: int = UPLOAD_SESSION_TTL):
+        self.ttl = ttl
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    key TEXT PRIMARY KEY,
+                    uri TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )""")
+
+    def get(self, key: str):
+        """
+        @param key: key of the upload.
+        @return: URI of the upload session. Returns None if there's none or it expired.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),))
+            row = self._connection.execute("SELECT uri FROM sessions WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def add(self, key: str, uri: str):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                                     (key, uri, time.time() + self.ttl))
+
+    def remove(self, key: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+
+class ThroughputMeter:
+    """
+    Measures the throughput of the uploaded chunks, to size the next chunks so each one takes about
+    'target_seconds' to upload - fewer requests on fast links, and no long requests to retry on slow ones.
+    Chunks can be recorded from any thread.
+    """
+
+    def __init__(self, target_seconds: float = CHUNK_TARGET_SECONDS, min_size: int = MIN_CHUNK_SIZE,
+                 max_size: int = MAX_CHUNK_SIZE, initial_size: int = UPLOAD_CHUNK_SIZE, smoothing: float = 0.3):
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.initial_size = initial_size
+        self.smoothing = smoothing
+
+        # Bytes per second, as a moving average
+        self._throughput = None
+        self._lock = threading.Lock()
+
+    def record(self, size: int, seconds: float):
+        """
+        Records an uploaded chunk.
+        @param size: bytes of the chunk.
+        @param seconds: seconds its upload took.
+        @return:
+        """
+        if size <= 0 or seconds <= 0:
+            return
+
+        with self._lock:
+            throughput = size / seconds
+            if self._throughput is None:
+                self._throughput = throughput
+            else:
+                self._throughput += self.smoothing * (throughput - self._throughput)
+
+    def chunk_size(self) -> int:
+        """
+        @return: size of the next chunks, in bytes (a multiple of 256 KB).
+        """
+        with self._lock:
+            if self._throughput is None:
+                return self.initial_size
+            size = int(self._throughput * self.target_seconds)
+
+        size = size // CHUNK_SIZE_MULTIPLE * CHUNK_SIZE_MULTIPLE
+        return max(self.min_size, min(self.max_size, size))
+
+
+upload_meter = ThroughputMeter()
+
+
+def get_upload_sessions() -> UploadSessions:
+    """
+    Gets the store of resumable upload sessions, creating it on first use.
+    @return: UploadSessions object.
+    """
+    global _upload_sessions
+
+    with _upload_sessions_lock:
+        if _upload_sessions is None:
+            _upload_sessions = UploadSessions(DATA_DIR + 'upload_sessions.sqlite3')
+
+    return _upload_sessions
+
+
+def get_drive_index() -> DriveIndex:
+    """
+    Gets the index of uploaded files, creating it on first use.
+    @return: DriveIndex object.
+    """
+    global _drive_index
+
+    with _drive_index_lock:
+        if _drive_index is None:
+            _drive_index = DriveIndex(DATA_DIR + 'drive.sqlite3')
+
+    return _drive_index
+
+
+def rebuild_drive_index():
+    """
+    Rebuilds the index of uploaded files from the 'appProperties' of the files on Google Drive.
+    @return: number of indexed files.
+    """
+    service = get_drive_service()
+
+    files = []
+    page_token = None
+    while True:
+        response = service.files().list(q="appProperties has {{ key='{}' and value='1' }} and trashed=false"
+                                        .format(APP_PROPERTY_MARKER),
+                                        spaces='drive',
+                                        pageSize=1000,
+                                        fields='nextPageToken, files(id, webViewLink, appProperties)',
+                                        pageToken=page_token).execute()
+
+        for file in response.get('files', []):
+            properties = file.get('appProperties', {})
+            files.append((_index_keys(properties.get(APP_PROPERTY_HASH), properties.get(APP_PROPERTY_YOUTUBE_ID),
+                                      properties.get(APP_PROPERTY_TELEGRAM_ID)),
+                          properties.get(APP_PROPERTY_FOLDER, ''), file['id'], file.get('webViewLink')))
+
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    get_drive_index().rebuild(files)
+
+    return len(files)
+
+
+def _index_keys(content_hash: str = None, video_id: str = None, telegram_id: str = None) -> list:
+    # Video IDs go first, as the same video uploaded with different tags has a different content hash
+    keys = []
+    if video_id:
+        keys.append('youtube:' + video_id)
+    if telegram_id:
+        keys.append('telegram:' + telegram_id)
+    if content_hash:
+        keys.append('sha256:' + content_hash)
+    return keys
+
+
+def _app_properties(folder_id: str, content_hash: str = None, video_id: str = None, telegram_id: str = None) -> dict:
+    properties = {
+        APP_PROPERTY_MARKER: '1',
+        APP_PROPERTY_FOLDER: folder_id,
+    }
+    if content_hash:
+        properties[APP_PROPERTY_HASH] = content_hash
+    if video_id:
+        properties[APP_PROPERTY_YOUTUBE_ID] = video_id
+    if telegram_id:
+        properties[APP_PROPERTY_TELEGRAM_ID] = telegram_id
+    return properties
+
+
+def _file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StreamMediaUpload(MediaUpload):
+    """
+    Resumable media upload reading from a stream of bytes (e.g. an HTTP download), so the file isn't saved locally.
+    Only the chunk being uploaded is kept in memory, so it can be sent again if its request is retried. Reading from
+    before that chunk (the upload has to go back further than that) raises StreamRewindError.
+    Streams of unknown size (e.g. the output of a transcoder) are read one chunk ahead, so the size is known before
+    their last chunk is sent - a last chunk can't be empty. Streams without a specific mimetype are sniffed from their
+    first bytes, which are buffered for the upload anyway.
+    """
+
+    def __init__(self, chunks, size: int, mimetype: str, chunksize: int = UPLOAD_CHUNK_SIZE):
+        """
+        @param chunks: iterator of the stream's bytes.
+        @param size: size of the stream, in bytes. None if it isn't known.
+        @param mimetype: mimetype of the stream. None if it isn't known.
+        @param chunksize: size of the uploaded chunks, in bytes.
+        """
+        super().__init__()
+        self._chunks = chunks
+        self._size = size
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._position = 0
+        self._digest = hashlib.sha256()
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        if self._mimetype is None or self._mimetype.lower() in GENERIC_MIME_TYPES:
+            # Only the start of the stream can be sniffed
+            if self._buffer_start == 0:
+                self._fill(SNIFF_SIZE)
+                self._mimetype = sniff_mime_type(bytes(self._buffer[:SNIFF_SIZE]))
+            else:
+                self._mimetype = DEFAULT_MIME_TYPE
+
+        return self._mimetype
+
+    def size(self):
+        # Called before each chunk is sent, so the stream is read up to the end of the next chunk (and one more byte)
+        if self._size is None and self._fill(self._position + self._chunksize + 1):
+            self._size = self._buffer_start + len(self._buffer)
+
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise StreamRewindError("Can't read from byte {}, the stream is at byte {}.".format(begin,
+                                                                                              self._buffer_start))
+
+        self._drop_until(begin)
+        self._fill(begin + length, drop_until=begin)
+
+        data = bytes(self._buffer[:length])
+        self._position = begin + len(data)
+        return data
+
+    def hexdigest(self) -> str:
+        """
+        @return: SHA-256 hash of the bytes read from the stream so far.
+        """
+        return self._digest.hexdigest()
+
+    def _fill(self, end: int, drop_until: int = None) -> bool:
+        """
+        Reads the stream until the buffer reaches 'end'.
+        @param end: position the buffer is filled up to.
+        @param drop_until: position the bytes before are dropped as they're read, e.g. when skipping ahead.
+        @return: True if the stream ended before that.
+        """
+        while self._buffer_start + len(self._buffer) < end:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return True
+
+            self._digest.update(chunk)
+            self._buffer += chunk
+            if drop_until is not None:
+                self._drop_until(drop_until)
+
+        return False
+
+    def _drop_until(self, position: int):
+        # Bytes before 'position' were uploaded and won't be read again
+        dropped = min(position - self._buffer_start, len(self._buffer))
+        if dropped > 0:
+            del self._buffer[:dropped]
+            self._buffer_start += dropped
+
+
 async def upload_to_drive(file_path: str, file_title: str, file_mime_type: str, message: Message,
-                    destination_folder: str = None):
+                    destination_folder: str = None, video_id: str = None) -> DriveFile:
     """
     Uploads file from 'file_path' to google drive on a given destination folder. If no destination folder is given, it uploads to root Google Drive folder.
     If the folder is given and not created on Google Drive, it's created before upload.
+    If the same file (or Youtube video) was already uploaded to the folder, the existing file is returned instead.
+    The upload itself runs on the upload worker pool so it doesn't block the event loop.
     Telegram message is passed to update the progress whilst uploading.
     @param file_path: path to the file to be uploaded.
     @param file_title: title of the file.
     @param file_mime_type: mimetype of the file.
     @param message: Telegram message object.
     @param destination_folder: Drive destination folder.
-    @return:
+    @param video_id: ID of the Youtube video the file comes from, if any.
+    @return: DriveFile object of the uploaded (or existing) file.
     """
 
     # Verifying params
@@ -135,53 +868,435 @@ async def upload_to_drive(file_path: str, file_title: str, file_mime_type: str,
     if len(file_title) == 0 or len(file_mime_type) == 0:
         raise GoogleDriveInvalidFileMeta
 
+    drive_file = await _run_upload(message, destination_folder, _upload_file, file_path, file_title, file_mime_type,
+                                   destination_folder, video_id)
+
+    # Delete uploaded file locally
+    os.remove(file_path)
+
+    return drive_file
+
+
+async def stream_to_drive(url: str, size: int, file_title: str, file_mime_type: str, message: Message,
+                          destination_folder: str = None, telegram_id: str = None) -> DriveFile:
+    """
+    Streams a file from an URL (e.g. a Telegram file) to Google Drive, without saving it locally.
+    The download is sent to a resumable upload through an in-memory buffer the size of an upload chunk. The file is
+    only downloaded to the scratch space and uploaded from there if the stream has to be read again (or its size is
+    unknown), so that's the only case space is reserved for it.
+    @param url: URL of the file to be uploaded.
+    @param size: size of the file, in bytes. None if it isn't known.
+    @param file_title: title of the file.
+    @param file_mime_type: mimetype of the file. None if it isn't known.
+    @param message: Telegram message object.
+    @param destination_folder: Drive destination folder.
+    @param telegram_id: unique ID of the Telegram file, if any.
+    @return: DriveFile object of the uploaded (or existing) file.
+    """
+
+    # Files without a (specific) mimetype are sniffed as they're streamed
+    if len(file_title) == 0:
+        raise GoogleDriveInvalidFileMeta
+
+    # The last chunk of a stream of unknown size can't always be told apart from an empty one
+    if size is not None:
+        try:
+            return await _run_upload(message, destination_folder, _stream_file, url, size, file_title, file_mime_type,
+                                     destination_folder, telegram_id)
+        except StreamRewindError:
+            pass
+
+    async with get_scratch_space().job(size) as job:
+        return await _run_upload(message, destination_folder, _download_and_upload_file, url, file_title,
+                                 file_mime_type, job.path(file_title), destination_folder, telegram_id)
+
+
+async def pipe_to_drive(open_stream, expected_size: int, file_title: str, file_mime_type: str, message: Message,
+                        destination_folder: str = None, video_id: str = None) -> DriveFile:
+    """
+    Uploads a file to Google Drive as it's being produced (e.g. by a transcoder), chunk by chunk, without saving it
+    locally. Its size isn't known until it ends, so the progress is estimated from 'expected_size'. The content hash of
+    the file is only known at the end, so it's added to the file's 'appProperties' once it's uploaded.
+    If the same Youtube video was already uploaded to the folder, the existing file is returned and nothing is produced.
+    @param open_stream: function returning a context manager that gives an iterator of the file's bytes.
+    @param expected_size: estimated size of the file, in bytes.
+    @param file_title: title of the file.
+    @param file_mime_type: mimetype of the file.
+    @param message: Telegram message object.
+    @param destination_folder: Drive destination folder.
+    @param video_id: ID of the Youtube video the file comes from, if any.
+    @return: DriveFile object of the uploaded (or existing) file.
+    """
+
+    if len(file_title) == 0 or len(file_mime_type) == 0:
+        raise GoogleDriveInvalidFileMeta
+
+    return await _run_upload(message, destination_folder, _pipe_file, open_stream, expected_size, file_title,
+                             file_mime_type, destination_folder, video_id)
+
+
+async def _run_upload(message: Message, destination_folder: str, upload, *args) -> DriveFile:
+    """
+    Runs a blocking upload function on the upload worker pool, showing its progress on a Telegram message.
+    @param message: Telegram message object.
+    @param destination_folder: Drive destination folder.
+    @param upload: function called with 'args' and a progress callback, returning a DriveFile object.
+    @param args: arguments of the upload function.
+    @return: DriveFile object of the uploaded (or existing) file.
+    """
+    loop = asyncio.get_running_loop()
+    reporter = ProgressReporter(message)
+
+    def on_progress(progress: int):
+        reporter.post(
+            "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
+            "Uploading to Google Drive: " + str(progress) + "%")
+
     try:
-        service = build('drive', 'v3', credentials=get_creds(), cache_discovery=False)
+        drive_file = await loop.run_in_executor(upload_executor, upload, *args, on_progress)
 
-        # If a destination folder is passed, we check if it exists. If not, we just push to the root directory
-        if destination_folder:
-            # Check if folder exists. If it does, use the ID to create folder. If not, we create a new folder
-            folder_id = get_drive_folder(destination_folder)
+        # Notify user upload is complete
+        if drive_file.existing:
+            await reporter.finish(
+                "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
+                "This song is already on Google Drive!")
+        else:
+            await reporter.finish(
+                "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
+                "Uploading to Google Drive complete!")
 
-            if folder_id is None:
-                folder_id = create_drive_folder(destination_folder)
+    except StreamRewindError:
+        # The caller uploads the file some other way
+        reporter.close()
+        raise
 
+    except Exception as e:
+        reporter.close()
+
+        # The cached folder might have been deleted in the meantime, so it's looked up again next time
         if destination_folder:
-            metadata = {
-                'name': file_title,
-                'parents': [folder_id]
-            }
-        else:
-            metadata = {
-                'name': file_title
-            }
-
-        # Upload file
-        media = MediaFileUpload(file_path, chunksize=1024 * 1024, mimetype=file_mime_type, resumable=True)
-        request = service.files().create(body=metadata,
-                                         media_body=media)
-
-        response = None
-        while response is None:
-            status, response = request.next_chunk()
-            if status:
-                progress = int(status.progress() * 100)
-                await message.edit_text(
-                    "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
-                    "Uploading to Google Drive: " + str(progress) + "%",
-                    parse_mode=ParseMode.MARKDOWN)
+            folder_cache.invalidate(destination_folder)
 
+        raise GoogleDriveUploadFail("Problem uploading file to Google Drive.")
+
+    return drive_file
+
+
+def _upload_file(file_path: str, file_title: str, file_mime_type: str, destination_folder: str, video_id: str,
+                 on_progress, telegram_id: str = None) -> DriveFile:
+    """
+    Blocking part of the upload, meant to be run on the upload worker pool.
+    @param file_path: path to the file to be uploaded.
+    @param file_title: title of the file.
+    @param file_mime_type: mimetype of the file.
+    @param destination_folder: Drive destination folder.
+    @param video_id: ID of the Youtube video the file comes from, if any.
+    @param on_progress: function called with the upload percentage after each chunk.
+    @param telegram_id: unique ID of the Telegram file the file comes from, if any.
+    @return: DriveFile object of the uploaded (or existing) file.
+    """
+    service = get_drive_service()
+    folder_id, metadata = _file_metadata(file_title, destination_folder)
+
+    # Skipping the upload if the file is already on the folder
+    content_hash = _file_hash(file_path)
+    keys = _index_keys(content_hash, video_id, telegram_id)
+
+    existing_file = _get_existing_file(keys, folder_id)
+    if existing_file is not None:
+        return existing_file
+
+    metadata['appProperties'] = _app_properties(folder_id, content_hash, video_id, telegram_id)
+
+    # Upload file, in one request if it's small
+    if os.path.getsize(file_path) <= SIMPLE_UPLOAD_MAX_SIZE:
+        media = MediaFileUpload(file_path, mimetype=file_mime_type, resumable=False)
+    else:
+        media = MediaFileUpload(file_path, chunksize=upload_meter.chunk_size(), mimetype=file_mime_type,
+                                resumable=True)
+
+    try:
+        response = _send_media(service, metadata, media, on_progress,
+                               session_key=_session_key(keys[-1], folder_id, file_title))
+
+    finally:
         # Release media stream to so the process can delete it afterwards
         media.stream().close()
 
-        # Notify user upload is complete
-        await message.edit_text(
-            "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
-            "Uploading to Google Drive complete!",
-            parse_mode=ParseMode.MARKDOWN)
+    get_drive_index().add(keys, folder_id, response['id'], response.get('webViewLink'))
+
+    return DriveFile(file_id=response['id'], link=response.get('webViewLink'), existing=False)
 
-        # Delete uploaded file locally
+
+def _stream_file(url: str, size: int, file_title: str, file_mime_type: str, destination_folder: str,
+                 telegram_id: str, on_progress) -> DriveFile:
+    """
+    Blocking part of the streamed upload, meant to be run on the upload worker pool.
+    Raises StreamRewindError if the stream has to be read again, so the file is downloaded and uploaded instead.
+    @param url: URL of the file to be uploaded.
+    @param size: size of the file, in bytes.
+    @param file_title: title of the file.
+    @param file_mime_type: mimetype of the file.
+    @param destination_folder: Drive destination folder.
+    @param telegram_id: unique ID of the Telegram file, if any.
+    @param on_progress: function called with the upload percentage after each chunk.
+    @return: DriveFile object of the uploaded (or existing) file.
+    """
+    service = get_drive_service()
+    folder_id, metadata = _file_metadata(file_title, destination_folder)
+
+    # Skipping the upload if the file is already on the folder
+    existing_file = _get_existing_file(_index_keys(telegram_id=telegram_id), folder_id)
+    if existing_file is not None:
+        return existing_file
+
+    metadata['appProperties'] = _app_properties(folder_id, telegram_id=telegram_id)
+
+    session_key = _session_key('telegram:' + telegram_id, folder_id, file_title) if telegram_id else None
+
+    try:
+        with httpx.stream('GET', url, timeout=STREAM_TIMEOUT) as stream:
+            stream.raise_for_status()
+
+            # Small files are read whole and uploaded in one request
+            if size <= SIMPLE_UPLOAD_MAX_SIZE:
+                content = b"".join(stream.iter_bytes(STREAM_READ_SIZE))
+                content_hash = hashlib.sha256(content).hexdigest()
+                media = MediaIoBaseUpload(io.BytesIO(content), mimetype=resolve_mime_type(file_mime_type, head=content),
+                                          resumable=False)
+                response = _send_media(service, metadata, media, on_progress, num_retries=UPLOAD_CHUNK_RETRIES)
+
+            else:
+                media = StreamMediaUpload(stream.iter_bytes(STREAM_READ_SIZE), size, file_mime_type,
+                                          chunksize=upload_meter.chunk_size())
+                response = _send_media(service, metadata, media, on_progress, num_retries=UPLOAD_CHUNK_RETRIES,
+                                       session_key=session_key)
+                content_hash = media.hexdigest()
+
+    except StreamRewindError:
+        # The file is uploaded from disk under its own session, so the stream's one would never be resumed
+        if session_key:
+            get_upload_sessions().remove(session_key)
+        raise
+
+    get_drive_index().add(_index_keys(content_hash, telegram_id=telegram_id), folder_id, response['id'],
+                          response.get('webViewLink'))
+
+    return DriveFile(file_id=response['id'], link=response.get('webViewLink'), existing=False)
+
+
+def _pipe_file(open_stream, expected_size: int, file_title: str, file_mime_type: str, destination_folder: str,
+               video_id: str, on_progress) -> DriveFile:
+    """
+    Blocking part of the piped upload, meant to be run on the upload worker pool.
+    @param open_stream: function returning a context manager that gives an iterator of the file's bytes.
+    @param expected_size: estimated size of the file, in bytes.
+    @param file_title: title of the file.
+    @param file_mime_type: mimetype of the file.
+    @param destination_folder: Drive destination folder.
+    @param video_id: ID of the Youtube video the file comes from, if any.
+    @param on_progress: function called with the estimated upload percentage.
+    @return: DriveFile object of the uploaded (or existing) file.
+    """
+    service = get_drive_service()
+    folder_id, metadata = _file_metadata(file_title, destination_folder)
+
+    # Skipping the upload (and producing the file) if the video is already on the folder
+    existing_file = _get_existing_file(_index_keys(video_id=video_id), folder_id)
+    if existing_file is not None:
+        return existing_file
+
+    metadata['appProperties'] = _app_properties(folder_id, video_id=video_id)
+
+    def read(chunks):
+        produced, reported = 0, None
+        for chunk in chunks:
+            produced += len(chunk)
+            progress = min(99, produced * 100 // expected_size) if expected_size else 0
+            if progress != reported:
+                on_progress(progress)
+                reported = progress
+            yield chunk
+
+    with open_stream() as chunks:
+        media = StreamMediaUpload(read(chunks), None, file_mime_type, chunksize=upload_meter.chunk_size())
+        response = _send_media(service, metadata, media, on_progress, num_retries=UPLOAD_CHUNK_RETRIES)
+
+    content_hash = media.hexdigest()
+    get_drive_index().add(_index_keys(content_hash, video_id), folder_id, response['id'], response.get('webViewLink'))
+
+    # The file is indexed locally either way, only a rebuilt index would miss the hash
+    try:
+        drive_batcher.execute(lambda service: service.files().update(
+            fileId=response['id'], body={'appProperties': {APP_PROPERTY_HASH: content_hash}}))
+    except Exception:
+        logger.exception("Couldn't add the content hash to the properties of the file %s.", response['id'])
+
+    return DriveFile(file_id=response['id'], link=response.get('webViewLink'), existing=False)
+
+
+def _download_and_upload_file(url: str, file_title: str, file_mime_type: str, file_path: str, destination_folder: str,
+                              telegram_id: str, on_progress) -> DriveFile:
+    # Fallback for files that can't be streamed - the file is saved locally and uploaded from there
+    head = b""
+    with httpx.stream('GET', url, timeout=STREAM_TIMEOUT) as stream:
+        stream.raise_for_status()
+
+        with open(file_path, 'wb') as file:
+            for chunk in stream.iter_bytes(STREAM_READ_SIZE):
+                file.write(chunk)
+
+                # The start of the file is kept in case it has to be sniffed
+                if len(head) < SNIFF_SIZE:
+                    head += chunk[:SNIFF_SIZE - len(head)]
+
+    try:
+        return _upload_file(file_path, file_title, resolve_mime_type(file_mime_type, head=head), destination_folder,
+                            None, on_progress, telegram_id=telegram_id)
+    finally:
         os.remove(file_path)
 
-    except Exception as e:
-        raise GoogleDriveUploadFail("Problem uploading file to Google Drive.")
+
+def _file_metadata(file_title: str, destination_folder: str):
+    """
+    Creates the metadata of a file to be uploaded.
+    @param file_title: title of the file.
+    @param destination_folder: Drive destination folder.
+    @return: (folder ID, metadata dict) tuple. The folder ID is '' for the root folder.
+    """
+    # If a destination folder is passed, we check if it exists. If not, we just push to the root directory
+    if destination_folder:
+        # Check if folder exists. If it does, use the ID to create folder. If not, we create a new folder
+        folder_id = get_or_create_drive_folder(destination_folder)
+
+        return folder_id, {
+            'name': file_title,
+            'parents': [folder_id]
+        }
+
+    return '', {
+        'name': file_title
+    }
+
+
+def _send_media(service, metadata: dict, media: MediaUpload, on_progress, num_retries: int = 0,
+                session_key: str = None) -> dict:
+    """
+    Uploads a file, chunk by chunk if its media is resumable.
+    The throughput of the chunks is measured to size the next uploads' chunks. The session of a resumable upload is
+    kept under 'session_key' until the upload is done, so the upload is resumed if it's started again.
+    @param service: Google Drive service object.
+    @param metadata: metadata of the file.
+    @param media: media of the file.
+    @param on_progress: function called with the upload percentage after each chunk.
+    @param num_retries: times a failing request is sent again.
+    @param session_key: key the upload session is kept under. The session isn't kept if None.
+    @return: response of the upload, with the ID and link of the file.
+    """
+    request = service.files().create(body=metadata,
+                                     media_body=media,
+                                     fields='id, webViewLink')
+
+    if not media.resumable():
+        response = request.execute(num_retries=num_retries)
+        on_progress(100)
+        return response
+
+    sessions = get_upload_sessions()
+    saved_uri = sessions.get(session_key) if session_key else None
+
+    response = None
+    if saved_uri is not None:
+        try:
+            response = _resume_upload(request, media, saved_uri)
+        except HttpError as e:
+            # The session expired or is unknown, so the upload starts over
+            if e.resp.status in (404, 410):
+                sessions.remove(session_key)
+                return _send_media(service, metadata, media, on_progress, num_retries, session_key)
+            raise
+
+        if response is not None:
+            on_progress(100)
+
+    while response is None:
+        progress = request.resumable_progress
+        start = time.monotonic()
+
+        try:
+            status, response = request.next_chunk(num_retries=num_retries)
+
+        finally:
+            # The session is kept as soon as it's started, in case the first chunk already fails
+            if session_key and request.resumable_uri is not None and request.resumable_uri != saved_uri:
+                sessions.add(session_key, request.resumable_uri)
+                saved_uri = request.resumable_uri
+
+        uploaded = media.size() if response is not None else request.resumable_progress
+        if uploaded is not None:
+            upload_meter.record(uploaded - progress, time.monotonic() - start)
+
+        # The progress of a stream of unknown size is reported by its reader
+        if status and status.total_size is not None:
+            on_progress(int(status.progress() * 100))
+
+    if session_key:
+        sessions.remove(session_key)
+
+    return response
+
+
+def _resume_upload(request: HttpRequest, media: MediaUpload, uri: str):
+    """
+    Points a resumable upload request to a stored upload session, asking Google Drive how much of the file it already
+    got - an empty PUT with 'Content-Range: bytes */<size>', as documented for resuming interrupted uploads. The next
+    'next_chunk' continues from the first byte it's missing.
+    @param request: resumable upload request, before any chunk is sent.
+    @param media: media of the upload.
+    @param uri: URI of the upload session.
+    @return: response of the upload, if Google Drive already got the whole file. Otherwise, None.
+    @raise HttpError: if the session can't be resumed (404 or 410 once it has expired).
+    """
+    size = media.size()
+    headers = {'Content-Range': 'bytes */{}'.format('*' if size is None else size), 'Content-Length': '0'}
+    resp, content = request.http.request(uri, 'PUT', headers=headers)
+
+    if resp.status in (200, 201):
+        return request.postproc(resp, content)
+    if resp.status != 308:
+        raise HttpError(resp, content, uri=uri)
+
+    # The 'Range' header holds the bytes Google Drive got, e.g. 'bytes=0-1048575'. There's none if it got nothing.
+    request.resumable_uri = uri
+    request.resumable_progress = int(resp['range'].split('-')[-1]) + 1 if 'range' in resp else 0
+    return None
+
+
+def _session_key(key: str, folder_id: str, file_title: str) -> str:
+    return key + '/' + folder_id + '/' + file_title
+
+
+def _get_existing_file(keys: list, folder_id: str):
+    """
+    Looks up an indexed file, making sure it's still on Google Drive.
+    @param keys: keys of the file.
+    @param folder_id: ID of the folder the file should be in ('' for the root folder).
+    @return: DriveFile object. Returns None if the file was never uploaded or has been deleted since.
+    """
+    drive_file = get_drive_index().get(keys, folder_id)
+    if drive_file is None:
+        return None
+
+    try:
+        response = drive_batcher.execute(lambda service: service.files().get(fileId=drive_file.file_id,
+                                                                              fields='id, webViewLink, trashed'))
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        response = {'trashed': True}
+
+    if response.get('trashed'):
+        get_drive_index().remove(drive_file.file_id)
+        return None
+
+    return DriveFile(file_id=drive_file.file_id, link=response.get('webViewLink', drive_file.link), existing=True)
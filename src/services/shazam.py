@@ -1,30 +1,549 @@
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+from collections import OrderedDict
 
+import aiohttp
+from decouple import config
+from pydub import AudioSegment
 from telegram.ext import CallbackContext
 from shazamio import Shazam
+from shazamio.exceptions import BadMethod
+from shazamio.utils import validate_json
 
-from src.exceptions import TrackNotFound, RemoveFileFailed
-from src.models import File, ShazamTrack
+from src.definitions.definitions import DATA_DIR
+from src.exceptions import TrackNotFound, RemoveFileFailed, AudioDecodeFail
+from src.models import File, ShazamTrack, TracklistEntry
+from src.pool import ProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of connections to Shazam open at the same time
+SHAZAM_MAX_CONNECTIONS = config("SHAZAM_MAX_CONNECTIONS", default=10, cast=int)
+
+# Number of recognitions kept in memory, on top of the ones on disk
+SHAZAM_CACHE_SIZE = config("SHAZAM_CACHE_SIZE", default=1024, cast=int)
+
+# Seconds a recognized track is cached for, and seconds a song Shazam didn't find is cached for (it may be found later)
+SHAZAM_CACHE_TTL = config("SHAZAM_CACHE_TTL", default=30 * 24 * 3600, cast=int)
+SHAZAM_NOT_FOUND_TTL = config("SHAZAM_NOT_FOUND_TTL", default=24 * 3600, cast=int)
+
+# Seconds of audio recognized, taken from the middle of the song. The whole file is recognized if 0.
+SHAZAM_EXCERPT_SECONDS = config("SHAZAM_EXCERPT_SECONDS", default=12, cast=int)
+
+# Seconds ffmpeg may take to fetch and decode the excerpt
+EXCERPT_TIMEOUT = 60
+
+# Excerpts are decoded to what Shazam fingerprints - 16 kHz mono 16-bit samples
+EXCERPT_SAMPLE_RATE = 16000
+
+# Tracklists recognize windows of 'TRACKLIST_WINDOW_SECONDS' every 'TRACKLIST_STEP_SECONDS' (so they overlap)
+TRACKLIST_WINDOW_SECONDS = config("TRACKLIST_WINDOW_SECONDS", default=12, cast=int)
+TRACKLIST_STEP_SECONDS = config("TRACKLIST_STEP_SECONDS", default=10, cast=int)
+
+# Windows of a tracklist sent to Shazam at the same time, and at most how many are sent per second
+TRACKLIST_CONCURRENCY = config("TRACKLIST_CONCURRENCY", default=4, cast=int)
+TRACKLIST_RATE = config("TRACKLIST_RATE", default=2, cast=float)
+
+# Mixes are decoded and fingerprinted on their own processes, as fingerprinting is CPU heavy
+tracklist_pool = ProcessPool(config("TRACKLIST_WORKERS", default=1, cast=int))
+
+# Bytes of decoded audio read from ffmpeg at a time
+DECODE_READ_SIZE = 64 * 1024
+
+# Bot tokens, part of the URLs of Telegram files (e.g. 'https://api.telegram.org/file/bot<token>/music/song.mp3')
+BOT_TOKEN_PATTERN = re.compile(r"bot\d+:[\w-]+")
+
+# Maximum length of the ffmpeg message kept on decode errors
+DECODE_ERROR_LENGTH = 200
+
+_shazam_client = None
+
+_recognition_cache = None
+_recognition_cache_lock = threading.Lock()
+
+
+class ShazamClient(Shazam):
+    """
+    Shazam client keeping one HTTP session open, so recognitions reuse its pooled connections instead of opening a new
+    session (and connection) per request.
+    """
+
+    def __init__(self, max_connections: int = SHAZAM_MAX_CONNECTIONS):
+        super().__init__()
+        self.max_connections = max_connections
+
+        self._session = None
+        self._loop = None
+
+    async def request(self, method: str, url: str, *args, **kwargs) -> dict:
+        session = self._get_session()
+
+        if method.upper() == "GET":
+            async with session.get(url, **kwargs) as resp:
+                return await validate_json(resp, *args)
+        elif method.upper() == "POST":
+            async with session.post(url, **kwargs) as resp:
+                return await validate_json(resp, *args)
+        else:
+            raise BadMethod("Accept only GET/POST")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # A session can only be used on the event loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+            self._loop = loop
+
+        return self._session
+
+
+class RateLimiter:
+    """
+    Spaces calls out so at most 'rate' of them start per second. Used from the event loop only.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        delay = self._next - now
+        self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RecognitionCache:
+    """
+    Cache of Shazam recognitions, keyed by Telegram file ID and by content hash, so a song that was already recognized
+    isn't fingerprinted and sent to Shazam again. Songs that weren't found are cached as well, for a shorter time.
+    Recognitions are stored on disk, with the most recently used ones also kept in memory.
+    """
+
+    def __init__(self, path: str, max_entries: int = SHAZAM_CACHE_SIZE, ttl: int = SHAZAM_CACHE_TTL,
+                 not_found_ttl: int = SHAZAM_NOT_FOUND_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+
+        # key -> (serialized track or None if it wasn't found, expiry time), least recently used first
+        self._entries = OrderedDict()
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS recognitions (
+                    key TEXT PRIMARY KEY,
+                    track TEXT,
+                    expires REAL NOT NULL
+                )""")
+
+    def get(self, keys: list):
+        """
+        Looks up a recognition by any of its keys.
+        @param keys: keys of the song, in lookup order.
+        @return: ShazamTrack object. Returns None if the song isn't cached.
+        @raise TrackNotFound: if the song is cached as not found.
+        """
+        now = time.time()
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._connection.execute("SELECT track, expires FROM recognitions WHERE key = ?",
+                                                     (key,)).fetchone()
+
+                if entry is None:
+                    continue
+
+                if entry[1] <= now:
+                    self._entries.pop(key, None)
+                    self._connection.execute("DELETE FROM recognitions WHERE key = ?", (key,))
+                    continue
+
+                self._remember(key, entry)
+
+                if entry[0] is None:
+                    raise TrackNotFound
+                return ShazamTrack({'track': json.loads(entry[0])})
+
+        return None
+
+    def add(self, keys: list, track):
+        """
+        Caches a recognition under all of its keys.
+        @param keys: keys of the song.
+        @param track: ShazamTrack object, or None if the song wasn't found.
+        @return:
+        """
+        if track is None:
+            entry = (None, time.time() + self.not_found_ttl)
+        else:
+            entry = (json.dumps(track.track), time.time() + self.ttl)
+
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO recognitions VALUES (?, ?, ?)",
+                                         [(key, *entry) for key in keys])
+            for key in keys:
+                self._remember(key, entry)
+
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def get_shazam_client() -> ShazamClient:
+    """
+    Gets the shared Shazam client, creating it on first use.
+    @return: ShazamClient object.
+    """
+    global _shazam_client
+
+    if _shazam_client is None:
+        _shazam_client = ShazamClient()
+
+    return _shazam_client
+
+
+async def close_shazam_client():
+    if _shazam_client is not None:
+        await _shazam_client.close()
+
+
+def get_recognition_cache() -> RecognitionCache:
+    """
+    Gets the cache of Shazam recognitions, creating it on first use.
+    @return: RecognitionCache object.
+    """
+    global _recognition_cache
+
+    with _recognition_cache_lock:
+        if _recognition_cache is None:
+            _recognition_cache = RecognitionCache(DATA_DIR + 'shazam.sqlite3')
+
+    return _recognition_cache
+
+
+async def cached_recognition(file: File):
+    """
+    Looks up a previous recognition of a Telegram file, so it doesn't have to be downloaded again.
+    @param file: File object.
+    @return: ShazamTrack object. Returns None if the file wasn't recognized before.
+    @raise TrackNotFound: if the song of the file wasn't found before.
+    """
+    if file.file_unique_id is None:
+        return None
+
+    return await _cache_get(_cache_keys(file))
+
+
+async def _cache_get(keys: list):
+    # The cache is on disk (and created on first use), so it's used off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: get_recognition_cache().get(keys))
+
+
+async def _cache_add(keys: list, track):
+    await asyncio.get_running_loop().run_in_executor(None, lambda: get_recognition_cache().add(keys, track))
+
+
+async def shazam_excerpt(file: File, url: str, seconds: int = SHAZAM_EXCERPT_SECONDS) -> ShazamTrack:
+    """
+    Recognizes a few seconds from the middle of a Telegram file. Only the part of the file with those seconds is
+    fetched - ffmpeg seeks to it with HTTP range requests and decodes it to a pipe - instead of downloading the whole
+    file.
+    @param file: File object.
+    @param url: URL (or path) of the file.
+    @param seconds: seconds of audio recognized.
+    @return: ShazamTrack object.
+    @raise AudioDecodeFail: if the excerpt couldn't be fetched or decoded.
+    """
+    offset = max(0, (file.duration or 0) - seconds) / 2
+    samples = await _decode_excerpt(url, offset, seconds)
+
+    audio = AudioSegment(data=samples, sample_width=2, frame_rate=EXCERPT_SAMPLE_RATE, channels=1)
+    unserialized_track = await get_shazam_client().recognize_song(audio)
+
+    keys = _cache_keys(file)
+    try:
+        serialized_track = ShazamTrack(unserialized_track)
+    except TrackNotFound:
+        await _cache_add(keys, None)
+        raise TrackNotFound
+
+    await _cache_add(keys, serialized_track)
+    return serialized_track
+
+
+async def recognize_tracklist(source: str, on_progress=None, window: int = TRACKLIST_WINDOW_SECONDS,
+                              step: int = TRACKLIST_STEP_SECONDS, concurrency: int = TRACKLIST_CONCURRENCY,
+                              rate: float = TRACKLIST_RATE) -> list:
+    """
+    Makes the tracklist of a mix by recognizing overlapping windows of it.
+    The mix is decoded by one ffmpeg process, and the windows are fingerprinted as they're decoded (on a process of
+    the tracklist pool). Their fingerprints are sent to Shazam as they come, 'concurrency' at a time.
+    @param source: URL or path of the mix.
+    @param on_progress: function called with the number of windows recognized so far.
+    @param window: seconds of each window.
+    @param step: seconds between the start of two windows.
+    @param concurrency: windows sent to Shazam at the same time.
+    @param rate: maximum windows sent to Shazam per second.
+    @return: list of TracklistEntry objects, in order.
+    @raise AudioDecodeFail: if the mix couldn't be decoded.
+    """
+    client = get_shazam_client()
+    limiter = RateLimiter(rate)
+    signatures = asyncio.Queue()
+
+    # window start (in seconds) -> ShazamTrack object, or None if it wasn't recognized
+    matches = {}
+
+    async def recognize():
+        while (item := await signatures.get()) is not None:
+            start, signature = item
+            matches[start] = await _recognize_signature(client, limiter, signature)
+
+            if on_progress is not None:
+                on_progress(len(matches))
+
+    workers = [asyncio.create_task(recognize()) for _ in range(concurrency)]
+    try:
+        await tracklist_pool.run(_fingerprint_windows, source, window, step, on_progress=signatures.put_nowait)
+
+        for _ in workers:
+            signatures.put_nowait(None)
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+    return merge_tracklist(matches, window)
+
+
+def merge_tracklist(matches: dict, window: int) -> list:
+    """
+    Merges the windows where the same song was recognized one after the other (skipping the windows where no song was)
+    into one entry.
+    @param matches: dict of window start (in seconds) -> ShazamTrack object, or None if no song was recognized.
+    @param window: seconds of each window.
+    @return: list of TracklistEntry objects, in order.
+    """
+    entries = []
+    for start in sorted(matches):
+        track = matches[start]
+        if track is None:
+            continue
+
+        if entries and (entries[-1].title, entries[-1].subtitle) == (track.title, track.subtitle):
+            entries[-1].end = start + window
+        else:
+            entries.append(TracklistEntry(start=start, end=start + window, title=track.title, subtitle=track.subtitle))
+
+    return entries
 
 
 # TODO We need to find a way to automatically install ffmpeg and add it to path variable before running, it's needed
 #  for Shazam
-async def shazam(file: File, context: CallbackContext) -> ShazamTrack:
-    file_location = file.get_file_location()
+async def shazam(file: File, context: CallbackContext, file_location: str = None) -> ShazamTrack:
+    file_location = file_location or file.get_file_location()
     if not os.path.isfile(file_location):
         raise FileNotFoundError
 
-    shazam_obj = Shazam()
-    unserialized_track = await shazam_obj.recognize_song(file_location)
+    content_hash = await asyncio.get_running_loop().run_in_executor(None, _file_hash, file_location)
+    keys = _cache_keys(file, content_hash)
+
+    not_found = False
+    try:
+        serialized_track = await _cache_get(keys)
+    except TrackNotFound:
+        serialized_track = None
+        not_found = True
+
+    unserialized_track = None
+    if serialized_track is None and not not_found:
+        unserialized_track = await get_shazam_client().recognize_song(file_location)
 
     try:
         os.remove(file_location)
     except Exception as e:
         raise RemoveFileFailed("Problem removing file after Shazam.")
 
-    try:
-        serialized_track = ShazamTrack(unserialized_track)
-    except TrackNotFound:
+    if not_found:
         raise TrackNotFound
 
+    if unserialized_track is not None:
+        try:
+            serialized_track = ShazamTrack(unserialized_track)
+        except TrackNotFound:
+            await _cache_add(keys, None)
+            raise TrackNotFound
+
+    # Cached under all keys, so the same Telegram file sent again is found without downloading it
+    await _cache_add(keys, serialized_track)
     return serialized_track
+
+
+async def _decode_excerpt(source: str, offset: float, seconds: int) -> bytes:
+    """
+    Decodes part of an audio file with ffmpeg.
+    @param source: URL or path of the file.
+    @param offset: second the excerpt starts at.
+    @param seconds: length of the excerpt, in seconds.
+    @return: raw 16-bit mono samples.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-ss', str(offset), '-t', str(seconds), '-i', source,
+            '-vn', '-ac', '1', '-ar', str(EXCERPT_SAMPLE_RATE), '-f', 's16le', 'pipe:1',
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        raise AudioDecodeFail("Couldn't run ffmpeg.") from e
+
+    try:
+        samples, errors = await asyncio.wait_for(process.communicate(), EXCERPT_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise AudioDecodeFail("Decoding the excerpt timed out.")
+
+    if process.returncode != 0 or not samples:
+        raise _decode_error(source, process.returncode, errors)
+
+    return samples
+
+
+async def _recognize_signature(client: ShazamClient, limiter: RateLimiter, signature):
+    if signature is None:
+        return None
+
+    await limiter.wait()
+    try:
+        return ShazamTrack(await client.send_recognize_request(signature))
+    except TrackNotFound:
+        return None
+    except Exception:
+        # A window that failed is left out, instead of failing the whole tracklist
+        logger.warning("Couldn't recognize a window of a tracklist.", exc_info=True)
+        return None
+
+
+def _fingerprint_windows(report, source: str, window: int, step: int):
+    """
+    Decodes a mix with ffmpeg and fingerprints its windows. Runs on a process of the tracklist pool.
+    @param report: function the (window start in seconds, signature or None if it's too short) tuples are sent with.
+    @param source: URL or path of the mix.
+    @param window: seconds of each window.
+    @param step: seconds between the start of two windows.
+    @return:
+    """
+    process = subprocess.Popen(
+        ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', source,
+         '-vn', '-ac', '1', '-ar', str(EXCERPT_SAMPLE_RATE), '-f', 's16le', 'pipe:1'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    try:
+        bytes_per_second = EXCERPT_SAMPLE_RATE * 2
+        chunks = iter(lambda: process.stdout.read(DECODE_READ_SIZE), b'')
+
+        for offset, samples in split_windows(chunks, window * bytes_per_second, step * bytes_per_second):
+            audio = AudioSegment(data=samples, sample_width=2, frame_rate=EXCERPT_SAMPLE_RATE, channels=1)
+            report((offset / bytes_per_second, _signature(audio)))
+
+        errors = process.stderr.read()
+        if process.wait() != 0:
+            raise _decode_error(source, process.returncode, errors)
+
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def _decode_error(source: str, returncode: int, errors: bytes) -> AudioDecodeFail:
+    """
+    Builds the error of a failed ffmpeg decode. ffmpeg's messages repeat the input URL, which for Telegram files has
+    the bot token in it, so only the last line of the messages is kept, without the URL and with any token masked.
+    @param source: URL or path ffmpeg decoded.
+    @param returncode: exit code of ffmpeg.
+    @param errors: what ffmpeg wrote to stderr.
+    @return: AudioDecodeFail object.
+    """
+    lines = [line.strip() for line in errors.decode(errors='replace').splitlines() if line.strip()]
+    reason = lines[-1] if lines else "no output"
+
+    reason = BOT_TOKEN_PATTERN.sub("bot<token>", reason.replace(source, "<input>"))
+    return AudioDecodeFail("ffmpeg failed with code {}: {}".format(returncode, reason[:DECODE_ERROR_LENGTH]))
+
+
+def split_windows(chunks, window_size: int, step_size: int):
+    """
+    Splits a stream of bytes into overlapping windows, keeping only one window in memory.
+    @param chunks: iterable of bytes.
+    @param window_size: bytes of each window.
+    @param step_size: bytes between the start of two windows.
+    @return: generator of (offset, window bytes) tuples. The last window may be shorter.
+    """
+    buffer = bytearray()
+    offset = 0
+
+    for chunk in chunks:
+        buffer += chunk
+
+        while len(buffer) >= window_size:
+            yield offset, bytes(buffer[:window_size])
+            del buffer[:step_size]
+            offset += step_size
+
+    # The rest, if it's not all in the last window already
+    if buffer and (offset == 0 or len(buffer) > window_size - step_size):
+        yield offset, bytes(buffer)
+
+
+def _signature(audio: AudioSegment):
+    # Same as 'Shazam.recognize_song' does, without sending the signature
+    generator = Shazam.create_signature_generator(audio)
+    signature = generator.get_next_signature()
+
+    if len(generator.input_pending_processing) < 128:
+        return None
+
+    while not signature:
+        signature = generator.get_next_signature()
+    return signature
+
+
+def _cache_keys(file: File, content_hash: str = None) -> list:
+    keys = []
+    if file.file_unique_id is not None:
+        keys.append('telegram:' + file.file_unique_id)
+    if content_hash is not None:
+        keys.append('sha256:' + content_hash)
+    return keys
+
+
+def _file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
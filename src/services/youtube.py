@@ -1,14 +1,61 @@
+import asyncio
+import contextlib
+import os
 import re
-import magic
+import subprocess
+import uuid
 
+from decouple import config
 from telegram import Message
-from telegram.constants import ParseMode
 
+from src.cache import AudioCache
 from src.definitions.definitions import FILES_DIR
 from src.exceptions import YoutubeAudioDownloadFail
-from src.models import YoutubeTrack, Metadata
+from src.mime import resolve_mime_type
+from src.models import YoutubeTrack, YoutubeSource, Metadata
+from src.pool import ProcessPool
+from src.progress import ProgressReporter
 from src.utils import set_file_metadata
 from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+# Downloads and transcoding run on their own processes, as many at a time as there are CPUs by default
+download_pool = ProcessPool(config("YOUTUBE_DOWNLOAD_WORKERS", default=os.cpu_count() or 1, cast=int))
+
+# Seconds a download (including transcoding) may take before it is cancelled
+DOWNLOAD_TIMEOUT = config("YOUTUBE_DOWNLOAD_TIMEOUT", default=900, cast=int)
+
+# How the downloaded audio is stored, part of the audio cache key: 'mp3' transcodes it to MP3, at the source's bitrate
+# at most, while 'native' keeps the audio stream as Youtube serves it (usually Opus or AAC), only changing its container
+# if needed, which takes a fraction of the CPU
+AUDIO_MODE = config("YOUTUBE_AUDIO_MODE", default='mp3')
+
+# Bitrates (in kbps) audio is transcoded to on 'mp3' mode, the highest one not above the source's being used
+MP3_BITRATES = (64, 96, 128, 160, 192, 256, 320)
+
+# On 'mp3' mode, the audio can be transcoded straight from Youtube into the Google Drive upload, so the upload starts
+# before the download is done. Tags are written in the file's header up front. Audio that is already cached isn't piped.
+PIPELINE = config("YOUTUBE_PIPELINE", default=False, cast=bool)
+
+# Bytes read from the transcoder at a time
+PIPE_READ_SIZE = 64 * 1024
+
+# Youtube video links (not channels, playlists...), capturing the video ID
+YOUTUBE_VIDEO_PATTERN = re.compile(
+    r"(?:https?:\/\/)?(?:youtu\.be\/|(?:www\.|m\.)?youtube\.com\/(?:watch|v|embed)(?:\.php)?(?:\?.*v=|\/))([a-zA-Z0-9\_-]+)")
+
+# Youtube (and Youtube Music) playlist and album links
+YOUTUBE_PLAYLIST_PATTERN = re.compile(
+    r"(?:https?:\/\/)?(?:www\.|m\.|music\.)?youtube\.com\/(?:playlist\?(?:[^&\s]*&)*list=|browse\/(?=MPREb_))([a-zA-Z0-9\_-]+)")
+
+# Playlist entries listed ahead of the ones being processed
+PLAYLIST_READ_AHEAD = 10
+
+# Playlists are listed on their own processes, so a long playlist doesn't hold a download process. A listing process
+# can only send a few entries past the ones read ahead, and then waits for them to be consumed.
+listing_pool = ProcessPool(config("YOUTUBE_LISTING_WORKERS", default=2, cast=int), buffer=PLAYLIST_READ_AHEAD)
+
+_audio_cache = None
 
 
 def url_is_youtube_valid(url: str):
@@ -17,61 +64,337 @@ def url_is_youtube_valid(url: str):
     @param url: string to be verified.
     @return: returns if it's a valid youtube video link downloadable by Youtube DL.
     """
-    pattern = re.compile(
-        r"(?:https?:\/\/)?(?:youtu\.be\/|(?:www\.|m\.)?youtube\.com\/(?:watch|v|embed)(?:\.php)?(?:\?.*v=|\/))([a-zA-Z0-9\_-]+)")
-    return pattern.search(url)
+    return YOUTUBE_VIDEO_PATTERN.search(url)
+
+
+def url_is_youtube_playlist(url: str):
+    """
+    Validates if it is a Youtube playlist (or Youtube Music album) link.
+    @param url: string to be verified.
+    @return: returns the match of the link, with the playlist ID as the first group. None if it's not a playlist link.
+    """
+    return YOUTUBE_PLAYLIST_PATTERN.search(url)
 
 
-async def download_youtube_audio(metadata: Metadata, message: Message) -> YoutubeTrack:
+async def list_youtube_playlist(url: str):
+    """
+    Lists the videos of a Youtube playlist as they're found, without resolving the whole playlist first.
+    Listing is paused while the entries listed ahead aren't consumed (the listing process blocks on sending the next
+    one), so memory doesn't grow with the playlist.
+    @param url: Youtube playlist link.
+    @return: async generator of dicts with the ID, title and link of each video.
+    """
+    entries = asyncio.Queue(maxsize=PLAYLIST_READ_AHEAD)
+    job = asyncio.ensure_future(listing_pool.run(_list_playlist, url, on_progress=entries.put))
+
+    try:
+        while True:
+            if entries.empty() and job.done():
+                try:
+                    job.result()
+                except Exception:
+                    raise YoutubeAudioDownloadFail("Problem listing the Youtube playlist.")
+                return
+
+            getter = asyncio.ensure_future(entries.get())
+            await asyncio.wait({getter, job}, return_when=asyncio.FIRST_COMPLETED)
+
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+    finally:
+        # Stopping the listing if the playlist isn't consumed until the end
+        job.cancel()
+
+
+async def download_youtube_audio(metadata: Metadata, message: Message, directory: str = FILES_DIR) -> YoutubeTrack:
     """
     Downloads audio from youtube video link. Alters message sent to show the progress of the download.
+    Audio is cached by video ID and format, so a video that was already downloaded (or is being downloaded) isn't
+    downloaded and transcoded again. The download and transcoding run on the download process pool.
     @param metadata: metadata object.
     @param message: message object to update the message with progress.
+    @param directory: directory the file is downloaded to, e.g. the directory of a scratch job.
     @return: YoutubeTrack containing information about the downloaded file and audio track.
     """
 
-    async def progress_hook(d):
-        if d['status'] == 'finished':
-            await message.edit_text(
-                "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
-                "Done downloading from Youtube!",
-                parse_mode=ParseMode.MARKDOWN)
+    video_match = url_is_youtube_valid(metadata.url)
+    if not video_match:
+        raise YoutubeAudioDownloadFail
+
+    reporter = ProgressReporter(message)
+
+    def on_progress(d):
         if d['status'] == 'downloading':
-            await message.edit_text(
+            reporter.post(
                 "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
-                "Downloading from Youtube: " + d['_percent_str'],
-                parse_mode=ParseMode.MARKDOWN)
+                "Downloading from Youtube: " + d['percent'])
+
+    async def download(report):
+        info = await download_pool.run(_download_audio, metadata.url, directory, AUDIO_MODE, timeout=DOWNLOAD_TIMEOUT,
+                                       on_progress=report)
+        return info['filepath'], {'title': info['title'], 'video_id': info['id'], 'format': info['format']}
+
+    # Each request gets its own copy of the cached audio, as it's tagged with the request's metadata.
+    # The extension depends on the format the audio was stored in, so it's only added once the audio is copied.
+    video_id = video_match.group(1)
+    download_path = os.path.join(directory, uuid.uuid4().hex + '-' + video_id)
+    filepath = download_path
+
+    try:
+        info = await get_audio_cache().fetch(video_id + '-' + AUDIO_MODE, download, download_path, on_progress)
+
+        filepath = download_path + _format_extension(info.get('format'))
+        os.replace(download_path, filepath)
+
+        loop = asyncio.get_running_loop()
+        mimetype = await loop.run_in_executor(None, _tag_audio, filepath, metadata, info.get('format'))
+
+    except Exception as e:
+        reporter.close()
+        for path in (download_path, filepath):
+            if os.path.exists(path):
+                os.remove(path)
+        raise YoutubeAudioDownloadFail
+
+    await reporter.finish(
+        "Got it! Going to download the file now and try to upload it to Google Drive. Gimme a few seconds ⌛!\n"
+        "Done downloading from Youtube!")
+
+    return YoutubeTrack(file_title=info['title'], video_id=info['video_id'], filepath=filepath, mimetype=mimetype,
+                        audio_format=info.get('format'))
+
+
+def can_pipe_youtube_audio(url: str) -> bool:
+    """
+    Checks if the audio of a Youtube link can be transcoded straight into its upload.
+    @param url: Youtube video link.
+    @return: True on pipelined 'mp3' mode, if the audio isn't cached.
+    """
+    video_match = url_is_youtube_valid(url)
+    return PIPELINE and AUDIO_MODE == 'mp3' and video_match is not None and \
+        video_match.group(1) + '-' + AUDIO_MODE not in get_audio_cache()
+
+
+async def resolve_youtube_audio(metadata: Metadata) -> YoutubeSource:
+    """
+    Gets the audio stream of a Youtube link, without downloading it. Runs on the download process pool.
+    @param metadata: metadata object.
+    @return: YoutubeSource object with the stream's URL and the bitrate it's transcoded to.
+    """
+    if not url_is_youtube_valid(metadata.url):
+        raise YoutubeAudioDownloadFail
+
+    try:
+        info = await download_pool.run(_resolve_audio, metadata.url, timeout=DOWNLOAD_TIMEOUT)
+    except Exception as e:
+        raise YoutubeAudioDownloadFail
+
+    return YoutubeSource(**info)
+
+
+@contextlib.contextmanager
+def transcode_youtube_audio(source: YoutubeSource, metadata: Metadata):
+    """
+    Transcodes the audio stream of a Youtube video to MP3 with ffmpeg, tagged with the metadata up front.
+    Blocking, meant to be read from the upload worker pool.
+    @param source: YoutubeSource object.
+    @param metadata: metadata object.
+    @return: context manager giving an iterator of the MP3 file's bytes. It raises YoutubeAudioDownloadFail at the end
+    if ffmpeg failed, and ffmpeg is stopped on exit.
+    """
+    process = subprocess.Popen(_transcode_command(source, metadata), stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read():
+        for chunk in iter(lambda: process.stdout.read(PIPE_READ_SIZE), b''):
+            yield chunk
 
-    # YoutubeDL options (best quality possible mp3 and outputting to files directory "files/ID.mp3")
+        # Failing before the end of the file, so a partial file isn't uploaded
+        if process.wait() != 0:
+            raise YoutubeAudioDownloadFail(process.stderr.read().decode(errors='replace'))
+
+    try:
+        yield read()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def expected_audio_size(source: YoutubeSource) -> int:
+    """
+    Estimates the size of the transcoded audio of a Youtube video.
+    @param source: YoutubeSource object.
+    @return: size in bytes, 0 if the video's duration isn't known.
+    """
+    return int((source.duration or 0) * source.bitrate * 1000 / 8)
+
+
+def get_audio_cache() -> AudioCache:
+    """
+    Gets the audio cache, creating it on first use.
+    @return: AudioCache object.
+    """
+    global _audio_cache
+
+    if _audio_cache is None:
+        _audio_cache = AudioCache()
+
+    return _audio_cache
+
+
+def _download_audio(report, url: str, directory: str = FILES_DIR, mode: str = AUDIO_MODE) -> dict:
+    """
+    Downloads the audio of a Youtube video, transcoding or remuxing it depending on the mode. Runs on the download
+    process pool.
+    The video's formats are extracted first, so the audio is never transcoded to a higher bitrate than the source's.
+    @param report: function to report download progress.
+    @param url: Youtube video link.
+    @param directory: directory the file is downloaded to.
+    @param mode: 'mp3' to transcode the audio to MP3, 'native' to keep its codec.
+    @return: dict with the ID and title of the video, the path of the downloaded file and its format
+    (extension and bitrate, e.g. 'opus-160').
+    """
+
+    def progress_hook(d):
+        if d['status'] == 'downloading':
+            report({'status': 'downloading', 'percent': d['_percent_str']})
+
+    # YoutubeDL options (best quality audio, outputting to the given directory, e.g. "files/ID.webm")
     ydl_opts = {
         'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '320',
-        }],
         'progress_hooks': [progress_hook],
-        'outtmpl': FILES_DIR + '%(id)s.%(ext)s'
+        'outtmpl': os.path.join(directory, '%(id)s.%(ext)s')
     }
-    
-    try:
-        with YoutubeDL(ydl_opts) as ydl:
-            
-            # Download and get file info
-            info = ydl.extract_info(metadata.url, download=True)
 
-            title = info['title']
-            video_id = info['id']
+    with YoutubeDL(ydl_opts) as ydl:
 
-            # Getting mimetype
-            filepath = FILES_DIR + video_id + '.mp3'
-            mime = magic.Magic(mime=True)
-            mimetype = mime.from_file(filepath)
+        # Get the file info, pick the bitrate and download
+        info = ydl.extract_info(url, download=False)
+        bitrate = _target_bitrate(info, mode)
+        ydl.add_post_processor(FFmpegExtractAudioPP(ydl, preferredcodec='best' if mode == 'native' else 'mp3',
+                                                    preferredquality=str(bitrate) if bitrate else None))
+        info = ydl.process_ie_result(info, download=True)
 
-            # Changing metadata
-            set_file_metadata(filepath=filepath, metadata=metadata)
+    downloads = info.get('requested_downloads') or [info]
+    filepath = downloads[0].get('filepath') or os.path.join(directory, info['id'] + '.mp3')
 
-    except Exception as e:
-        raise YoutubeAudioDownloadFail
+    audio_format = os.path.splitext(filepath)[1][1:]
+    if bitrate:
+        audio_format += '-' + str(bitrate)
+
+    return {'id': info['id'], 'title': info['title'], 'filepath': filepath, 'format': audio_format}
+
+
+def _resolve_audio(report, url: str) -> dict:
+    """
+    Gets the audio stream of a Youtube video, without downloading it. Runs on the download process pool.
+    @param report: function to report progress (unused).
+    @param url: Youtube video link.
+    @return: dict with the fields of a YoutubeSource object.
+    """
+    with YoutubeDL({'format': 'bestaudio/best', 'quiet': True}) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    return {'video_id': info['id'], 'title': info['title'], 'url': info['url'],
+            'http_headers': info.get('http_headers') or {}, 'bitrate': _target_bitrate(info, 'mp3'),
+            'duration': info.get('duration')}
+
+
+def _transcode_command(source: YoutubeSource, metadata: Metadata) -> list:
+    """
+    Gets the ffmpeg command transcoding a Youtube audio stream to MP3 on its standard output.
+    The ID3 tags are written at the start of the file, with the same tags 'set_file_metadata' sets.
+    @param source: YoutubeSource object.
+    @param metadata: metadata object.
+    @return: command arguments.
+    """
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'error',
+               '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+    if source.http_headers:
+        command += ['-headers', ''.join(name + ': ' + value + '\r\n' for name, value in source.http_headers.items())]
+    command += ['-i', source.url, '-vn', '-map_metadata', '-1', '-c:a', 'libmp3lame', '-b:a', str(source.bitrate) + 'k',
+                '-id3v2_version', '3']
+
+    tags = {'artist': metadata.artist, 'date': metadata.year, 'track': metadata.track, 'genre': metadata.genre,
+            'album': metadata.album, 'title': metadata.title}
+    for name, value in tags.items():
+        if value not in ("", None):
+            command += ['-metadata', name + '=' + str(value)]
+
+    return command + ['-f', 'mp3', 'pipe:1']
+
+
+def _target_bitrate(info: dict, mode: str):
+    """
+    Picks the bitrate the audio of a video is stored at.
+    @param info: info of the video, with its selected format.
+    @param mode: 'mp3' to transcode the audio to MP3, 'native' to keep its codec.
+    @return: bitrate in kbps. On 'native' mode it's the source's, None if it's not known.
+    """
+    source_bitrate = info.get('abr') or info.get('tbr')
+
+    if mode == 'native':
+        return round(source_bitrate) if source_bitrate else None
+
+    # Bitrates above the source's only make the file bigger
+    if not source_bitrate:
+        return MP3_BITRATES[-1]
+    return max([bitrate for bitrate in MP3_BITRATES if bitrate <= source_bitrate], default=MP3_BITRATES[0])
+
+
+def _format_extension(audio_format: str) -> str:
+    # e.g. 'opus-160' -> '.opus'. Audio cached before formats were recorded is MP3.
+    return '.' + audio_format.split('-')[0] if audio_format else '.mp3'
+
+
+def _list_playlist(report, url: str) -> dict:
+    """
+    Lists the videos of a Youtube playlist, reporting each one as it's found. Runs on the listing process pool.
+    Only the video IDs and titles are extracted ('flat' extraction), one page of the playlist at a time.
+    @param report: function to report each video.
+    @param url: Youtube playlist link.
+    @return: dict with the title of the playlist.
+    """
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'quiet': True,
+    }
+
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+
+        # Album links redirect to their playlist
+        if info.get('_type') in ('url', 'url_transparent'):
+            info = ydl.extract_info(info['url'], download=False, process=False)
+
+        for entry in info.get('entries') or []:
+            if entry and entry.get('id'):
+                report({'id': entry['id'],
+                        'title': entry.get('title') or entry['id'],
+                        'url': 'https://www.youtube.com/watch?v=' + entry['id']})
+
+    return {'title': info.get('title')}
+
+
+def _tag_audio(filepath: str, metadata: Metadata, audio_format: str = None) -> str:
+    """
+    Sets the metadata of a downloaded audio file and gets its mimetype.
+    @param filepath: path of the audio file.
+    @param metadata: metadata object.
+    @param audio_format: format the audio was stored in, e.g. 'mp3-320'. The file is only sniffed if it's not given.
+    @return: mimetype of the file.
+    """
+
+    # Getting mimetype
+    mimetype = resolve_mime_type(audio_format=audio_format, path=filepath)
+
+    # Changing metadata
+    set_file_metadata(filepath=filepath, metadata=metadata)
 
-    return YoutubeTrack(file_title=title, video_id=video_id, filepath=filepath, mimetype=mimetype)
+    return mimetype
@@ -0,0 +1,140 @@
+import asyncio
+import contextlib
+import os
+import shutil
+import uuid
+
+from decouple import config
+
+from src.definitions.definitions import FILES_DIR
+
+SCRATCH_DIR = FILES_DIR + 'scratch/'
+
+# Maximum size of the files of the jobs running at the same time, in megabytes
+SCRATCH_QUOTA = config("SCRATCH_QUOTA", default=2048, cast=int)
+
+# Megabytes reserved by jobs whose files' size isn't known beforehand (e.g. Youtube downloads)
+SCRATCH_JOB_SIZE = config("SCRATCH_JOB_SIZE", default=100, cast=int)
+
+_scratch_space = None
+
+
+class ScratchJob:
+    """
+    Directory of a job's files, removed when the job is done.
+    """
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = size
+
+    def path(self, name: str) -> str:
+        """
+        Gets the path of a file of the job.
+        @param name: name of the file, e.g. the title of a song. Path separators are replaced.
+        @return: path inside the job's directory.
+        """
+        name = name.replace('/', '_').replace('\\', '_').replace('\0', '')
+        if name in ('', '.', '..'):
+            name = 'file'
+
+        return os.path.join(self.directory, name)
+
+
+class ScratchSpace:
+    """
+    Scratch space for the files jobs download and process (e.g. songs before they're uploaded to Google Drive).
+    Each job gets its own directory, so jobs never write to the same path, and the directory is removed when the job
+    ends, whether it succeeded or failed. Jobs reserve the space they need beforehand, and wait for other jobs to end
+    if the quota would be exceeded. Directories left by a previous run are removed on start.
+    Jobs are started from the event loop only.
+    """
+
+    def __init__(self, directory: str = SCRATCH_DIR, quota: int = SCRATCH_QUOTA * 1024 * 1024,
+                 job_size: int = SCRATCH_JOB_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.quota = quota
+        self.job_size = job_size
+
+        self._jobs = {}
+        self._reserved = 0
+        self._condition = None
+        self._loop = None
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.asynccontextmanager
+    async def job(self, size: int = None):
+        """
+        Starts a job, waiting for space to free up if needed.
+        @param size: bytes the job's files take at most. The default job size is reserved if not given.
+        @return: async context manager giving the ScratchJob object. Its directory is removed on exit.
+        """
+        # A job bigger than the whole quota runs alone
+        size = min(size or self.job_size, self.quota)
+
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._reserved + size <= self.quota)
+            self._reserved += size
+
+        job = ScratchJob(os.path.join(self.directory, uuid.uuid4().hex), size)
+        self._jobs[job.directory] = job
+
+        try:
+            os.makedirs(job.directory)
+            yield job
+        finally:
+            shutil.rmtree(job.directory, ignore_errors=True)
+            del self._jobs[job.directory]
+
+            async with condition:
+                self._reserved -= size
+                condition.notify_all()
+
+    def usage(self) -> dict:
+        """
+        Gets the current usage of the scratch space, e.g. for monitoring.
+        @return: dict with the number of running jobs, the bytes they reserved, the bytes their files take and the quota.
+        """
+        return {
+            'jobs': len(self._jobs),
+            'reserved': self._reserved,
+            'used': sum(_directory_size(directory) for directory in list(self._jobs)),
+            'quota': self.quota,
+        }
+
+    def _get_condition(self) -> asyncio.Condition:
+        # The condition is created lazily so it belongs to the running event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+
+        return self._condition
+
+
+def get_scratch_space() -> ScratchSpace:
+    """
+    Gets the scratch space, creating it (and removing the files left by a previous run) on first use.
+    @return: ScratchSpace object.
+    """
+    global _scratch_space
+
+    if _scratch_space is None:
+        _scratch_space = ScratchSpace()
+
+    return _scratch_space
+
+
+def _directory_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Removed while walking
+                pass
+    return size
@@ -0,0 +1,772 @@
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from decouple import config
+
+from src.definitions.definitions import DATA_DIR
+from src.exceptions import GoogleDriveUploadFail, YoutubeAudioDownloadFail, TaskRateLimited, TaskDeferred
+from src.models import Task
+
+logger = logging.getLogger(__name__)
+
+# Number of tasks processed at the same time
+TASK_WORKERS = config("TASK_WORKERS", default=4, cast=int)
+
+# Times a task is attempted before giving up, and seconds to wait before the first retry (doubled on each retry)
+TASK_MAX_ATTEMPTS = config("TASK_MAX_ATTEMPTS", default=3, cast=int)
+TASK_RETRY_BACKOFF = config("TASK_RETRY_BACKOFF", default=30, cast=float)
+
+# Seconds idle workers wait before checking for tasks again
+POLL_INTERVAL = 5
+
+# Share of the workers each chat gets, as 'chat_id:weight' pairs separated by commas (chats not listed have weight 1).
+# Tasks are taken from the chats in weighted round-robin, and from the users of a chat in round-robin.
+TASK_CHAT_WEIGHTS = config("TASK_CHAT_WEIGHTS", default="")
+
+# Jobs a user can queue at once, and jobs per minute they can queue after that. A burst of 0 disables the limit.
+TASK_USER_BURST = config("TASK_USER_BURST", default=10, cast=int)
+TASK_USER_RATE = config("TASK_USER_RATE", default=6, cast=float)
+
+# Songs of batches and playlists processed at the same time, across all of them. Waiting songs get free slots in the
+# same turns as queued tasks.
+TASK_SONG_SLOTS = config("TASK_SONG_SLOTS", default=TASK_WORKERS, cast=int)
+
+# Number of recent queue wait times the metrics are worked out from
+WAIT_SAMPLES = 100
+
+# Errors worth retrying - the others fail the task right away
+RETRYABLE_ERRORS = (GoogleDriveUploadFail, YoutubeAudioDownloadFail)
+
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+
+_checkpoints = None
+_checkpoints_lock = threading.Lock()
+
+_user_limits = None
+_song_slots = None
+_shared_lock = threading.Lock()
+
+
+class TaskQueue:
+    """
+    Durable task queue stored on a SQLite database.
+    Tasks are claimed one at a time, so there can be any number of them queued without loading them into memory.
+    Completed tasks are removed and failed ones are kept for inspection.
+    Tasks are queued on lanes, one per chat and user, and claimed fairly across them: chats take turns in proportion to
+    their weights and the users of a chat take turns, so one user queueing many links doesn't hold up everyone else.
+    """
+
+    def __init__(self, path: str, chat_weights: dict = None):
+        self.chat_weights = parse_chat_weights(TASK_CHAT_WEIGHTS) if chat_weights is None else chat_weights
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+        # Turns of the chats, and of the users of each chat
+        self._turns = _LaneTurns(self._weight)
+
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    error TEXT,
+                    chat_id INTEGER,
+                    user_id INTEGER
+                )""")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS tasks_available ON tasks (status, available_at, id)")
+
+            # Queues made before tasks had lanes
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(tasks)")}
+            for column in ("chat_id", "user_id"):
+                if column not in columns:
+                    self._connection.execute("ALTER TABLE tasks ADD COLUMN {} INTEGER".format(column))
+
+    def put(self, kind: str, payload: dict, chat_id: int = None, user_id: int = None) -> int:
+        """
+        Adds a task to the queue.
+        @param kind: kind of task, which tells which function processes it.
+        @param payload: JSON serializable task arguments.
+        @param chat_id: ID of the chat the task comes from.
+        @param user_id: ID of the user that queued the task.
+        @return: ID of the task.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO tasks (kind, payload, status, available_at, created_at, chat_id, user_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (kind, json.dumps(payload), PENDING, now, now, chat_id, user_id))
+            return cursor.lastrowid
+
+    def claim(self):
+        """
+        Takes the next available task from the queue, marking it as running.
+        The task is the oldest one of the lane whose turn it is.
+        @return: Task object. Returns None if there are no available tasks.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Oldest available task of each lane
+                lanes = self._connection.execute(
+                    "SELECT chat_id, user_id, MIN(id) FROM tasks WHERE status = ? AND available_at <= ? "
+                    "GROUP BY chat_id, user_id", (PENDING, now)).fetchall()
+
+                row = None
+                if lanes:
+                    row = self._connection.execute(
+                        "SELECT id, kind, payload, attempts, available_at FROM tasks WHERE id = ?",
+                        (self._next_task(lanes),)).fetchone()
+                    self._connection.execute("UPDATE tasks SET status = ?, attempts = attempts + 1 WHERE id = ?",
+                                             (RUNNING, row[0]))
+            finally:
+                self._connection.execute("COMMIT")
+
+        if row is None:
+            return None
+
+        return Task(id=row[0], kind=row[1], payload=json.loads(row[2]), attempts=row[3] + 1,
+                    waited=max(0.0, now - row[4]))
+
+    def _next_task(self, lanes: list) -> int:
+        # Ties go to the oldest task
+        oldest = {(chat_id, user_id): task_id for chat_id, user_id, task_id in lanes}
+        return oldest[self._turns.next(oldest)]
+
+    def _weight(self, chat_id: int) -> float:
+        return self.chat_weights.get(chat_id, 1)
+
+    def position(self, chat_id: int = None, user_id: int = None) -> int:
+        """
+        Estimates how many of the pending tasks would be claimed before a new task of a chat and user, if they were
+        all claimed in turns.
+        @param chat_id: ID of the chat.
+        @param user_id: ID of the user.
+        @return: number of tasks ahead of the new task.
+        """
+        with self._lock:
+            lanes = self._connection.execute(
+                "SELECT chat_id, user_id, COUNT(*) FROM tasks WHERE status = ? GROUP BY chat_id, user_id",
+                (PENDING,)).fetchall()
+
+        # Turn of the new task on its lane, and on its chat (each other user of the chat takes as many turns)
+        own_lane = sum(count for chat, user, count in lanes if (chat, user) == (chat_id, user_id)) + 1
+        own_chat = own_lane + sum(min(count, own_lane) for chat, user, count in lanes
+                                  if chat == chat_id and user != user_id)
+
+        # Other chats take turns in proportion to their weights, and go first on the same turn as their tasks are older
+        other_chats = {}
+        for chat, _, count in lanes:
+            if chat != chat_id:
+                other_chats[chat] = other_chats.get(chat, 0) + count
+
+        return own_chat - 1 + sum(
+            min(count, math.floor((own_chat - 1) * self._weight(chat) / self._weight(chat_id)) + 1)
+            for chat, count in other_chats.items())
+
+    def complete(self, task_id: int):
+        """
+        Removes a finished task from the queue.
+        @param task_id: ID of the task.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def retry(self, task_id: int, delay: float, error: str = None):
+        """
+        Puts a task back on the queue, to be available after a delay.
+        @param task_id: ID of the task.
+        @param delay: seconds to wait before the task is available again.
+        @param error: description of the error that made the task fail.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("UPDATE tasks SET status = ?, available_at = ?, error = ? WHERE id = ?",
+                                     (PENDING, time.time() + delay, error, task_id))
+
+    def defer(self, task_id: int, delay: float):
+        """
+        Puts a task back on the queue to be available after a delay, without counting the attempt, e.g. when it has
+        to wait for the rate limit of its user.
+        @param task_id: ID of the task.
+        @param delay: seconds to wait before the task is available again.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("UPDATE tasks SET status = ?, available_at = ?, attempts = attempts - 1 "
+                                     "WHERE id = ?", (PENDING, time.time() + delay, task_id))
+
+    def fail(self, task_id: int, error: str = None):
+        """
+        Marks a task as failed, so it's not attempted again.
+        @param task_id: ID of the task.
+        @param error: description of the error that made the task fail.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("UPDATE tasks SET status = ?, error = ? WHERE id = ?", (FAILED, error, task_id))
+
+    def recover(self) -> int:
+        """
+        Puts tasks that were left running (e.g. the bot was restarted mid-task) back on the queue.
+        @return: number of recovered tasks.
+        """
+        with self._lock:
+            cursor = self._connection.execute("UPDATE tasks SET status = ? WHERE status = ?", (PENDING, RUNNING))
+            return cursor.rowcount
+
+    def pending_count(self) -> int:
+        """
+        Counts the tasks waiting to be processed.
+        @return: number of pending tasks.
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM tasks WHERE status = ?", (PENDING,)).fetchone()[0]
+
+    def stats(self) -> dict:
+        """
+        Gets the depth of the queue, e.g. for monitoring.
+        @return: dict with the number of pending tasks, the number of lanes they're on and the seconds the oldest
+        available one has been waiting.
+        """
+        now = time.time()
+        with self._lock:
+            pending, oldest = self._connection.execute(
+                "SELECT COUNT(*), MIN(CASE WHEN available_at <= ? THEN available_at END) FROM tasks WHERE status = ?",
+                (now, PENDING)).fetchone()
+            lanes = self._connection.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM tasks WHERE status = ? GROUP BY chat_id, user_id)",
+                (PENDING,)).fetchone()[0]
+
+        return {
+            'pending': pending,
+            'lanes': lanes,
+            'oldest_wait': round(now - oldest, 1) if oldest is not None else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class FairSlots:
+    """
+    Limits how many parts of jobs (e.g. the songs of batches and playlists) run at the same time, across all jobs.
+    Parts waiting for a slot get them in the same turns tasks are claimed from a TaskQueue, so a user's long playlist
+    doesn't hold up the songs of everyone else's. Used from the event loop only.
+    """
+
+    def __init__(self, size: int, chat_weights: dict = None):
+        self.size = max(1, size)
+        self.chat_weights = parse_chat_weights(TASK_CHAT_WEIGHTS) if chat_weights is None else chat_weights
+        self.used = 0
+
+        # (chat_id, user_id) -> futures of the parts waiting on that lane, oldest first
+        self._waiting = {}
+        self._arrivals = 0
+        self._turns = _LaneTurns(lambda chat_id: self.chat_weights.get(chat_id, 1))
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(futures) for futures in self._waiting.values())
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: int = None, user_id: int = None):
+        """
+        Waits for a slot on the turn of a chat and user, and holds it until the block is exited.
+        @param chat_id: ID of the chat the job comes from.
+        @param user_id: ID of the user that queued the job.
+        @return:
+        """
+        lane = (chat_id, user_id)
+
+        if self.used < self.size and not self._waiting:
+            # Free slots are still a turn of the lane
+            self._turns.next({lane: 0})
+            self.used += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._arrivals += 1
+            self._waiting.setdefault(lane, deque()).append((self._arrivals, future))
+
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    self._forget(lane, future)
+                else:
+                    # The slot was handed over just as the part was cancelled
+                    self._release()
+                raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self.used -= 1
+
+        while self._waiting and self.used < self.size:
+            # Ties go to the part that has waited the longest
+            lane = self._turns.next({lane: futures[0][0] for lane, futures in self._waiting.items()})
+            _, future = self._waiting[lane].popleft()
+            if not self._waiting[lane]:
+                del self._waiting[lane]
+
+            # Parts cancelled while waiting are forgotten once their task gets to run
+            if future.cancelled():
+                continue
+
+            self.used += 1
+            future.set_result(None)
+
+    def _forget(self, lane: tuple, future: asyncio.Future):
+        waiters = deque(waiter for waiter in self._waiting.get(lane, ()) if waiter[1] is not future)
+        if waiters:
+            self._waiting[lane] = waiters
+        else:
+            self._waiting.pop(lane, None)
+
+
+class _LaneTurns:
+    """
+    Turns of the (chat, user) lanes of a queue: chats take turns in proportion to their weights, and the users of a
+    chat take turns.
+    """
+
+    def __init__(self, weight):
+        """
+        @param weight: function returning the weight of a chat, from its ID.
+        """
+        self._weight = weight
+        self._chat_turns = _Turns()
+        self._user_turns = {}
+
+    def next(self, lanes: dict) -> tuple:
+        """
+        Picks the lane whose turn it is, and moves it forward.
+        @param lanes: dict of (chat_id, user_id) -> order of the oldest item of the lane, for ties.
+        @return: (chat_id, user_id) tuple.
+        """
+        # The chat whose turn it is goes first, then the user of that chat whose turn it is
+        chats = {}
+        for (chat_id, _), order in lanes.items():
+            chats[chat_id] = min(order, chats.get(chat_id, order))
+
+        chat_id = min(chats, key=lambda chat: (self._chat_turns.position(chat), chats[chat]))
+        self._chat_turns.advance(chat_id, 1 / self._weight(chat_id))
+
+        # Users of chats that are done taking turns start over
+        self._user_turns = {chat: turns for chat, turns in self._user_turns.items() if chat in self._chat_turns}
+        user_turns = self._user_turns.setdefault(chat_id, _Turns())
+
+        users = {user_id: order for (chat, user_id), order in lanes.items() if chat == chat_id}
+        user_id = min(users, key=lambda user: (user_turns.position(user), users[user]))
+        user_turns.advance(user_id, 1)
+
+        return chat_id, user_id
+
+
+class _Turns:
+    """
+    Turns of the lanes of a queue, on stride scheduling: every time a lane is served it moves forward by its stride
+    (1 / its weight), and the lane furthest behind goes next. Lanes that were idle start from the last served position,
+    so they don't build up turns while they have nothing queued.
+    """
+
+    def __init__(self):
+        self._clock = 0.0
+        self._positions = {}
+
+    def __contains__(self, lane) -> bool:
+        return lane in self._positions
+
+    def position(self, lane) -> float:
+        return max(self._positions.get(lane, 0.0), self._clock)
+
+    def advance(self, lane, stride: float):
+        self._clock = self.position(lane)
+        self._positions[lane] = self._clock + stride
+
+        # Lanes that aren't ahead of the clock are the same as new ones
+        self._positions = {key: position for key, position in self._positions.items() if position > self._clock}
+
+
+class TokenBuckets:
+    """
+    Token bucket rate limits, one bucket per key (e.g. per user). Buckets hold up to 'capacity' tokens and are refilled
+    with 'rate' tokens per second; taking more tokens than a bucket holds is refused, and taking more than its capacity
+    is never allowed. Used from the event loop only.
+    """
+
+    def __init__(self, capacity: float, rate: float, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self._clock = clock
+
+        # key -> (tokens, time they were counted). Full buckets aren't kept.
+        self._buckets = {}
+
+    def take(self, key, tokens: float = 1) -> float:
+        """
+        Takes tokens from the bucket of a key, if it holds enough.
+        @param key: key of the bucket.
+        @param tokens: number of tokens.
+        @return: 0 if they were taken. Otherwise, seconds until the bucket holds enough (infinite if it never does).
+        """
+        retry_after = self.wait_time(key, tokens)
+        if retry_after or self.capacity <= 0:
+            return retry_after
+
+        now = self._clock()
+        self._buckets[key] = (self._level(key, now) - tokens, now)
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if self._level(key, now) < self.capacity}
+        return 0
+
+    def wait_time(self, key, tokens: float = 1) -> float:
+        """
+        Works out how long until the bucket of a key holds enough tokens, without taking them.
+        @param key: key of the bucket.
+        @param tokens: number of tokens.
+        @return: 0 if it holds enough. Otherwise, seconds until it does (infinite if it never does).
+        """
+        if self.capacity <= 0:
+            return 0
+
+        if tokens > self.capacity:
+            return math.inf
+
+        available = self._level(key, self._clock())
+        if available < tokens:
+            return (tokens - available) / self.rate if self.rate > 0 else math.inf
+
+        return 0
+
+    def _level(self, key, now: float) -> float:
+        if key not in self._buckets:
+            return self.capacity
+
+        tokens, counted_at = self._buckets[key]
+        return min(self.capacity, tokens + (now - counted_at) * self.rate)
+
+
+class TaskWorkers:
+    """
+    Pool of async workers processing the tasks of a TaskQueue.
+    Each kind of task is processed by a registered 'run(bot, payload)' coroutine function. Tasks failing with a
+    retryable error are retried with exponential backoff; once they run out of attempts (or fail with another error),
+    the kind's 'on_failure(bot, payload, error)' coroutine function is called. Tasks raising TaskDeferred go back on
+    the queue until their delay is over, without counting the attempt.
+    Users are rate limited when jobs are admitted, before they're queued.
+    """
+
+    def __init__(self, queue: TaskQueue, bot, concurrency: int = TASK_WORKERS, max_attempts: int = TASK_MAX_ATTEMPTS,
+                 backoff: float = TASK_RETRY_BACKOFF, limits: TokenBuckets = None, slots: FairSlots = None):
+        self.queue = queue
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.limits = limits or get_user_limits()
+        self.slots = slots or get_song_slots()
+
+        self._handlers = {}
+        self._workers = []
+        self._wakeup = None
+        self._running = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    def register(self, kind: str, run, on_failure=None):
+        """
+        Registers the functions processing a kind of task.
+        @param kind: kind of task.
+        @param run: coroutine function called with (bot, payload) to process the task.
+        @param on_failure: coroutine function called with (bot, payload, error) when the task fails for good.
+        @return:
+        """
+        self._handlers[kind] = (run, on_failure)
+
+    async def admit(self, chat_id: int = None, user_id: int = None, cost: int = 1) -> int:
+        """
+        Checks if a user can queue a job, taking it from their rate limit.
+        @param chat_id: ID of the chat the job comes from.
+        @param user_id: ID of the user queueing the job.
+        @param cost: number of jobs it counts as. 0 for jobs whose songs are taken from the rate limit as they're
+        processed (batches and playlists), which are admitted as long as the user could queue a job.
+        @raise TaskRateLimited: if the user has to wait before queueing it.
+        @return: estimated position of the job on the queue. 0 if a worker can start it right away.
+        """
+        if cost:
+            retry_after = self.limits.take(user_id, cost)
+        else:
+            retry_after = self.limits.wait_time(user_id)
+
+        if retry_after:
+            raise TaskRateLimited(retry_after)
+
+        ahead = await _run_blocking(self.queue.position, chat_id, user_id)
+        return max(0, ahead + self._running - self.concurrency + 1)
+
+    async def enqueue(self, kind: str, payload: dict, chat_id: int = None, user_id: int = None) -> int:
+        """
+        Adds a task to the queue and wakes up the workers.
+        @param kind: kind of task.
+        @param payload: JSON serializable task arguments.
+        @param chat_id: ID of the chat the task comes from.
+        @param user_id: ID of the user that queued the task.
+        @return: ID of the task.
+        """
+        task_id = await _run_blocking(self.queue.put, kind, payload, chat_id, user_id)
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+        return task_id
+
+    async def start(self):
+        """
+        Starts the workers. Tasks left unfinished by a previous run are picked up again.
+        @return:
+        """
+        recovered = await _run_blocking(self.queue.recover)
+        if recovered:
+            logger.info("Recovered %d unfinished tasks.", recovered)
+
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        """
+        Stops the workers. Tasks being processed are left running and are picked up again on the next start.
+        @return:
+        """
+        for worker in self._workers:
+            worker.cancel()
+
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            self._wakeup.clear()
+            task = await _run_blocking(self.queue.claim)
+
+            if task is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Waking up another worker in case there are more tasks waiting
+            self._wakeup.set()
+
+            self._waits.append(task.waited)
+            self._running += 1
+            try:
+                await self._process(task)
+            finally:
+                self._running -= 1
+
+    async def metrics(self) -> dict:
+        """
+        Gets the queue depth and the recent wait times, e.g. for monitoring.
+        @return: dict with the queue stats, the number of running tasks and workers, the songs of batches and playlists
+        being processed and waiting for a slot, and the median, 95th percentile and maximum seconds the last claimed
+        tasks waited on the queue.
+        """
+        stats = await _run_blocking(self.queue.stats)
+        waits = sorted(self._waits)
+
+        return {
+            **stats,
+            'running': self._running,
+            'workers': self.concurrency,
+            'songs': self.slots.used,
+            'songs_waiting': self.slots.waiting,
+            'wait_p50': round(_percentile(waits, 0.5), 1),
+            'wait_p95': round(_percentile(waits, 0.95), 1),
+            'wait_max': round(waits[-1], 1) if waits else 0,
+        }
+
+    async def _process(self, task: Task):
+        # Tasks of unknown kinds (e.g. queued by a newer version) fail instead of stopping the worker
+        run, on_failure = None, None
+
+        try:
+            run, on_failure = self._handlers[task.kind]
+            await run(self.bot, task.payload)
+
+        except TaskDeferred as e:
+            # Not an attempt - the task goes back on the queue, freeing the worker for other tasks meanwhile
+            logger.info("Task %d (%s) deferred for %.1f seconds.", task.id, task.kind, e.delay)
+            await _run_blocking(self.queue.defer, task.id, e.delay)
+            asyncio.get_running_loop().call_later(e.delay, self._wakeup.set)
+
+        except RETRYABLE_ERRORS as e:
+            if task.attempts < self.max_attempts:
+                delay = self.backoff * 2 ** (task.attempts - 1)
+                logger.warning("Task %d (%s) failed, retrying in %.1f seconds.", task.id, task.kind, delay)
+                await _run_blocking(self.queue.retry, task.id, delay, repr(e))
+                asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+                return
+
+            await self._fail(task, on_failure, e)
+
+        except Exception as e:
+            logger.exception("Task %d (%s) failed.", task.id, task.kind)
+            await self._fail(task, on_failure, e)
+
+        else:
+            await _run_blocking(self.queue.complete, task.id)
+
+    async def _fail(self, task: Task, on_failure, error: Exception):
+        await _run_blocking(self.queue.fail, task.id, repr(error))
+
+        if on_failure is not None:
+            try:
+                await on_failure(self.bot, task.payload, error)
+            except Exception:
+                logger.exception("Failure callback of task %d (%s) failed.", task.id, task.kind)
+
+
+class Checkpoints:
+    """
+    Durable record of the parts of a job that are done (e.g. the songs of a playlist), so a job that is retried or
+    picked up again after a restart can skip them.
+    """
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    job TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (job, key)
+                )""")
+
+    def add(self, job: str, key: str):
+        """
+        Records a part of a job as done.
+        @param job: ID of the job.
+        @param key: ID of the part of the job.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO checkpoints VALUES (?, ?)", (job, key))
+
+    def contains(self, job: str, key: str) -> bool:
+        """
+        Checks if a part of a job is done.
+        @param job: ID of the job.
+        @param key: ID of the part of the job.
+        @return: True if it's done.
+        """
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM checkpoints WHERE job = ? AND key = ?",
+                                            (job, key)).fetchone() is not None
+
+    def clear(self, job: str):
+        """
+        Forgets the checkpoints of a job, once it's finished.
+        @param job: ID of the job.
+        @return:
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM checkpoints WHERE job = ?", (job,))
+
+
+def get_checkpoints() -> Checkpoints:
+    """
+    Gets the job checkpoints, creating them on first use.
+    @return: Checkpoints object.
+    """
+    global _checkpoints
+
+    with _checkpoints_lock:
+        if _checkpoints is None:
+            _checkpoints = Checkpoints(DATA_DIR + 'checkpoints.sqlite3')
+
+    return _checkpoints
+
+
+def get_user_limits() -> TokenBuckets:
+    """
+    Gets the rate limits of the users, creating them on first use. They're shared by the jobs being admitted and the
+    songs of batches and playlists, which are taken as they're processed.
+    @return: TokenBuckets object, one bucket per user.
+    """
+    global _user_limits
+
+    with _shared_lock:
+        if _user_limits is None:
+            _user_limits = TokenBuckets(TASK_USER_BURST, TASK_USER_RATE / 60)
+
+    return _user_limits
+
+
+def get_song_slots() -> FairSlots:
+    """
+    Gets the slots the songs of batches and playlists are processed on, creating them on first use.
+    @return: FairSlots object.
+    """
+    global _song_slots
+
+    with _shared_lock:
+        if _song_slots is None:
+            _song_slots = FairSlots(TASK_SONG_SLOTS)
+
+    return _song_slots
+
+
+def parse_chat_weights(value: str) -> dict:
+    """
+    Parses the weights of the chats, e.g. '-1001234:2,-1005678:0.5'.
+    @param value: 'chat_id:weight' pairs separated by commas.
+    @return: dict of chat ID -> weight.
+    """
+    weights = {}
+    for pair in value.split(","):
+        if pair.strip():
+            chat_id, weight = pair.rsplit(":", 1)
+            weights[int(chat_id)] = float(weight)
+
+            if weights[int(chat_id)] <= 0:
+                raise ValueError("The weight of chat {} has to be positive.".format(chat_id))
+
+    return weights
+
+
+def _percentile(values: list, fraction: float) -> float:
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, math.ceil(fraction * len(values)) - 1)]
+
+
+async def _run_blocking(fn, *args):
+    # Database calls are run off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
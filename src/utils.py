@@ -1,16 +1,51 @@
+import os
 import re
+
+import mutagen
 from mutagen.easyid3 import EasyID3
 
 from src.models import Metadata
 
+# Tags that can be set on a message, e.g. '&& artist: Daft Punk'
+METADATA_TAGS = {'artist', 'year', 'genre', 'album', 'title', 'folder', 'track'}
+
+# Tokens of a message: tag separators, quoted strings, and anything else (an unclosed quote is taken as it is).
+# None of the alternatives can backtrack, so a message is tokenized in linear time.
+_TOKEN_REGEX = re.compile(r'(&&)|"([^"]*)"|([^&"]+|[&"])')
+_TAG_REGEX = re.compile(r'\s*([A-Za-z]+)\s*:(.*)', re.DOTALL)
+
+# Start of a word that is an URL (scheme, 'www.' or domain followed by a path), and punctuation that ends a sentence
+_URL_START_REGEX = re.compile(r'(?i)(?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)')
+_URL_TRAILING_CHARS = "`!()[]{};:'\".,<>?«»“”‘’"
+_URL_LEADING_CHARS = "(<[{'\"«“‘"
+
+
+def format_timestamp(seconds: float) -> str:
+    """
+    Formats a number of seconds as a timestamp, e.g. '03:25' or '1:03:25'.
+    @param seconds: number of seconds.
+    @return: timestamp.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
 
 def set_file_metadata(filepath: str, metadata: Metadata):
     """
     Set file's artist, track number and title metadata.
+    MP3 files get ID3 tags, and other formats (e.g. M4A or Opus audio kept as Youtube serves it) their own kind of tags.
     @param filepath: file path to set metadata.
     @param metadata: metadata object.
     @return:
     """
+    if os.path.splitext(filepath)[1].lower() != '.mp3':
+        _set_other_file_metadata(filepath, metadata)
+        return
+
     metatag = EasyID3(filepath)
 
     metatag['artist'] = metadata.artist
@@ -23,49 +58,111 @@ def set_file_metadata(filepath: str, metadata: Metadata):
     metatag.save()
 
 
+def _set_other_file_metadata(filepath: str, metadata: Metadata):
+    metatag = mutagen.File(filepath, easy=True)
+    if metatag is None:
+        raise ValueError("Unknown audio format: " + filepath)
+    if metatag.tags is None:
+        metatag.add_tags()
+
+    tags = {
+        'artist': metadata.artist,
+        'date': metadata.year,
+        'tracknumber': metadata.track,
+        'genre': metadata.genre,
+        'album': metadata.album,
+        'title': metadata.title,
+    }
+
+    # These tags only take text, and empty values are left out
+    for key, value in tags.items():
+        if value not in ("", None):
+            metatag[key] = str(value)
+
+    metatag.save()
+
+
 def get_metadata_from_message(message: str) -> Metadata:
     """
-    Parses message and extracts metadata.
+    Parses message and extracts metadata, in a single pass over the message.
     Message should have the format of <URL> && (artist:<artist> && folder:<folder>) -> '()' being optional.
+    Values can be quoted (e.g. title:"Run && Hide") and, if a tag is repeated, the last one is used.
+    All URLs in the message are kept, the first one being the main URL.
     @param message: message to parse.
     @return: returns Metadata object with the extracted metadata
     """
+    urls = []
+    tags = {}
 
-    url_regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-
-    # Checking if there are any metadata matches
-    url_match = re.search(url_regex, message)
-    artist_match = re.search(r"(&&\s{0,}artist:([^&]{0,}))", message)
-    year_match = re.search(r"(&&\s{0,}year:([^&]{0,}))", message)
-    genre_match = re.search(r"(&&\s{0,}genre:([^&]{0,}))", message)
-    album_match = re.search(r"(&&\s{0,}album:([^&]{0,}))", message)
-    title_match = re.search(r"(&&\s{0,}title:([^&]{0,}))", message)
-    folder_match = re.search(r"(&&\s{0,}folder:([^&]{0,}))", message)
-    track_match = re.search(r"(&&\s{0,}track:([^&]{0,}))", message)
-
-    # Retrieving values from matches
-    url = url_match.group(0).strip() if url_match is not None else ""
-    artist = artist_match.group(2).strip() if artist_match is not None else ""
-    year = year_match.group(2).strip() if year_match is not None else ""
-    genre = genre_match.group(2).strip() if genre_match is not None else ""
-    album = album_match.group(2).strip() if album_match is not None else ""
-    title = title_match.group(2).strip() if title_match is not None else ""
-    folder = folder_match.group(2).strip() if folder_match is not None else None
-    track = track_match.group(2).strip() if track_match is not None else ""
+    for index, text in enumerate(_split_segments(message)):
+        # Tags come after a '&&', so the first segment is never a tag
+        tag = _TAG_REGEX.match(text) if index > 0 else None
+
+        if tag is not None and tag.group(1).lower() in METADATA_TAGS:
+            tags[tag.group(1).lower()] = tag.group(2).strip()
+        else:
+            urls.extend(_find_urls(text))
 
     # Parsing ints
     try:
-        year = int(year)
-    except: year = ""
+        year = int(tags.get('year', ""))
+    except ValueError: year = ""
     try:
-        track = int(track)
-    except: track = ""
+        track = int(tags.get('track', ""))
+    except ValueError: track = ""
 
-    return Metadata(url=url,
-                    artist=artist,
+    return Metadata(url=urls[0] if urls else "",
+                    artist=tags.get('artist', ""),
                     year=year,
-                    genre=genre,
-                    album=album,
-                    title=title,
-                    folder=folder,
-                    track=track)
+                    genre=tags.get('genre', ""),
+                    album=tags.get('album', ""),
+                    title=tags.get('title', ""),
+                    folder=tags.get('folder', None),
+                    track=track,
+                    urls=urls)
+
+
+def _split_segments(message: str):
+    """
+    Splits a message on its '&&' tag separators, which are ignored inside quoted strings.
+    @param message: message to split.
+    @return: generator of the text of each segment, with the quotes removed.
+    """
+    text = []
+
+    for separator, quoted, other in _TOKEN_REGEX.findall(message):
+        if separator:
+            yield "".join(text)
+            text = []
+        elif other:
+            text.append(other)
+        else:
+            text.append(quoted)
+
+    yield "".join(text)
+
+
+def _find_urls(text: str) -> list:
+    """
+    Finds the URLs in a text, looking at one word at a time.
+    @param text: text to search.
+    @return: list of URLs, in the order they show up.
+    """
+    urls = []
+
+    for word in text.split():
+        word = word.lstrip(_URL_LEADING_CHARS)
+        if not _URL_START_REGEX.match(word):
+            continue
+
+        # Trailing punctuation isn't part of the URL, unless it closes a parenthesis opened inside it
+        end = len(word)
+        while end > 0 and word[end - 1] in _URL_TRAILING_CHARS:
+            if word[end - 1] == ')' and word.count('(', 0, end) >= word.count(')', 0, end):
+                break
+            end -= 1
+
+        if end > 0:
+            urls.append(word[:end])
+
+    return urls
@@ -0,0 +1,145 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+
+from aiohttp import web
+from decouple import config
+from telegram import Update
+from telegram.ext import Application
+
+from src.metrics import collect_metrics
+
+logger = logging.getLogger(__name__)
+
+# Public URL Telegram sends the updates to (without the path), e.g. 'https://bot.example.com'
+WEBHOOK_URL = config("WEBHOOK_URL", default="")
+
+# Address and port the webhook server listens on, and path the updates are posted to
+WEBHOOK_LISTEN = config("WEBHOOK_LISTEN", default="0.0.0.0")
+WEBHOOK_PORT = config("WEBHOOK_PORT", default=8443, cast=int)
+WEBHOOK_PATH = config("WEBHOOK_PATH", default="/telegram")
+
+# Token Telegram sends with every update, so posts from anyone else are rejected. A random one is used if not set.
+WEBHOOK_SECRET_TOKEN = config("WEBHOOK_SECRET_TOKEN", default="")
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+HEALTH_PATH = "/health"
+
+
+class WebhookServer:
+    """
+    HTTP server receiving the bot updates from Telegram, as an alternative to polling for them.
+    Updates are put on the application's update queue, so they're handled just like polled ones.
+    It also serves a health endpoint for load balancers and container orchestrators, with the task queue metrics.
+    """
+
+    def __init__(self, application: Application, url: str = WEBHOOK_URL, listen: str = WEBHOOK_LISTEN,
+                 port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH, secret_token: str = WEBHOOK_SECRET_TOKEN):
+        if not url:
+            raise ValueError("'WEBHOOK_URL' has to be set to run on webhook mode.")
+
+        self.application = application
+        self.url = url.rstrip('/') + path
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+
+        self._runner = None
+
+    def create_app(self) -> web.Application:
+        """
+        Creates the aiohttp application with the webhook and health routes.
+        @return: aiohttp application.
+        """
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get(HEALTH_PATH, self.handle_health)
+        return app
+
+    async def start(self):
+        """
+        Starts listening and tells Telegram to send the updates to the webhook.
+        The application has to be initialized beforehand.
+        @return:
+        """
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+
+        await self.application.bot.set_webhook(url=self.url, secret_token=self.secret_token,
+                                               allowed_updates=Update.ALL_TYPES)
+        logger.info("Listening for updates on %s:%d%s.", self.listen, self.port, self.path)
+
+    async def stop(self):
+        """
+        Stops listening. Requests being handled are finished first.
+        The webhook is kept, so Telegram holds on to the updates sent while the bot is down.
+        @return:
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token):
+            return web.Response(status=403)
+
+        # Telegram sends the update again later if it's not accepted
+        if not self.application.running:
+            return web.Response(status=503)
+
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            return web.Response(status=400)
+
+        if update is None:
+            return web.Response(status=400)
+
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        if not self.application.running:
+            return web.json_response({'status': 'stopping'}, status=503)
+
+        return web.json_response({'status': 'ok', **await collect_metrics(self.application)})
+
+
+async def run_webhook(application: Application, server: WebhookServer = None):
+    """
+    Runs the bot on webhook mode until it gets a SIGINT or SIGTERM, like 'Application.run_polling' does on polling mode.
+    On shutdown, the server stops taking updates first and the updates already received are handled before stopping.
+    @param application: bot application, built without an updater.
+    @param server: webhook server. One with the configured settings is used if not given.
+    @return:
+    """
+    server = server or WebhookServer(application)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+
+    try:
+        await application.start()
+        await server.start()
+
+        await stop.wait()
+        logger.info("Shutting down the webhook server.")
+
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,64 @@
+"""
+Microbenchmark of the Google Drive setup cost paid by each upload.
+
+Before: every Drive call (folder lookup, folder creation and the upload itself) read 'token.json' from disk and built a
+new Drive service. After: the shared 'DriveClient' keeps credentials in memory and reuses the service.
+
+Runs offline - a fake token file is used and the Drive discovery document is the one bundled with the client library.
+Run from the repository root with `PYTHONPATH=. python tests/benchmarks/drive_setup_bench.py`.
+"""
+import json
+import os
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+from googleapiclient.discovery import build
+
+from src.services.gdrive import get_creds, DriveClient
+
+# Drive calls made by an upload to a 'folder:' tag (lookup, creation, upload)
+CALLS_PER_UPLOAD = 3
+UPLOADS = 50
+
+
+def write_fake_token(path: str):
+    token = {
+        "token": "fake_token",
+        "refresh_token": "fake_refresh_token",
+        "client_id": "fake_client_id",
+        "client_secret": "fake_client_secret",
+        "scopes": ["https://www.googleapis.com/auth/drive"],
+        "expiry": (datetime.utcnow() + timedelta(days=1)).isoformat() + "Z",
+    }
+    with open(path, 'w') as file:
+        json.dump(token, file)
+
+
+def per_call_setup(token_path: str):
+    for _ in range(CALLS_PER_UPLOAD):
+        build('drive', 'v3', credentials=get_creds(token_path, ""), cache_discovery=False)
+
+
+def shared_client_setup(client: DriveClient):
+    for _ in range(CALLS_PER_UPLOAD):
+        client.service()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        token_path = os.path.join(directory, 'token.json')
+        write_fake_token(token_path)
+
+        client = DriveClient(token_path, "")
+
+        before = timeit.timeit(lambda: per_call_setup(token_path), number=UPLOADS) / UPLOADS
+        after = timeit.timeit(lambda: shared_client_setup(client), number=UPLOADS) / UPLOADS
+
+    print(f"Per-upload setup, rebuilding per call: {before * 1000:.3f} ms")
+    print(f"Per-upload setup, shared DriveClient:  {after * 1000:.3f} ms")
+    print(f"Speedup: {before / after:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
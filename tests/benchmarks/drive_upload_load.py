@@ -0,0 +1,129 @@
+"""
+Load test of Google Drive uploads against a fake Drive endpoint.
+
+Each fake chunk upload blocks its thread for a while, like the real 'httplib2' calls do. While N uploads are in flight,
+a fake handler is run every few milliseconds and the delay between when it should have run and when it actually ran
+is measured. With uploads running on the worker pool the handler latency should stay flat as N grows; running the
+chunk loop on the event loop (as before) makes it grow with the upload time.
+Run from the repository root with `PYTHONPATH=. python tests/benchmarks/drive_upload_load.py`.
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from unittest.mock import Mock, AsyncMock, patch
+
+import src.services.gdrive
+from src.services.gdrive import upload_to_drive, _upload_file, DriveIndex, UploadSessions
+
+CHUNKS_PER_UPLOAD = 10
+CHUNK_SIZE = 256 * 1024
+CHUNK_UPLOAD_SECONDS = 0.02
+HANDLER_INTERVAL_SECONDS = 0.005
+IN_FLIGHT_UPLOADS = [0, 1, 4, 8]
+
+
+class FakeMedia:
+    """Resumable media of 'CHUNKS_PER_UPLOAD' chunks."""
+
+    def __init__(self, *args, **kwargs):
+        self._stream = Mock()
+
+    def resumable(self):
+        return True
+
+    def size(self):
+        return CHUNKS_PER_UPLOAD * CHUNK_SIZE
+
+    def stream(self):
+        return self._stream
+
+
+class FakeDriveRequest:
+    """Resumable upload request whose chunks block the calling thread, like 'httplib2' does."""
+
+    def __init__(self):
+        self.chunks_left = CHUNKS_PER_UPLOAD
+        self.resumable_uri = None
+        self.resumable_progress = 0
+
+    def next_chunk(self, num_retries=0):
+        time.sleep(CHUNK_UPLOAD_SECONDS)
+        self.chunks_left -= 1
+        self.resumable_uri = "https://upload/fake_session"
+        self.resumable_progress += CHUNK_SIZE
+
+        status = Mock(total_size=CHUNKS_PER_UPLOAD * CHUNK_SIZE)
+        status.progress.return_value = 1 - self.chunks_left / CHUNKS_PER_UPLOAD
+        return status, ({'id': 'fake_id'} if self.chunks_left == 0 else None)
+
+
+def fake_drive_service():
+    service = Mock()
+    service.files.return_value.create.side_effect = lambda **kwargs: FakeDriveRequest()
+    return service
+
+
+async def blocking_upload(file_path: str, file_title: str, file_mime_type: str, message):
+    """Previous behaviour - the chunk loop runs straight on the event loop."""
+    await asyncio.sleep(0)
+    _upload_file(file_path, file_title, file_mime_type, None, None, lambda progress: None)
+
+
+async def measure(upload, uploads: int) -> list:
+    latencies = []
+    stop = asyncio.Event()
+
+    async def handler():
+        while not stop.is_set():
+            expected = time.perf_counter() + HANDLER_INTERVAL_SECONDS
+            await asyncio.sleep(HANDLER_INTERVAL_SECONDS)
+            latencies.append(time.perf_counter() - expected)
+
+    handler_task = asyncio.create_task(handler())
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(uploads):
+            paths.append(os.path.join(directory, f"{i}.mp3"))
+            # Random content, so uploads aren't skipped as already uploaded
+            with open(paths[-1], 'wb') as file:
+                file.write(os.urandom(16))
+
+        if uploads:
+            await asyncio.gather(*[upload(path, "track", "audio/mpeg", AsyncMock()) for path in paths])
+        else:
+            await asyncio.sleep(CHUNKS_PER_UPLOAD * CHUNK_UPLOAD_SECONDS)
+
+    stop.set()
+    await handler_task
+
+    return latencies
+
+
+def report(name: str, uploads: int, latencies: list):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<12} uploads={uploads:<3} handler latency p50={p50:7.2f} ms  p99={p99:7.2f} ms")
+
+
+async def main():
+    for uploads in IN_FLIGHT_UPLOADS:
+        report("worker pool", uploads, await measure(upload_to_drive, uploads))
+
+    for uploads in IN_FLIGHT_UPLOADS:
+        report("event loop", uploads, await measure(blocking_upload, uploads))
+
+
+if __name__ == "__main__":
+    # Every upload is chunked, and the stores are kept on a temporary directory instead of 'data/'
+    with tempfile.TemporaryDirectory() as data_directory, \
+            patch.object(src.services.gdrive, "get_drive_service", fake_drive_service), \
+            patch.object(src.services.gdrive, "MediaFileUpload", FakeMedia), \
+            patch.object(src.services.gdrive, "SIMPLE_UPLOAD_MAX_SIZE", -1), \
+            patch.object(src.services.gdrive, "_drive_index", DriveIndex(os.path.join(data_directory, "index.db"))), \
+            patch.object(src.services.gdrive, "_upload_sessions",
+                         UploadSessions(os.path.join(data_directory, "upload_sessions.sqlite3"))):
+        asyncio.run(main())
@@ -0,0 +1,106 @@
+"""
+Microbenchmark of the message metadata parser, over a corpus of chat messages.
+
+Before: nine 're.search' calls per message, including a large URL regex that backtracks exponentially on a URL followed
+by punctuation (e.g. 'https://youtu.be/...!!!!!!!!!!!!!!!!!!!!'). After: one tokenizing pass with regexes compiled once
+at module level, looking for URLs one word at a time.
+
+The adversarial messages are kept short enough for the old parser to finish in a few seconds; each extra trailing
+character roughly doubles its time.
+Run from the repository root with `PYTHONPATH=. python tests/benchmarks/message_parser_bench.py`.
+"""
+import random
+import re
+import time
+
+from src.models import Metadata
+from src.utils import get_metadata_from_message
+
+REALISTIC_MESSAGES = 2000
+ADVERSARIAL_PUNCTUATION = [12, 16, 20]
+
+
+def legacy_get_metadata_from_message(message: str) -> Metadata:
+    """Previous parser, kept here as the baseline."""
+    url_regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
+
+    url_match = re.search(url_regex, message)
+    artist_match = re.search(r"(&&\s{0,}artist:([^&]{0,}))", message)
+    year_match = re.search(r"(&&\s{0,}year:([^&]{0,}))", message)
+    genre_match = re.search(r"(&&\s{0,}genre:([^&]{0,}))", message)
+    album_match = re.search(r"(&&\s{0,}album:([^&]{0,}))", message)
+    title_match = re.search(r"(&&\s{0,}title:([^&]{0,}))", message)
+    folder_match = re.search(r"(&&\s{0,}folder:([^&]{0,}))", message)
+    track_match = re.search(r"(&&\s{0,}track:([^&]{0,}))", message)
+
+    url = url_match.group(0).strip() if url_match is not None else ""
+    artist = artist_match.group(2).strip() if artist_match is not None else ""
+    year = year_match.group(2).strip() if year_match is not None else ""
+    genre = genre_match.group(2).strip() if genre_match is not None else ""
+    album = album_match.group(2).strip() if album_match is not None else ""
+    title = title_match.group(2).strip() if title_match is not None else ""
+    folder = folder_match.group(2).strip() if folder_match is not None else None
+    track = track_match.group(2).strip() if track_match is not None else ""
+
+    try:
+        year = int(year)
+    except: year = ""
+    try:
+        track = int(track)
+    except: track = ""
+
+    return Metadata(url=url, artist=artist, year=year, genre=genre, album=album, title=title, folder=folder,
+                    track=track)
+
+
+def video_url(rng: random.Random) -> str:
+    video_id = "".join(rng.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-") for _ in range(11))
+    return rng.choice(["https://www.youtube.com/watch?v={}", "https://youtu.be/{}", "youtube.com/watch?v={}&t=42",
+                       "https://m.youtube.com/watch?v={}&list=RD{}"]).format(video_id, video_id)
+
+
+def realistic_messages(count: int) -> list:
+    rng = random.Random(42)
+    chatter = ["this one's a banger", "omg listen to this", "for the road trip", "lol", "ok but the drop at 2:30",
+               "throwback!!", "(the live version is better)", "no skips", "🔥🔥🔥"]
+    tags = ["artist: Daft Punk", "year: 2001", "genre: french house", "album: Discovery", "title: One More Time",
+            "folder: road trip", "track: 1", 'title: "Harder, Better && Faster"', "artist: Simon & Garfunkel"]
+
+    messages = []
+    for _ in range(count):
+        parts = [rng.choice(chatter) + " " + video_url(rng) if rng.random() < 0.5 else video_url(rng)]
+        parts += rng.sample(tags, rng.randint(0, 4))
+        messages.append(" && ".join(parts))
+    return messages
+
+
+def adversarial_messages() -> list:
+    messages = []
+    for length in ADVERSARIAL_PUNCTUATION:
+        messages.append("https://youtu.be/lSooYPG-5Rg" + "!" * length)
+        messages.append("check this out https://www.youtube.com/watch?v=lSooYPG-5Rg" + "." * length + " && folder: x")
+    return messages
+
+
+def measure(parse, messages: list) -> tuple:
+    times = []
+    for message in messages:
+        start = time.perf_counter()
+        parse(message)
+        times.append(time.perf_counter() - start)
+    return sum(times), max(times)
+
+
+def report(name: str, corpus: str, messages: list, parse):
+    total, slowest = measure(parse, messages)
+    print(f"{name:<8} {corpus:<12} messages={len(messages):<5} mean={total / len(messages) * 1e6:12.1f} us"
+          f"  max={slowest * 1e6:14.1f} us")
+
+
+if __name__ == "__main__":
+    realistic = realistic_messages(REALISTIC_MESSAGES)
+    adversarial = adversarial_messages()
+
+    for name, parse in [("new", get_metadata_from_message), ("legacy", legacy_get_metadata_from_message)]:
+        report(name, "realistic", realistic, parse)
+        report(name, "adversarial", adversarial, parse)
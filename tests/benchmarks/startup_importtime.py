@@ -0,0 +1,64 @@
+"""
+Import-time profile of the bot's startup.
+
+Before: 'src.main' imported the handlers, and with them yt-dlp, shazamio, the Google API client, mutagen and magic,
+before the bot started. After: they're imported on a background thread while the bot connects to Telegram.
+Shows the slowest modules of 'import src.main' and, for comparison, of 'import src.handlers', and fails if importing
+'src.main' takes longer than the startup budget.
+Run from the repository root with
+`PYTHONPATH=. python tests/benchmarks/startup_importtime.py [number of modules shown]`.
+"""
+import os
+import subprocess
+import sys
+
+from src.definitions.definitions import ROOT_DIR
+
+SHOWN_MODULES = 15
+
+# Milliseconds 'import src.main' may take. Importing the handlers up front takes several times this.
+STARTUP_IMPORT_BUDGET_MS = int(os.environ.get("STARTUP_IMPORT_BUDGET_MS", 1000))
+
+
+def import_profile(module: str) -> list:
+    """
+    Imports a module on a new interpreter with '-X importtime'.
+    @param module: module to import.
+    @return: list of (self microseconds, cumulative microseconds, module name) tuples, one per imported module.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=ROOT_DIR,
+                            env={**os.environ, 'PYTHONPATH': ROOT_DIR}, capture_output=True, text=True, check=True)
+
+    profile = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if self_time.strip().isdigit():
+            profile.append((int(self_time), int(cumulative), name.strip()))
+
+    return profile
+
+
+def show(module: str, shown: int) -> float:
+    profile = import_profile(module)
+    total = next(cumulative for _, cumulative, name in profile if name == module)
+
+    print("import {}: {:.1f} ms, {} modules".format(module, total / 1000, len(profile)))
+    print("{:>10} {:>10}  module".format("self ms", "total ms"))
+    for self_time, cumulative, name in sorted(profile, key=lambda entry: entry[1], reverse=True)[:shown]:
+        print("{:>10.1f} {:>10.1f}  {}".format(self_time / 1000, cumulative / 1000, name))
+    print()
+
+    return total / 1000
+
+
+if __name__ == "__main__":
+    shown = int(sys.argv[1]) if len(sys.argv) > 1 else SHOWN_MODULES
+
+    main_time = show("src.main", shown)
+    show("src.handlers", shown)
+
+    if main_time > STARTUP_IMPORT_BUDGET_MS:
+        sys.exit("import src.main took {:.1f} ms, over the budget of {} ms.".format(main_time, STARTUP_IMPORT_BUDGET_MS))
+    print("import src.main is within the budget of {} ms.".format(STARTUP_IMPORT_BUDGET_MS))
@@ -0,0 +1,201 @@
+"""
+Replays recorded Telegram updates against the bot on polling and webhook mode, and compares the latency from when an
+update is sent by Telegram to when the bot's first reply to it arrives.
+
+Runs offline - a fake Bot API server hands out the updates (through 'getUpdates' on polling mode, posting them to the
+webhook on webhook mode) and records the 'sendMessage' calls. The bot runs with the real handlers.
+Run from the repository root with
+`PYTHONPATH=. python tests/benchmarks/webhook_replay.py [updates.jsonl] [updates per second]`. The recorded updates
+are one 'Update' JSON per line; by default the bundled '/start' commands from a few chats are replayed.
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+from telegram.ext import Application
+
+from src.main import add_handlers
+from src.webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+TOKEN = "123456:benchmark"
+HOST = "127.0.0.1"
+API_PORT = 8081
+WEBHOOK_PORT = 8082
+
+UPDATES_PATH = os.path.join(os.path.dirname(__file__), "data", "updates.jsonl")
+UPDATES_PER_SECOND = 200
+
+# Telegram posts at most this many updates to a webhook at the same time (the 'max_connections' default)
+WEBHOOK_CONNECTIONS = 40
+
+
+class FakeBotApi:
+    """Bot API server handing out the replayed updates and timing the replies to them."""
+
+    def __init__(self):
+        self.pending = []
+        self.new_updates = asyncio.Event()
+        self.webhook = None
+
+        # chat ID -> times the unanswered updates of the chat were sent
+        self.sent_at = defaultdict(deque)
+        self.latencies = []
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot" + TOKEN + "/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+
+        if method == "getMe":
+            return ok({"id": 1, "is_bot": True, "first_name": "Banger", "username": "banger_bench_bot"})
+
+        if method == "setWebhook":
+            self.webhook = (params['url'], params['secret_token'])
+        elif method == "deleteWebhook":
+            self.webhook = None
+        elif method == "getUpdates":
+            return ok(await self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0))))
+        elif method == "sendMessage":
+            chat_id = int(params['chat_id'])
+            self.latencies.append(time.perf_counter() - self.sent_at[chat_id].popleft())
+            return ok({"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                       "text": params.get('text', '')})
+
+        return ok(True)
+
+    async def get_updates(self, offset: int, timeout: float) -> list:
+        self.pending = [update for update in self.pending if update['update_id'] >= offset]
+        if not self.pending:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return self.pending[:100]
+
+    def send(self, update: dict):
+        self.sent_at[update['message']['chat']['id']].append(time.perf_counter())
+        self.pending.append(update)
+        self.new_updates.set()
+
+
+def ok(result) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
+
+
+def load_updates(path: str) -> list:
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def build_application(webhook: bool) -> Application:
+    builder = Application.builder().token(TOKEN).base_url(f"http://{HOST}:{API_PORT}/bot")
+    if webhook:
+        builder = builder.updater(None)
+
+    application = builder.build()
+    add_handlers(application)
+    return application
+
+
+async def replay(api: FakeBotApi, updates: list, rate: int, post=None):
+    """
+    Sends the updates at 'rate' per second and waits for all replies.
+    @param api: fake Bot API.
+    @param updates: updates to send.
+    @param rate: updates sent per second.
+    @param post: coroutine function posting an update to the webhook. The updates are polled if not given.
+    """
+    api.latencies = []
+    posts = []
+    start = time.perf_counter()
+
+    for i, update in enumerate(updates):
+        await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        if post is None:
+            api.send(update)
+        else:
+            api.sent_at[update['message']['chat']['id']].append(time.perf_counter())
+            posts.append(asyncio.create_task(post(update)))
+
+    await asyncio.gather(*posts)
+    while len(api.latencies) < len(updates):
+        await asyncio.sleep(0.01)
+
+
+async def run_polling(api: FakeBotApi, updates: list, rate: int) -> list:
+    application = build_application(webhook=False)
+
+    async with application:
+        await application.updater.start_polling(poll_interval=0)
+        await application.start()
+
+        await replay(api, updates, rate)
+
+        await application.updater.stop()
+        await application.stop()
+
+    return api.latencies
+
+
+async def run_webhook(api: FakeBotApi, updates: list, rate: int) -> list:
+    application = build_application(webhook=True)
+    server = WebhookServer(application, url=f"http://{HOST}:{WEBHOOK_PORT}", listen=HOST, port=WEBHOOK_PORT)
+
+    async with application:
+        await application.start()
+        await server.start()
+
+        url, secret_token = api.webhook
+        connections = asyncio.Semaphore(WEBHOOK_CONNECTIONS)
+
+        async with aiohttp.ClientSession() as session:
+            async def post(update: dict):
+                async with connections:
+                    async with session.post(url, json=update, headers={SECRET_TOKEN_HEADER: secret_token}) as response:
+                        assert response.status == 200
+
+            await replay(api, updates, rate, post)
+
+        await server.stop()
+        await application.stop()
+
+    return api.latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+    print(f"{name:<8} updates={len(latencies):<5} update to first reply p50={p50:8.2f} ms  p99={p99:8.2f} ms")
+
+
+async def main(path: str, rate: int):
+    updates = load_updates(path)
+
+    api = FakeBotApi()
+    runner = web.AppRunner(api.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, HOST, API_PORT).start()
+
+    try:
+        report("polling", await run_polling(api, updates, rate))
+        report("webhook", await run_webhook(api, updates, rate))
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else UPDATES_PATH,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else UPDATES_PER_SECOND))
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import pytest
+
+from src.cache import AudioCache
+
+
+def make_download(tmp_path, content: bytes = b"audio", calls: list = None, delay: float = 0):
+    """
+    Creates a fake download coroutine function writing 'content' to a new file.
+    @param tmp_path: directory to download to.
+    @param content: content of the downloaded file.
+    @param calls: list the downloads are recorded in.
+    @param delay: seconds the download takes.
+    @return: coroutine function.
+    """
+
+    async def download(report):
+        if calls is not None:
+            calls.append(content)
+
+        report({'status': 'downloading', 'percent': '50%'})
+        await asyncio.sleep(delay)
+
+        path = str(tmp_path / f"download-{len(os.listdir(tmp_path))}.mp3")
+        with open(path, 'wb') as file:
+            file.write(content)
+
+        return path, {'title': content.decode()}
+
+    return download
+
+
+@pytest.mark.asyncio
+async def test_fetch_miss_then_hit(tmp_path):
+    """Normal flow - the file is downloaded once and copied from the cache afterwards."""
+
+    cache = AudioCache(str(tmp_path / "cache"), max_size=1024)
+    calls = []
+
+    first = await cache.fetch("id-mp3", make_download(tmp_path, b"song", calls), str(tmp_path / "first.mp3"))
+    second = await cache.fetch("id-mp3", make_download(tmp_path, b"song", calls), str(tmp_path / "second.mp3"))
+
+    assert calls == [b"song"]
+    assert first == second == {'title': 'song'}
+    assert (tmp_path / "first.mp3").read_bytes() == (tmp_path / "second.mp3").read_bytes() == b"song"
+    assert "id-mp3" in cache
+
+
+@pytest.mark.asyncio
+async def test_fetch_joins_download_in_progress(tmp_path):
+    """Concurrent requests for the same key share one download, and all of them get progress."""
+
+    cache = AudioCache(str(tmp_path / "cache"), max_size=1024)
+    calls = []
+    progress = []
+
+    results = await asyncio.gather(*[
+        cache.fetch("id-mp3", make_download(tmp_path, b"song", calls, delay=0.1), str(tmp_path / f"{i}.mp3"),
+                    on_progress=progress.append)
+        for i in range(3)
+    ])
+
+    assert calls == [b"song"]
+    assert results == [{'title': 'song'}] * 3
+    assert len(progress) == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_download_is_not_cached(tmp_path):
+    """A failed download is raised on every request waiting for it and can be attempted again."""
+
+    cache = AudioCache(str(tmp_path / "cache"), max_size=1024)
+
+    async def failing_download(report):
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        await cache.fetch("id-mp3", failing_download, str(tmp_path / "first.mp3"))
+
+    assert "id-mp3" not in cache
+    assert await cache.fetch("id-mp3", make_download(tmp_path, b"song"), str(tmp_path / "second.mp3"))
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction(tmp_path):
+    """The least recently used entries are evicted when the cache is full."""
+
+    cache = AudioCache(str(tmp_path / "cache"), max_size=10)
+
+    await cache.fetch("a", make_download(tmp_path, b"aaaa"), str(tmp_path / "a.mp3"))
+    await cache.fetch("b", make_download(tmp_path, b"bbbb"), str(tmp_path / "b.mp3"))
+
+    # Using 'a' so 'b' is the least recently used
+    await cache.fetch("a", make_download(tmp_path, b"aaaa"), str(tmp_path / "a.mp3"))
+    await cache.fetch("c", make_download(tmp_path, b"cccc"), str(tmp_path / "c.mp3"))
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.size == 8
+    assert sorted(os.listdir(tmp_path / "cache")) == ["a.json", "a.mp3", "c.json", "c.mp3"]
+
+
+@pytest.mark.asyncio
+async def test_cache_survives_restart(tmp_path):
+    """Cached files are found again by a new cache on the same directory."""
+
+    cache = AudioCache(str(tmp_path / "cache"), max_size=1024)
+    await cache.fetch("id-mp3", make_download(tmp_path, b"song"), str(tmp_path / "first.mp3"))
+
+    calls = []
+    cache = AudioCache(str(tmp_path / "cache"), max_size=1024)
+    metadata = await cache.fetch("id-mp3", make_download(tmp_path, b"song", calls), str(tmp_path / "second.mp3"))
+
+    assert calls == []
+    assert metadata == {'title': 'song'}
+    assert cache.size == 4
@@ -0,0 +1,52 @@
+import src.callbacks
+from src.callbacks import CallbackStore, CallbackRecord, callback_data, parse_callback_data
+from src.models import File, Action
+
+
+def test_callback_store(tmp_path):
+    """Records are found by their key, also by a new store on the same file (e.g. after a restart)."""
+
+    store = CallbackStore(str(tmp_path / "callbacks.sqlite3"))
+    key = store.add(CallbackRecord("sample.mp3", "12345", "audio/mpeg", 15552, "unique", 200))
+
+    assert store.get(key).file_id == "12345"
+    assert store.get("unknown") is None
+
+    store = CallbackStore(str(tmp_path / "callbacks.sqlite3"))
+    file = store.get(key).to_file(Action.SHAZAM)
+
+    assert file == File(Action.SHAZAM, "sample.mp3", "12345", "audio/mpeg", 15552, "unique", 200)
+
+
+def test_callback_store_expiry(tmp_path, mocker):
+    """Records expire after the TTL, from memory and from disk."""
+
+    store = CallbackStore(str(tmp_path / "callbacks.sqlite3"), ttl=10)
+    key = store.add(CallbackRecord("sample.mp3", "12345", "audio/mpeg", 15552))
+
+    time_mock = mocker.patch.object(src.callbacks.time, "time")
+    time_mock.return_value = 10 ** 12
+
+    assert store.get(key) is None
+    assert CallbackStore(str(tmp_path / "callbacks.sqlite3")).get(key) is None
+
+
+def test_callback_store_memory_bound(tmp_path):
+    """Only the most recently used records are kept in memory."""
+
+    store = CallbackStore(str(tmp_path / "callbacks.sqlite3"), max_entries=2)
+    keys = [store.add(CallbackRecord("sample.mp3", str(i), "audio/mpeg", 15552)) for i in range(3)]
+
+    assert list(store._entries) == keys[1:]
+
+    # Evicted records are still found on disk
+    assert store.get(keys[0]).file_id == "0"
+
+
+def test_callback_data():
+    """Callback data fits Telegram's 64 bytes and is parsed back."""
+
+    data = callback_data("k7Fq3x0aZ1w", Action.TRACKLIST)
+
+    assert len(data.encode()) <= 64
+    assert parse_callback_data(data) == ("k7Fq3x0aZ1w", "tracklist")
@@ -1,16 +1,71 @@
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+import httpx
 import pytest
 
 from pytest_mock import MockerFixture
 from unittest.mock import Mock, mock_open, patch, AsyncMock
+from google.auth.exceptions import RefreshError
 from google.oauth2.credentials import Credentials
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, HttpRequest, HttpMockSequence
+from googleapiclient.model import JsonModel
 from datetime import datetime, timedelta
 
 from src.definitions.definitions import AUTH_DIR
+from src.mime import SNIFF_SIZE
+from src.storage import ScratchSpace
 from src.exceptions import GoogleDriveClientSecretNotFound, FileDoesNotExist, GoogleDriveInvalidFileMeta, \
-    GoogleDriveUploadFail, GoogleDriveCreateFolderFail
-from src.services.gdrive import get_creds, upload_to_drive, create_drive_folder, get_drive_folder
+    GoogleDriveUploadFail, GoogleDriveCreateFolderFail, StreamRewindError
+from src.services.gdrive import get_creds, upload_to_drive, create_drive_folder, get_drive_folder, DriveClient, \
+    get_or_create_drive_folder, FolderCache, DriveIndex, rebuild_drive_index, \
+    stream_to_drive, pipe_to_drive, StreamMediaUpload, UploadSessions, ThroughputMeter, DriveBatcher
 import src.services.gdrive
+import src.storage
+
+
+@pytest.fixture(autouse=True)
+def reset_drive_client(tmp_path):
+    """
+    Makes sure every test starts without cached credentials, Drive services, indexed uploads or upload sessions.
+    The test files are tiny, so simple uploads are turned off unless a test turns them on.
+    """
+    src.services.gdrive.drive_client.reset()
+    src.services.gdrive.folder_cache.invalidate()
+    src.services.gdrive._drive_index = DriveIndex(str(tmp_path / "drive.sqlite3"))
+    src.services.gdrive._upload_sessions = UploadSessions(str(tmp_path / "upload_sessions.sqlite3"))
+    src.services.gdrive.upload_meter = ThroughputMeter()
+    simple_upload_max_size = src.services.gdrive.SIMPLE_UPLOAD_MAX_SIZE
+    src.services.gdrive.SIMPLE_UPLOAD_MAX_SIZE = -1
+    yield
+    src.services.gdrive.drive_client.reset()
+    src.services.gdrive.folder_cache.invalidate()
+    src.services.gdrive._drive_index = None
+    src.services.gdrive._upload_sessions = None
+    src.services.gdrive.SIMPLE_UPLOAD_MAX_SIZE = simple_upload_max_size
+
+
+@pytest.fixture
+def scratch_space(mocker, tmp_path) -> ScratchSpace:
+    """Empty scratch space for the uploads that fall back to downloading the file."""
+    scratch = ScratchSpace(str(tmp_path / "scratch"), quota=1024 * 1024)
+    mocker.patch.object(src.storage, "_scratch_space", scratch)
+    return scratch
+
+
+@pytest.fixture
+def audio_file(tmp_path) -> str:
+    path = tmp_path / "mo_bamba.mp3"
+    path.write_bytes(b"audio")
+    return str(path)
 
 
 def mocked_credentials(valid: bool = True, expired: bool = False, refresh_token="refresh_token_XX") -> Mock:
@@ -67,8 +122,8 @@ def mocked_build() -> Mock:
     status_mock = Mock()
     status_mock.progress.return_value = 0.1
 
-    mock_request = Mock()
-    mock_request.next_chunk.return_value = (status_mock, "response")
+    mock_request = Mock(resumable_uri=None, resumable_progress=0)
+    mock_request.next_chunk.return_value = (status_mock, {'id': "file_id", 'webViewLink': "file_link"})
     mock_request.execute.return_value = {
         'id': "random_folder_id_123"
     }
@@ -102,6 +157,8 @@ def mocked_media() -> Mock:
     """
     mock_media = Mock(spec=MediaFileUpload)
     mock_media.stream.close.return_value = None
+    mock_media.resumable.return_value = True
+    mock_media.size.return_value = 5
 
     mock_media_file_upload = Mock(return_value=mock_media)
 
@@ -175,6 +232,69 @@ def test_creds_relogin(mocker: MockerFixture):
     mock_flow.from_client_secrets_file().run_local_server.assert_called_once()
 
 
+# Drive client --------------------------------------
+
+def test_drive_client_reuses_service(mocker: MockerFixture):
+    """Normal flow - credentials are loaded and the service is built only once for several calls."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_get_creds = Mock()
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", mock_get_creds)
+
+    # Running and asserts
+    client = DriveClient(AUTH_DIR, AUTH_DIR)
+    services = [client.service() for _ in range(3)]
+
+    assert all(service is services[0] for service in services)
+    mock_build.assert_called_once()
+    mock_get_creds.assert_called_once()
+
+
+def test_drive_client_refreshes_close_to_expiry(mocker: MockerFixture):
+    """Credentials about to expire are refreshed and written back to the token file."""
+
+    # Setting mocks
+    mock_creds = Mock()
+    mock_creds.valid = True
+    mock_creds.expiry = datetime.utcnow() + timedelta(minutes=1)
+    mock_creds.to_json.return_value = "{}"
+    mocker.patch.object(src.services.gdrive, "build", mocked_build())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock(return_value=mock_creds))
+
+    # Running and asserts
+    client = DriveClient(AUTH_DIR, AUTH_DIR)
+    client.service()
+
+    with patch("builtins.open", mock_open()) as mock_file:
+        client.service()
+
+    mock_creds.refresh.assert_called_once()
+    mock_file.assert_called_once_with(AUTH_DIR, 'w')
+
+
+def test_drive_client_no_refresh_when_valid(mocker: MockerFixture):
+    """Valid credentials far from expiry are neither refreshed nor written to disk."""
+
+    # Setting mocks
+    mock_creds = Mock()
+    mock_creds.valid = True
+    mock_creds.expiry = datetime.utcnow() + timedelta(hours=1)
+    mocker.patch.object(src.services.gdrive, "build", mocked_build())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock(return_value=mock_creds))
+
+    # Running and asserts
+    client = DriveClient(AUTH_DIR, AUTH_DIR)
+    client.service()
+
+    with patch("builtins.open", mock_open()) as mock_file:
+        client.service()
+
+    mock_creds.refresh.assert_not_called()
+    mock_file.assert_not_called()
+
+
 # Upload to drive --------------------------------------
 
 @pytest.mark.asyncio
@@ -210,7 +330,7 @@ async def test_upload_file_error(mocker):
 
 
 @pytest.mark.asyncio
-async def test_upload_file_normal(mocker: MockerFixture):
+async def test_upload_file_normal(mocker: MockerFixture, audio_file):
     """Normal flow - uploads file to Google Drive."""
 
     # Setting mocks
@@ -231,7 +351,7 @@ async def test_upload_file_normal(mocker: MockerFixture):
 
     # Running and asserts
     with patch("os.remove"):
-        await upload_to_drive(AUTH_DIR, "mo_bamba", "audio/mpeg", mock_message)
+        await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", mock_message)
 
     mock_build.assert_called_once()
     mock_media.assert_called_once()
@@ -244,7 +364,7 @@ async def test_upload_file_normal(mocker: MockerFixture):
 
 
 @pytest.mark.asyncio
-async def test_upload_file_normal_create_folder(mocker: MockerFixture):
+async def test_upload_file_normal_create_folder(mocker: MockerFixture, audio_file):
     """Normal flow - uploads file to Google Drive (and creates folder along the way)"""
 
     # Setting mocks
@@ -265,7 +385,7 @@ async def test_upload_file_normal_create_folder(mocker: MockerFixture):
 
     # Running and asserts
     with patch("os.remove"):
-        await upload_to_drive(AUTH_DIR, "mo_bamba", "audio/mpeg", mock_message, destination_folder="tag")
+        await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", mock_message, destination_folder="tag")
 
     mock_build.assert_called_once()
     mock_media.assert_called_once()
@@ -278,7 +398,698 @@ async def test_upload_file_normal_create_folder(mocker: MockerFixture):
     mock_message.edit_text.assert_called()
 
 
+@pytest.mark.asyncio
+async def test_upload_file_does_not_block_event_loop(mocker: MockerFixture, audio_file):
+    """The blocking chunk uploads run off the event loop, so other coroutines keep running meanwhile."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    status_mock = Mock()
+    status_mock.progress.return_value = 0.5
+
+    responses = iter([None, None, None, {'id': "file_id"}])
+
+    def slow_next_chunk(num_retries=0):
+        time.sleep(0.05)
+        return status_mock, next(responses)
+
+    mock_request = mock_build.return_value.files.return_value.create.return_value
+    mock_request.next_chunk.side_effect = slow_next_chunk
+
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mock_message = AsyncMock()
+
+    # Counting event loop ticks while the upload is in flight
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.005)
+
+    ticker_task = asyncio.create_task(ticker())
+
+    # Running and asserts
+    with patch("os.remove"):
+        await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", mock_message)
+    ticker_task.cancel()
+
+    assert mock_request.next_chunk.call_count == 4
+    assert ticks > 10
+
+
+
+@pytest.mark.asyncio
+async def test_upload_file_sets_app_properties(mocker: MockerFixture, audio_file):
+    """Uploaded files are tagged with their content hash and video ID, and indexed."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    # Running and asserts
+    with patch("os.remove"):
+        drive_file = await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", AsyncMock(), video_id="video_id")
+
+    assert (drive_file.file_id, drive_file.link, drive_file.existing) == ("file_id", "file_link", False)
+
+    app_properties = mock_build.return_value.files.return_value.create.call_args.kwargs['body']['appProperties']
+    assert app_properties['bangerBot'] == '1'
+    assert app_properties['bangerYoutubeId'] == "video_id"
+    assert app_properties['bangerHash'] == hashlib.sha256(b"audio").hexdigest()
+
+    assert src.services.gdrive.get_drive_index().get(["youtube:video_id"], '').file_id == "file_id"
+
+
+@pytest.mark.asyncio
+async def test_upload_file_skips_existing(mocker: MockerFixture, audio_file):
+    """A file already uploaded to the folder is not uploaded again."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_build.return_value.files.return_value.get.return_value.execute.return_value = {
+        'id': "file_id", 'webViewLink': "file_link", 'trashed': False
+    }
+    mock_message = AsyncMock()
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    src.services.gdrive.get_drive_index().add(["sha256:" + hashlib.sha256(b"audio").hexdigest()], '', "file_id",
+                                              "file_link")
+
+    # Running and asserts
+    with patch("os.remove") as mock_remove:
+        drive_file = await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", mock_message)
+
+    assert drive_file.existing
+    assert drive_file.file_id == "file_id"
+    mock_build.return_value.files.return_value.create.assert_not_called()
+    mock_remove.assert_called_once_with(audio_file)
+    assert "already on Google Drive" in mock_message.edit_text.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_upload_file_reuploads_deleted(mocker: MockerFixture, audio_file):
+    """An indexed file that was deleted from Google Drive is uploaded again."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_build.return_value.files.return_value.get.return_value.execute.return_value = {
+        'id': "old_file_id", 'trashed': True
+    }
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    src.services.gdrive.get_drive_index().add(["youtube:video_id"], '', "old_file_id", "old_link")
+
+    # Running and asserts
+    with patch("os.remove"):
+        drive_file = await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", AsyncMock(), video_id="video_id")
+
+    assert not drive_file.existing
+    mock_build.return_value.files.return_value.create.assert_called_once()
+    assert src.services.gdrive.get_drive_index().get(["youtube:video_id"], '').file_id == "file_id"
+
+
+@pytest.mark.asyncio
+async def test_upload_file_simple_upload(mocker: MockerFixture, audio_file):
+    """Small files are uploaded in a single request."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_media = mocked_media()
+    mock_request = mock_build.return_value.files.return_value.create.return_value
+    mock_request.execute.return_value = {'id': "file_id", 'webViewLink': "file_link"}
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mock_media)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mocker.patch.object(src.services.gdrive, "SIMPLE_UPLOAD_MAX_SIZE", 1024)
+    mock_media.return_value.resumable.return_value = False
+
+    # Running and asserts
+    with patch("os.remove"):
+        drive_file = await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", AsyncMock())
+
+    assert drive_file.file_id == "file_id"
+    assert mock_media.call_args.kwargs['resumable'] is False
+    mock_request.execute.assert_called_once()
+    mock_request.next_chunk.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_upload_file_resumes_session(mocker: MockerFixture, audio_file):
+    """An interrupted upload continues on its upload session, which is forgotten once the upload is done."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_request = mock_build.return_value.files.return_value.create.return_value
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    session_key = "sha256:" + hashlib.sha256(b"audio").hexdigest() + "//mo_bamba"
+    src.services.gdrive.get_upload_sessions().add(session_key, "https://upload/session")
+
+    # Google Drive got the first 3 bytes
+    mock_request.http.request.return_value = (httplib2.Response({'status': 308, 'range': "bytes=0-2"}), b"")
+
+    def next_chunk(num_retries=0):
+        assert mock_request.resumable_uri == "https://upload/session"
+        assert mock_request.resumable_progress == 3
+        return Mock(progress=Mock(return_value=1)), {'id': "file_id", 'webViewLink': "file_link"}
+
+    mock_request.next_chunk.side_effect = next_chunk
+
+    # Running and asserts
+    with patch("os.remove"):
+        drive_file = await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", AsyncMock())
+
+    assert drive_file.file_id == "file_id"
+    assert src.services.gdrive.get_upload_sessions().get(session_key) is None
+
+
+@pytest.mark.asyncio
+async def test_upload_file_restarts_expired_session(mocker: MockerFixture, audio_file):
+    """The upload starts over if its stored upload session is gone."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_files = mock_build.return_value.files.return_value
+    expired_request = Mock(resumable_uri=None, resumable_progress=0)
+    expired_request.http.request.return_value = (httplib2.Response({'status': 404}), b"")
+    new_request = mocked_build().return_value.files.return_value.create.return_value
+    mock_files.create.side_effect = [expired_request, new_request]
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    session_key = "sha256:" + hashlib.sha256(b"audio").hexdigest() + "//mo_bamba"
+    src.services.gdrive.get_upload_sessions().add(session_key, "https://upload/expired")
+
+    # Running and asserts
+    with patch("os.remove"):
+        drive_file = await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", AsyncMock())
+
+    assert drive_file.file_id == "file_id"
+    assert mock_files.create.call_count == 2
+    new_request.next_chunk.assert_called_once()
+    assert src.services.gdrive.get_upload_sessions().get(session_key) is None
+
+
+@pytest.mark.asyncio
+async def test_upload_file_keeps_session_on_failure(mocker: MockerFixture, audio_file):
+    """The upload session of a failed upload is kept, to be resumed."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_request = mock_build.return_value.files.return_value.create.return_value
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mocked_media())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    def next_chunk(num_retries=0):
+        # The session is started, but the chunk fails
+        mock_request.resumable_uri = "https://upload/session"
+        raise HttpError(Mock(status=500), b"")
+
+    mock_request.next_chunk.side_effect = next_chunk
+
+    # Running and asserts
+    with pytest.raises(GoogleDriveUploadFail), patch("os.remove"):
+        await upload_to_drive(audio_file, "mo_bamba", "audio/mpeg", AsyncMock())
+
+    session_key = "sha256:" + hashlib.sha256(b"audio").hexdigest() + "//mo_bamba"
+    assert src.services.gdrive.get_upload_sessions().get(session_key) == "https://upload/session"
+
+
+class RecordingHttp(HttpMockSequence):
+    """Sequence of fake HTTP responses that records the requests it answers."""
+
+    def __init__(self, responses: list):
+        super().__init__(responses)
+        self.requests = []
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        self.requests.append((uri, method, body, headers))
+        return super().request(uri, method, body, headers, *args, **kwargs)
+
+
+def real_upload_request(http, content: bytes) -> tuple:
+    media = MediaIoBaseUpload(io.BytesIO(content), mimetype="audio/mpeg", chunksize=256 * 1024, resumable=True)
+    request = HttpRequest(http, JsonModel().response, "https://upload/files", method="POST", resumable=media)
+    return request, media
+
+
+def test_resume_upload_real_request():
+    """A real upload request resumed on a stored session sends the bytes Google Drive is missing."""
+    http = RecordingHttp([
+        ({'status': "308", 'range': "bytes=0-3"}, b""),
+        ({'status': "200"}, b'{"id": "file_id"}'),
+    ])
+    request, media = real_upload_request(http, b"audio file")
+
+    assert src.services.gdrive._resume_upload(request, media, "https://upload/session") is None
+    status, response = request.next_chunk()
+
+    assert response == {'id': "file_id"}
+    (probe_uri, probe_method, _, probe_headers), (uri, method, body, headers) = http.requests
+    assert (probe_uri, probe_method, probe_headers['Content-Range']) == ("https://upload/session", "PUT", "bytes */10")
+    assert (uri, method) == ("https://upload/session", "PUT")
+    assert headers['Content-Range'] == "bytes 4-9/10"
+    assert bytes(body.read() if hasattr(body, 'read') else body) == b"o file"
+
+
+def test_resume_upload_already_complete():
+    """The probe gives the response when Google Drive already got the whole file."""
+    http = RecordingHttp([({'status': "200"}, b'{"id": "file_id"}')])
+    request, media = real_upload_request(http, b"audio")
+
+    assert src.services.gdrive._resume_upload(request, media, "https://upload/session") == {'id': "file_id"}
+
+
+def test_resume_upload_expired_session():
+    http = RecordingHttp([({'status': "404"}, b"")])
+    request, media = real_upload_request(http, b"audio")
+
+    with pytest.raises(HttpError):
+        src.services.gdrive._resume_upload(request, media, "https://upload/session")
+
+
+def test_upload_sessions_expire(tmp_path):
+    """Upload sessions are forgotten once they expire."""
+    sessions = UploadSessions(str(tmp_path / "sessions.sqlite3"), ttl=-1)
+    sessions.add("key", "https://upload/session")
+
+    assert sessions.get("key") is None
+
+
+def test_throughput_meter_chunk_size():
+    """Chunks are sized to the measured throughput, in multiples of 256 KB and within the bounds."""
+    meter = ThroughputMeter(target_seconds=2, min_size=256 * 1024, max_size=8 * 1024 * 1024,
+                            initial_size=1024 * 1024)
+    assert meter.chunk_size() == 1024 * 1024
+
+    # 1.1 MB/s for 2 seconds, rounded down
+    meter.record(1100 * 1024, 1)
+    assert meter.chunk_size() == 2048 * 1024
+
+    slow_meter = ThroughputMeter(target_seconds=2, min_size=256 * 1024, max_size=8 * 1024 * 1024)
+    slow_meter.record(10 * 1024, 1)
+    assert slow_meter.chunk_size() == 256 * 1024
+
+    fast_meter = ThroughputMeter(target_seconds=2, min_size=256 * 1024, max_size=8 * 1024 * 1024)
+    fast_meter.record(100 * 1024 * 1024, 1)
+    assert fast_meter.chunk_size() == 8 * 1024 * 1024
+
+
+def test_drive_index_is_per_folder(tmp_path):
+    """The same file can be in different folders."""
+
+    index = DriveIndex(str(tmp_path / "index.sqlite3"))
+    index.add(["sha256:hash"], "folder_a", "file_a", "link_a")
+
+    assert index.get(["sha256:hash"], "folder_a").file_id == "file_a"
+    assert index.get(["sha256:hash"], "folder_b") is None
+    assert index.get(["youtube:id", "sha256:hash"], "folder_a").file_id == "file_a"
+
+    index.remove("file_a")
+    assert index.is_empty()
+
+
+def test_rebuild_drive_index(mocker: MockerFixture):
+    """The index is rebuilt from the 'appProperties' of the files on Google Drive."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_build.return_value.files.return_value.list.return_value.execute.side_effect = [
+        {'files': [{'id': "file_a", 'webViewLink': "link_a",
+                    'appProperties': {'bangerBot': '1', 'bangerHash': "hash_a", 'bangerFolder': "folder_id"}}],
+         'nextPageToken': "page_2"},
+        {'files': [{'id': "file_b", 'webViewLink': "link_b",
+                    'appProperties': {'bangerBot': '1', 'bangerHash': "hash_b", 'bangerYoutubeId': "video_b"}}]},
+    ]
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    index = src.services.gdrive.get_drive_index()
+    index.add(["sha256:stale"], '', "stale_file", "stale_link")
+
+    # Running and asserts
+    assert rebuild_drive_index() == 2
+
+    assert index.get(["sha256:hash_a"], "folder_id").file_id == "file_a"
+    assert index.get(["youtube:video_b"], '').file_id == "file_b"
+    assert index.get(["sha256:hash_b"], '').file_id == "file_b"
+    assert index.get(["sha256:stale"], '') is None
+    assert "appProperties has" in mock_build.return_value.files.return_value.list.call_args.kwargs['q']
+
+
+# Stream to drive --------------------------------------
+def mocked_stream(content: bytes, read_size: int = 3) -> Mock:
+    """
+    Mocks 'httpx.stream', returning a response streaming 'content'.
+    @param content: content of the response.
+    @param read_size: bytes in each chunk of the response.
+    @return: mocked 'httpx.stream' function.
+    """
+
+    @contextlib.contextmanager
+    def stream(method, url, **kwargs):
+        response = Mock()
+        response.iter_bytes.return_value = iter([content[i:i + read_size] for i in range(0, len(content), read_size)])
+        yield response
+
+    return Mock(side_effect=stream)
+
+
+def test_stream_media_upload_keeps_one_chunk():
+    """Only the chunk being uploaded can be read again."""
+
+    media = StreamMediaUpload(iter([b"abc", b"defg", b"h"]), 8, "audio/mpeg", chunksize=4)
+
+    assert media.getbytes(0, 4) == b"abcd"
+    assert media.getbytes(0, 4) == b"abcd"
+    assert media.getbytes(4, 4) == b"efgh"
+    assert media.getbytes(8, 4) == b""
+
+    with pytest.raises(StreamRewindError):
+        media.getbytes(0, 4)
+
+    assert media.hexdigest() == hashlib.sha256(b"abcdefgh").hexdigest()
+
+
+def test_stream_media_upload_unknown_size():
+    """The size of a stream of unknown size is found before its last chunk is sent, even if that chunk is full."""
+
+    media = StreamMediaUpload(iter([b"ab", b"cd", b"ef", b"gh"]), None, "audio/mpeg", chunksize=4)
+
+    assert media.size() is None
+    assert media.getbytes(0, 4) == b"abcd"
+    assert media.size() == 8
+    assert media.getbytes(4, 4) == b"efgh"
+    assert media.hexdigest() == hashlib.sha256(b"abcdefgh").hexdigest()
+
+
+def test_stream_media_upload_sniffs_mimetype():
+    """Streams without a specific mimetype are sniffed from their first bytes, which are still uploaded."""
+
+    media = StreamMediaUpload(iter([b"%PDF-", b"1.4\n", bytes(SNIFF_SIZE)]), None, None, chunksize=SNIFF_SIZE)
+
+    assert media.mimetype() == "application/pdf"
+    assert media.getbytes(0, 9) == b"%PDF-1.4\n"
+
+    media = StreamMediaUpload(iter([b"audio"]), 5, "application/octet-stream", chunksize=4)
+    media.getbytes(0, 4)
+    media.getbytes(4, 4)
+
+    assert media.mimetype() == "application/octet-stream"
+
+
+@pytest.mark.asyncio
+async def test_pipe_to_drive(mocker: MockerFixture):
+    """A file is uploaded as it's produced, with the content hash added to its properties at the end."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_files = mock_build.return_value.files.return_value
+    uploaded = []
+
+    def next_chunk(num_retries=0):
+        media = mock_files.create.call_args.kwargs['media_body']
+        media.size()
+        uploaded.append(media.getbytes(len(b"".join(uploaded)), media.chunksize()))
+        return None, {'id': "file_id", 'webViewLink': "file_link"}
+
+    mock_files.create.return_value.next_chunk.side_effect = next_chunk
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    @contextlib.contextmanager
+    def open_stream():
+        yield iter([b"au", b"dio"])
+
+    mock_message = AsyncMock()
+    on_progress = mocker.spy(src.services.gdrive.ProgressReporter, "post")
+
+    # Running and asserts
+    drive_file = await pipe_to_drive(open_stream, 10, "mo_bamba", "audio/mpeg", mock_message, video_id="video_id")
+
+    content_hash = hashlib.sha256(b"audio").hexdigest()
+    assert drive_file.file_id == "file_id"
+    assert uploaded == [b"audio"]
+    assert mock_files.create.call_args.kwargs['body']['appProperties']['bangerYoutubeId'] == "video_id"
+    assert mock_files.update.call_args.kwargs == {'fileId': "file_id", 'body': {'appProperties': {
+        'bangerHash': content_hash}}}
+    assert src.services.gdrive.get_drive_index().get(["sha256:" + content_hash], '').file_id == "file_id"
+
+    # 'au' is 2 of the 10 expected bytes, 'audio' half of them
+    texts = [call.args[1] for call in on_progress.call_args_list]
+    assert any(text.endswith("Uploading to Google Drive: 20%") for text in texts)
+    assert any(text.endswith("Uploading to Google Drive: 50%") for text in texts)
+
+
+@pytest.mark.asyncio
+async def test_pipe_to_drive_skips_existing(mocker: MockerFixture):
+    """The file isn't produced if the video is already on Google Drive."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_build.return_value.files.return_value.get.return_value.execute.return_value = {
+        'id': "old_file_id", 'webViewLink': "old_link"
+    }
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    open_stream = Mock()
+
+    src.services.gdrive.get_drive_index().add(["youtube:video_id"], '', "old_file_id", "old_link")
+
+    # Running and asserts
+    drive_file = await pipe_to_drive(open_stream, 10, "mo_bamba", "audio/mpeg", AsyncMock(), video_id="video_id")
+
+    assert drive_file.existing
+    open_stream.assert_not_called()
+    mock_build.return_value.files.return_value.create.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_stream_to_drive(mocker: MockerFixture, scratch_space):
+    """Normal flow - the file is streamed to Google Drive without saving it locally."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_files = mock_build.return_value.files.return_value
+    uploaded = []
+
+    def next_chunk(num_retries=0):
+        media = mock_files.create.call_args.kwargs['media_body']
+        uploaded.append(media.getbytes(len(b"".join(uploaded)), media.chunksize()))
+        return Mock(progress=Mock(return_value=0.5)), {'id': "file_id", 'webViewLink': "file_link"}
+
+    mock_files.create.return_value.next_chunk.side_effect = next_chunk
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mocker.patch.object(src.services.gdrive.httpx, "stream", mocked_stream(b"audio"))
+
+    # Running and asserts
+    drive_file = await stream_to_drive("https://telegram/file", 5, "mo_bamba", "audio/mpeg", AsyncMock(),
+                                       telegram_id="unique_id")
+
+    assert drive_file.file_id == "file_id"
+    assert uploaded == [b"audio"]
+    assert scratch_space.usage()['jobs'] == 0
+    assert os.listdir(scratch_space.directory) == []
+    assert mock_files.create.call_args.kwargs['body']['appProperties']['bangerTelegramId'] == "unique_id"
+    assert src.services.gdrive.get_drive_index().get(["telegram:unique_id"], '').file_id == "file_id"
+    assert src.services.gdrive.get_drive_index().get(["sha256:" + hashlib.sha256(b"audio").hexdigest()], '')
+
+
+@pytest.mark.asyncio
+async def test_stream_to_drive_simple_upload(mocker: MockerFixture, tmp_path):
+    """Small streamed files are read whole and uploaded in a single request."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_request = mock_build.return_value.files.return_value.create.return_value
+    mock_request.execute.return_value = {'id': "file_id", 'webViewLink': "file_link"}
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mocker.patch.object(src.services.gdrive.httpx, "stream", mocked_stream(b"audio"))
+    mocker.patch.object(src.services.gdrive, "SIMPLE_UPLOAD_MAX_SIZE", 1024)
+
+    # Running and asserts
+    drive_file = await stream_to_drive("https://telegram/file", 5, "mo_bamba", "audio/mpeg", AsyncMock(),
+                                       telegram_id="unique_id")
+
+    assert drive_file.file_id == "file_id"
+    mock_request.execute.assert_called_once()
+    mock_request.next_chunk.assert_not_called()
+    media = mock_build.return_value.files.return_value.create.call_args.kwargs['media_body']
+    assert media.getbytes(0, 5) == b"audio"
+    assert src.services.gdrive.get_drive_index().get(["sha256:" + hashlib.sha256(b"audio").hexdigest()], '')
+
+
+@pytest.mark.asyncio
+async def test_stream_to_drive_unknown_mime_type(mocker: MockerFixture, tmp_path):
+    """Files without a MIME type are sniffed from the streamed bytes."""
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_request = mock_build.return_value.files.return_value.create.return_value
+    mock_request.execute.return_value = {'id': "file_id", 'webViewLink': "file_link"}
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mocker.patch.object(src.services.gdrive.httpx, "stream", mocked_stream(b"%PDF-1.4\n"))
+    mocker.patch.object(src.services.gdrive, "SIMPLE_UPLOAD_MAX_SIZE", 1024)
+
+    # Running and asserts
+    await stream_to_drive("https://telegram/file", 9, "mo_bamba", None, AsyncMock())
+
+    media = mock_build.return_value.files.return_value.create.call_args.kwargs['media_body']
+    assert media.mimetype() == "application/pdf"
+
+
+@pytest.mark.asyncio
+async def test_stream_to_drive_falls_back_to_disk(mocker: MockerFixture, scratch_space):
+    """
+    The file is downloaded and uploaded from disk when the stream has to be read again, and the stream's upload session
+    is forgotten.
+    """
+
+    # Setting mocks
+    mock_build = mocked_build()
+    mock_files = mock_build.return_value.files.return_value
+    mock_media = mocked_media()
+
+    def next_chunk(num_retries=0):
+        media = mock_files.create.call_args.kwargs['media_body']
+        if isinstance(media, StreamMediaUpload):
+            # The server lost the first chunk after the second one was read, once the stream's session was started
+            mock_files.create.return_value.resumable_uri = "https://upload/session"
+            media.getbytes(0, 3)
+            media.getbytes(3, 3)
+            media.getbytes(0, 3)
+        return Mock(progress=Mock(return_value=0.5)), {'id': "file_id", 'webViewLink': "file_link"}
+
+    mock_files.create.return_value.next_chunk.side_effect = next_chunk
+    mocker.patch.object(src.services.gdrive, "build", mock_build)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mocker.patch.object(src.services.gdrive, "MediaFileUpload", mock_media)
+    mocker.patch.object(src.services.gdrive.httpx, "stream", mocked_stream(b"audio_file"))
+    reserved = []
+    job = scratch_space.job
+    mocker.patch.object(scratch_space, "job", lambda size=None: reserved.append(size) or job(size))
+
+    # Running and asserts
+    drive_file = await stream_to_drive("https://telegram/file", 10, "mo_bamba", "audio/mpeg", AsyncMock(),
+                                       telegram_id="unique_id")
+
+    assert drive_file.file_id == "file_id"
+    assert mock_files.create.call_count == 2
+    assert reserved == [10]
+    assert mock_media.call_args.args[0].startswith(scratch_space.directory)
+    assert not os.path.exists(mock_media.call_args.args[0])
+    assert scratch_space.usage()['jobs'] == 0
+    assert src.services.gdrive.get_upload_sessions().get("telegram:unique_id//mo_bamba") is None
+
+
+@pytest.mark.asyncio
+async def test_stream_to_drive_error(mocker: MockerFixture, tmp_path):
+    """Erroring when the file can't be downloaded."""
+
+    mocker.patch.object(src.services.gdrive, "build", mocked_build())
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+    mocker.patch.object(src.services.gdrive.httpx, "stream", Mock(side_effect=httpx.ConnectError("fail")))
+
+    with pytest.raises(GoogleDriveUploadFail):
+        await stream_to_drive("https://telegram/file", 10, "mo_bamba", "audio/mpeg", AsyncMock())
+
+
 # Create folder --------------------------------------
+class FakeBatch:
+    """Batch request answering each request with its own body, or failing the ones whose body is an exception."""
+
+    def __init__(self, sent: list):
+        self._requests = []
+        self._sent = sent
+
+    def add(self, request, callback):
+        self._requests.append((request, callback))
+
+    def execute(self):
+        self._sent.append([request for request, _ in self._requests])
+        for i, (request, callback) in enumerate(self._requests):
+            if isinstance(request, Exception):
+                callback(str(i), None, request)
+            else:
+                callback(str(i), request, None)
+
+
+def test_drive_batcher_single_request(mocker: MockerFixture):
+    """A request on its own is sent without batching."""
+    mock_service = Mock()
+    mocker.patch.object(src.services.gdrive, "get_drive_service", Mock(return_value=mock_service))
+    batcher = DriveBatcher(interval=0)
+
+    response = batcher.execute(lambda service: service.files().get(fileId="file_id"))
+
+    assert response == mock_service.files.return_value.get.return_value.execute.return_value
+    mock_service.new_batch_http_request.assert_not_called()
+
+
+def test_drive_batcher_groups_requests(mocker: MockerFixture):
+    """Requests made at the same time are sent in one batch, once it's full, and each caller gets its own response."""
+    sent = []
+    mock_service = Mock()
+    mock_service.new_batch_http_request.side_effect = lambda: FakeBatch(sent)
+    mocker.patch.object(src.services.gdrive, "get_drive_service", Mock(return_value=mock_service))
+
+    # The batch is full well before the interval is over
+    batcher = DriveBatcher(interval=10, max_size=3)
+    error = ValueError("not found")
+    bodies = ["first", "second", error]
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = list(executor.map(lambda body: batcher.submit(lambda service: body), bodies))
+
+    assert futures[0].result(timeout=5) == "first"
+    assert futures[1].result(timeout=5) == "second"
+    assert futures[2].exception(timeout=5) is error
+    assert len(sent) == 1 and sorted(map(str, sent[0])) == sorted(map(str, bodies))
+    assert time.monotonic() - start < 5
+
+
+def test_drive_batcher_sends_after_interval(mocker: MockerFixture):
+    """A batch that isn't full is sent once the interval is over."""
+    mock_service = Mock()
+    mocker.patch.object(src.services.gdrive, "get_drive_service", Mock(return_value=mock_service))
+    batcher = DriveBatcher(interval=0.05, max_size=100)
+
+    future = batcher.submit(lambda service: service.files().create(body={}))
+
+    assert future.done()
+    mock_service.files.return_value.create.return_value.execute.assert_called_once()
+
+
+def test_drive_batcher_service_error(mocker: MockerFixture):
+    """Every caller of a batch gets the error when the Drive service can't be built, instead of waiting forever."""
+    error = RefreshError("token expired")
+    mocker.patch.object(src.services.gdrive, "get_drive_service", Mock(side_effect=error))
+    batcher = DriveBatcher(interval=10, max_size=3)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = list(executor.map(lambda _: batcher.submit(lambda service: None), range(3)))
+
+    assert all(future.exception(timeout=5) is error for future in futures)
+
+
 def test_create_folder(mocker: MockerFixture):
     """Normal flow - creates a new folder without parent"""
 
@@ -351,3 +1162,125 @@ def test_get_drive_folder_not_found(mocker: MockerFixture):
     folder_id = get_drive_folder("not_found")
 
     assert folder_id is None
+
+
+def test_get_drive_folder_filters_by_name(mocker: MockerFixture):
+    """The folder name (and parent) are filtered on the server and the result is cached."""
+
+    # Setting mocks
+    build_mock = mocked_build()
+
+    mocker.patch.object(src.services.gdrive, "build", build_mock)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    # Running and asserts
+    folder_id = get_drive_folder("folder_name", "parent_id")
+    cached_folder_id = get_drive_folder("folder_name", "parent_id")
+
+    list_mock = build_mock.return_value.files.return_value.list
+    list_mock.assert_called_once()
+    assert "name='folder_name'" in list_mock.call_args.kwargs['q']
+    assert "'parent_id' in parents" in list_mock.call_args.kwargs['q']
+    assert folder_id == cached_folder_id == "folder_id"
+
+
+def test_get_drive_folder_escapes_name(mocker: MockerFixture):
+    """Quotes in folder names are escaped in the query."""
+
+    # Setting mocks
+    build_mock = mocked_build()
+
+    mocker.patch.object(src.services.gdrive, "build", build_mock)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    # Running and asserts
+    get_drive_folder("rock 'n' roll")
+
+    list_mock = build_mock.return_value.files.return_value.list
+    assert "name='rock \\'n\\' roll'" in list_mock.call_args.kwargs['q']
+
+
+def test_create_folder_fills_cache(mocker: MockerFixture):
+    """Created folders are found without querying Google Drive."""
+
+    # Setting mocks
+    build_mock = mocked_build()
+
+    mocker.patch.object(src.services.gdrive, "build", build_mock)
+    mocker.patch.object(src.services.gdrive, "get_creds", Mock())
+
+    # Running and asserts
+    folder_id = create_drive_folder("new_folder")
+
+    assert get_drive_folder("new_folder") == folder_id
+    build_mock.return_value.files.return_value.list.assert_not_called()
+
+
+def test_get_or_create_drive_folder_concurrently(mocker: MockerFixture):
+    """Concurrent lookups of a new folder only create it once."""
+
+    # Setting mocks
+    created = []
+
+    def slow_create(folder_name, parent_id=None):
+        time.sleep(0.05)
+        created.append(folder_name)
+        src.services.gdrive.folder_cache.set(folder_name, "id_123", parent_id)
+        return "id_123"
+
+    mocker.patch.object(src.services.gdrive, "get_drive_folder",
+                        lambda folder_name, parent_id=None: src.services.gdrive.folder_cache.get(folder_name, parent_id))
+    mocker.patch.object(src.services.gdrive, "create_drive_folder", slow_create)
+
+    # Running and asserts
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        folder_ids = list(executor.map(lambda _: get_or_create_drive_folder("tag"), range(4)))
+
+    assert folder_ids == ["id_123"] * 4
+    assert created == ["tag"]
+    assert src.services.gdrive.folder_cache._locks == {}
+
+
+def test_folder_cache_expiry_and_invalidation():
+    """Cache entries expire after the TTL and can be invalidated."""
+
+    cache = FolderCache(ttl=-1)
+    cache.set("folder", "id_1")
+    assert cache.get("folder") is None
+
+    cache = FolderCache(ttl=60)
+    cache.set("folder", "id_1")
+    cache.set("folder", "id_2", parent_id="parent")
+    assert cache.get("folder") == "id_1"
+    assert cache.get("folder", "parent") == "id_2"
+
+    cache.invalidate("folder")
+    assert cache.get("folder") is None
+    assert cache.get("folder", "parent") == "id_2"
+
+    cache.invalidate()
+    assert cache.get("folder", "parent") is None
+
+
+def test_folder_cache_locks():
+    """A folder's lock is shared by the threads that want it, and dropped once none of them does."""
+
+    cache = FolderCache()
+    acquired = threading.Event()
+
+    def hold_lock():
+        with cache.lock("folder"):
+            acquired.set()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with cache.lock("folder"):
+            waiting = executor.submit(hold_lock)
+            assert not acquired.wait(0.05)
+
+            with cache.lock("folder", parent_id="parent"):
+                assert len(cache._locks) == 2
+
+        waiting.result(timeout=1)
+
+    assert acquired.is_set()
+    assert cache._locks == {}
@@ -1,12 +1,80 @@
+import asyncio
+import threading
+from dataclasses import asdict
+
 import pytest
 
 from unittest.mock import Mock, AsyncMock
 
-from src.exceptions import YoutubeAudioDownloadFail, GoogleDriveUploadFail, TrackNotFound
-from src.models import YoutubeTrack, File, Action, ShazamTrack
+from src.exceptions import YoutubeAudioDownloadFail, GoogleDriveUploadFail, TrackNotFound, AudioDecodeFail, \
+    TaskRateLimited, TaskDeferred
+from src.models import YoutubeTrack, YoutubeSource, File, Action, ShazamTrack, Metadata, DriveFile, TracklistEntry
 from src.main import start_handler, help_handler
 import src.handlers
-from src.handlers import url_handler, audio_file_handler_button, audio_file_handler
+import src.callbacks
+import src.storage
+import src.tasks
+from src.callbacks import CallbackStore, CallbackRecord, get_callback_store
+from src.storage import ScratchSpace
+from src.tasks import Checkpoints, FairSlots, TokenBuckets, TaskQueue, TaskWorkers
+from src.handlers import url_handler, audio_file_handler_button, audio_file_handler, youtube_task, \
+    youtube_task_failed, drive_upload_task, youtube_batch_task, youtube_playlist_task, YOUTUBE_TASK, \
+    DRIVE_UPLOAD_TASK, YOUTUBE_BATCH_TASK, YOUTUBE_PLAYLIST_TASK, TRACKLIST_TASK, tracklist_task, format_tracklist
+
+
+@pytest.fixture(autouse=True)
+def scratch_space(mocker, tmp_path):
+    """Empty scratch space for each test."""
+    scratch = ScratchSpace(str(tmp_path / "scratch"), quota=1024 * 1024 * 1024)
+    mocker.patch.object(src.storage, "_scratch_space", scratch)
+    return scratch
+
+
+@pytest.fixture(autouse=True)
+def callback_store(mocker, tmp_path):
+    """Empty store of button records for each test."""
+    store = CallbackStore(str(tmp_path / "callbacks.sqlite3"))
+    mocker.patch.object(src.callbacks, "_callback_store", store)
+    return store
+
+
+@pytest.fixture(autouse=True)
+def song_slots(mocker):
+    """Free song slots and rate limits for each test."""
+    slots = FairSlots(4, chat_weights={})
+    mocker.patch.object(src.tasks, "_song_slots", slots)
+    mocker.patch.object(src.tasks, "_user_limits", TokenBuckets(capacity=0, rate=0))
+    return slots
+
+
+@pytest.fixture(autouse=True)
+def checkpoints(mocker, tmp_path):
+    """Empty checkpoints for each test."""
+    job_checkpoints = Checkpoints(str(tmp_path / "checkpoints.sqlite3"))
+    mocker.patch.object(src.tasks, "_checkpoints", job_checkpoints)
+    return job_checkpoints
+
+
+def button_data(file: File) -> str:
+    """
+    Stores the record of a file, as the audio file handler does, and gets the callback data of its button.
+    @param file: File object, with the action of the button.
+    @return: callback data.
+    """
+    key = get_callback_store().add(CallbackRecord(file.file_title, file.file_id, file.mime_type, file.chat_id,
+                                                  file.file_unique_id, file.duration))
+    return key + ":" + (file.action.value if isinstance(file.action, Action) else file.action)
+
+
+def mocked_tasks(position: int = 0) -> AsyncMock:
+    """
+    Mocks the task workers the handlers queue jobs on.
+    @param position: position the jobs are admitted at.
+    @return: mocked TaskWorkers object.
+    """
+    tasks_mock = AsyncMock()
+    tasks_mock.admit.return_value = position
+    return tasks_mock
 
 
 @pytest.mark.asyncio
@@ -51,7 +119,7 @@ async def test_help():
 # URL handler tests ------------
 @pytest.mark.asyncio
 async def test_url_handler(mocker):
-    """Test url handler. Should detect youtube links accordingly."""
+    """Test url handler. Should detect youtube links accordingly and queue them."""
 
     url = "https://www.youtube.com/watch?v=W2TE0DjdNqI&ab_channel=PorterRobinsonVEVO"
 
@@ -70,24 +138,17 @@ async def test_url_handler(mocker):
     bot_mock = AsyncMock()
     bot_mock.send_message.return_value = msg_mock
 
+    tasks_mock = mocked_tasks()
+
     context_mock = Mock()
     context_mock.bot = bot_mock
-
-    # Youtube audio download mock
-    youtube_track = YoutubeTrack("sample", "sample", "filepath", "audio/mpeg")
-    download_youtube_audio_mock = AsyncMock()
-    download_youtube_audio_mock.return_value = youtube_track
-
-    # Google drive mock
-    drive_mock = AsyncMock()
-
-    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
-    mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
+    context_mock.bot_data = {'tasks': tasks_mock}
 
     # Run #1
     await url_handler(update_mock, context_mock)
-    download_youtube_audio_mock.assert_called_once()
-    drive_mock.assert_called_once()
+    tasks_mock.enqueue.assert_called_once()
+    assert tasks_mock.enqueue.call_args[0][0] == YOUTUBE_TASK
+    assert tasks_mock.enqueue.call_args[0][1]['metadata']['url'] == url
 
     # Run #2
 
@@ -101,8 +162,8 @@ async def test_url_handler(mocker):
     update_mock.message = message_mock
 
     await url_handler(update_mock, context_mock)
-    download_youtube_audio_mock.assert_called()
-    drive_mock.assert_called()
+    assert tasks_mock.enqueue.call_count == 2
+    assert tasks_mock.enqueue.call_args[0][1]['metadata']['folder'] == "porter"
 
 @pytest.mark.asyncio
 async def test_url_handler_invalid_youtube_link(mocker):
@@ -144,11 +205,13 @@ async def test_url_handler_invalid_youtube_link(mocker):
     assert update_mock.message.reply_text.call_args[0][0] == "This URL does not point to a valid Youtube video ❌."
 
 
+
+
 @pytest.mark.asyncio
-async def test_url_handler_error_audio_download(mocker):
-    """Errors on youtube audio download."""
+async def test_url_handler_unsupported_provider(mocker):
+    """Unsupported provider."""
 
-    url = "https://www.youtube.com/watch?v=W2TE0DjdNqI&ab_channel=PorterRobinsonVEVO"
+    url = "https://www.google.com"
 
     # Update mock
     message_mock = AsyncMock()
@@ -171,41 +234,187 @@ async def test_url_handler_error_audio_download(mocker):
     # Youtube audio download mock
     youtube_track = YoutubeTrack("sample", "sample", "filepath", "audio/mpeg")
     download_youtube_audio_mock = Mock()
-    download_youtube_audio_mock.side_effect = YoutubeAudioDownloadFail
+    download_youtube_audio_mock.return_value = youtube_track
 
     # Google drive mock
     drive_mock = AsyncMock()
+    drive_mock.side_effect = GoogleDriveUploadFail
 
     mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
     mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
 
     # Run
     await url_handler(update_mock, context_mock)
-    assert msg_mock.edit_text.call_args[0][0] == "There was a problem downloading the audio from this Youtube link ❌."
+    assert update_mock.message.reply_text.call_args[0][0] == "We are yet to support URLs from this place 😕."
+
 
 @pytest.mark.asyncio
-async def test_url_handler_drive_error(mocker):
-    """Google drive error uploading."""
+async def test_url_handler_several_youtube_links():
+    """Messages with several Youtube links queue a single batch task, without repeated videos."""
 
-    url = "https://www.youtube.com/watch?v=W2TE0DjdNqI&ab_channel=PorterRobinsonVEVO"
+    message_mock = AsyncMock()
+    message_mock.text = "https://www.youtube.com/watch?v=W2TE0DjdNqI https://youtu.be/lSooYPG-5Rg " \
+                        "https://youtu.be/W2TE0DjdNqI https://www.google.com && folder: porter"
+    message_mock.message_id = 2
+
+    update_mock = AsyncMock()
+    update_mock.message = message_mock
+    update_mock.effective_chat.id = 15552
+    update_mock.effective_chat.type = "group"
+
+    bot_mock = AsyncMock()
+    bot_mock.send_message.return_value = Mock(message_id=1)
+    tasks_mock = mocked_tasks()
+
+    context_mock = Mock()
+    context_mock.bot = bot_mock
+    context_mock.bot_data = {'tasks': tasks_mock}
+
+    # Run
+    await url_handler(update_mock, context_mock)
+
+    tasks_mock.enqueue.assert_called_once()
+    assert tasks_mock.enqueue.call_args[0][0] == YOUTUBE_BATCH_TASK
+    assert tasks_mock.enqueue.call_args[0][1]['urls'] == ["https://www.youtube.com/watch?v=W2TE0DjdNqI",
+                                                          "https://youtu.be/lSooYPG-5Rg"]
+    assert tasks_mock.enqueue.call_args[0][1]['metadata']['folder'] == "porter"
+    assert "2 songs" in bot_mock.send_message.call_args.kwargs['text']
+
+
+@pytest.mark.asyncio
+async def test_url_handler_youtube_link_after_other_link():
+    """A single Youtube link is queued even if the message has an unsupported link before it."""
 
-    # Update mock
     message_mock = AsyncMock()
-    message_mock.text = url
-    message_mock.reply_text.return_value = None
+    message_mock.text = "https://www.google.com https://youtu.be/lSooYPG-5Rg"
+    message_mock.message_id = 2
 
     update_mock = AsyncMock()
     update_mock.message = message_mock
+    update_mock.effective_chat.id = 15552
+    update_mock.effective_chat.type = "group"
+    update_mock.effective_user.id = 7
 
-    # Context mock
-    msg_mock = AsyncMock()
-    msg_mock.edit_text.return_value = None
+    bot_mock = AsyncMock()
+    bot_mock.send_message.return_value = Mock(message_id=1)
+    tasks_mock = mocked_tasks()
+
+    context_mock = Mock()
+    context_mock.bot = bot_mock
+    context_mock.bot_data = {'tasks': tasks_mock}
+
+    # Run
+    await url_handler(update_mock, context_mock)
+
+    message_mock.reply_text.assert_not_called()
+    kind, payload = tasks_mock.enqueue.call_args[0]
+    assert kind == YOUTUBE_TASK
+    assert payload['metadata']['url'] == "https://youtu.be/lSooYPG-5Rg"
+    assert payload['user_id'] == 7
+
+
+@pytest.mark.asyncio
+async def test_url_handler_queue_position():
+    """The status message tells the position of the job when the workers are busy, and the job is queued on the lane
+    of its chat and user."""
+
+    # Mocks
+    update_mock = AsyncMock()
+    update_mock.message.text = "https://www.youtube.com/watch?v=W2TE0DjdNqI"
+    update_mock.effective_chat.id = 15552
+    update_mock.effective_user.id = 7
 
     bot_mock = AsyncMock()
-    bot_mock.send_message.return_value = msg_mock
+    bot_mock.send_message.return_value = Mock(message_id=1)
+    tasks_mock = mocked_tasks(position=3)
 
-    context_mock = AsyncMock()
+    context_mock = Mock()
+    context_mock.bot = bot_mock
+    context_mock.bot_data = {'tasks': tasks_mock}
+
+    # Run
+    await url_handler(update_mock, context_mock)
+
+    tasks_mock.admit.assert_called_once_with(15552, 7, 1)
+    assert bot_mock.send_message.call_args.kwargs['text'].endswith("Queued, position 3 ⏳")
+    assert tasks_mock.enqueue.call_args.kwargs == {'chat_id': 15552, 'user_id': 7}
+
+
+@pytest.mark.asyncio
+async def test_url_handler_rate_limited():
+    """Users queueing links too fast are told when to try again, and nothing is queued."""
+
+    # Mocks
+    update_mock = AsyncMock()
+    update_mock.message.text = "https://www.youtube.com/watch?v=W2TE0DjdNqI https://youtu.be/lSooYPG-5Rg"
+
+    bot_mock = AsyncMock()
+    tasks_mock = mocked_tasks()
+    tasks_mock.admit.side_effect = TaskRateLimited(12.5)
+
+    context_mock = Mock()
     context_mock.bot = bot_mock
+    context_mock.bot_data = {'tasks': tasks_mock}
+
+    # Run
+    await url_handler(update_mock, context_mock)
+
+    assert tasks_mock.admit.call_args.args[2] == 0
+    tasks_mock.enqueue.assert_not_called()
+    bot_mock.send_message.assert_not_called()
+    assert "try again in 13 seconds" in update_mock.effective_message.reply_text.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_url_handler_long_tracklist(tmp_path):
+    """Messages with more links than a user can queue at once are still queued, as their songs are taken from the
+    rate limit as they're processed."""
+
+    update_mock = AsyncMock()
+    update_mock.message.text = " ".join(f"https://youtu.be/video{i:06d}" for i in range(20))
+    update_mock.message.message_id = 2
+    update_mock.effective_chat.id = 15552
+    update_mock.effective_chat.type = "group"
+    update_mock.effective_user.id = 7
+
+    bot_mock = AsyncMock()
+    bot_mock.send_message.return_value = Mock(message_id=1)
+
+    queue = TaskQueue(str(tmp_path / "tasks.sqlite3"))
+    workers = TaskWorkers(queue, bot_mock, limits=TokenBuckets(capacity=10, rate=0.1))
+
+    context_mock = Mock()
+    context_mock.bot = bot_mock
+    context_mock.bot_data = {'tasks': workers}
+
+    # Run
+    try:
+        await url_handler(update_mock, context_mock)
+        task = queue.claim()
+    finally:
+        queue.close()
+
+    assert task.kind == YOUTUBE_BATCH_TASK
+    assert len(task.payload['urls']) == 20
+    update_mock.effective_message.reply_text.assert_not_called()
+
+
+# Task handlers tests ------------
+def youtube_task_payload() -> dict:
+    return {
+        "chat_id": 15552,
+        "chat_type": "group",
+        "message_id": 1,
+        "reply_to_message_id": 2,
+        "metadata": asdict(Metadata("https://www.youtube.com/watch?v=W2TE0DjdNqI", "", "", "", "", "", "", "porter")),
+    }
+
+
+@pytest.mark.asyncio
+async def test_youtube_task(mocker):
+    """Normal flow - downloads the Youtube audio, uploads it and lets the user know."""
+
+    bot_mock = AsyncMock()
 
     # Youtube audio download mock
     youtube_track = YoutubeTrack("sample", "sample", "filepath", "audio/mpeg")
@@ -214,54 +423,496 @@ async def test_url_handler_drive_error(mocker):
 
     # Google drive mock
     drive_mock = AsyncMock()
-    drive_mock.side_effect = GoogleDriveUploadFail
+    drive_mock.return_value = DriveFile("file_id", "file_link", existing=False)
 
     mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
     mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
 
     # Run
-    await url_handler(update_mock, context_mock)
-    assert msg_mock.edit_text.call_args[0][0] == "We managed to download the audio but failed to upload on Google Drive ❌."
+    await youtube_task(bot_mock, youtube_task_payload())
+
+    download_youtube_audio_mock.assert_called_once()
+    assert download_youtube_audio_mock.call_args[0][0].folder == "porter"
+    drive_mock.assert_called_once()
+    assert drive_mock.call_args[0][4] == "porter"
+    assert drive_mock.call_args.kwargs['video_id'] == "sample"
+    assert "has been uploaded" in bot_mock.send_message.call_args.kwargs['text']
+    assert bot_mock.send_message.call_args.kwargs['reply_to_message_id'] == 2
+
 
 @pytest.mark.asyncio
-async def test_url_handler_unsupported_provider(mocker):
-    """Unsupported provider."""
+async def test_youtube_task_already_uploaded(mocker):
+    """The user is told when the song was already on Google Drive."""
 
-    url = "https://www.google.com"
+    bot_mock = AsyncMock()
 
-    # Update mock
-    message_mock = AsyncMock()
-    message_mock.text = url
-    message_mock.reply_text.return_value = None
+    download_youtube_audio_mock = AsyncMock()
+    download_youtube_audio_mock.return_value = YoutubeTrack("sample", "sample", "filepath", "audio/mpeg")
+    drive_mock = AsyncMock()
+    drive_mock.return_value = DriveFile("file_id", "file_link", existing=True)
 
-    update_mock = AsyncMock()
-    update_mock.message = message_mock
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
+    mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
 
-    # Context mock
-    msg_mock = AsyncMock()
-    msg_mock.edit_text.return_value = None
+    # Run
+    await youtube_task(bot_mock, youtube_task_payload())
+
+    assert "already on Google Drive" in bot_mock.send_message.call_args.kwargs['text']
+
+
+@pytest.mark.asyncio
+async def test_youtube_task_pipelined(mocker):
+    """On pipelined mode, the audio is transcoded straight into the Google Drive upload."""
 
     bot_mock = AsyncMock()
-    bot_mock.send_message.return_value = msg_mock
+    source = YoutubeSource("sample", "sample title", "https://stream", {}, 128, 200)
+    pipe_mock = AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False))
+    download_youtube_audio_mock = AsyncMock()
+    transcode_mock = Mock()
 
-    context_mock = AsyncMock()
-    context_mock.bot = bot_mock
+    mocker.patch.object(src.handlers, "can_pipe_youtube_audio", Mock(return_value=True))
+    mocker.patch.object(src.handlers, "resolve_youtube_audio", AsyncMock(return_value=source))
+    mocker.patch.object(src.handlers, "transcode_youtube_audio", transcode_mock)
+    mocker.patch.object(src.handlers, "pipe_to_drive", pipe_mock)
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
 
-    # Youtube audio download mock
-    youtube_track = YoutubeTrack("sample", "sample", "filepath", "audio/mpeg")
-    download_youtube_audio_mock = Mock()
-    download_youtube_audio_mock.return_value = youtube_track
+    # Run
+    await youtube_task(bot_mock, youtube_task_payload())
 
-    # Google drive mock
+    download_youtube_audio_mock.assert_not_called()
+    pipe_mock.assert_called_once()
+    assert pipe_mock.call_args.args[1:4] == (200 * 128 * 1000 // 8, "sample title", "audio/mpeg")
+    assert pipe_mock.call_args.args[5] == "porter"
+    assert pipe_mock.call_args.kwargs['video_id'] == "sample"
+    assert "*sample title* has been uploaded" in bot_mock.send_message.call_args.kwargs['text']
+
+    # The stream is only opened by the upload
+    transcode_mock.assert_not_called()
+    pipe_mock.call_args.args[0]()
+    assert transcode_mock.call_args.args[0] == source
+
+
+@pytest.mark.asyncio
+async def test_youtube_task_pipeline_falls_back(mocker):
+    """The audio is downloaded and then uploaded if piping it fails."""
+
+    bot_mock = AsyncMock()
+    download_youtube_audio_mock = AsyncMock(return_value=YoutubeTrack("sample", "sample", "filepath", "audio/mpeg"))
+    drive_mock = AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False))
+
+    mocker.patch.object(src.handlers, "can_pipe_youtube_audio", Mock(return_value=True))
+    mocker.patch.object(src.handlers, "resolve_youtube_audio",
+                        AsyncMock(return_value=YoutubeSource("sample", "sample", "https://stream", {}, 128)))
+    mocker.patch.object(src.handlers, "pipe_to_drive", AsyncMock(side_effect=GoogleDriveUploadFail))
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
+    mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
+
+    # Run
+    await youtube_task(bot_mock, youtube_task_payload())
+
+    download_youtube_audio_mock.assert_called_once()
+    drive_mock.assert_called_once()
+    assert "has been uploaded" in bot_mock.send_message.call_args.kwargs['text']
+
+
+@pytest.mark.asyncio
+async def test_youtube_task_error_audio_download(mocker):
+    """Errors on youtube audio download are raised, so the task is retried."""
+
+    bot_mock = AsyncMock()
+
+    download_youtube_audio_mock = AsyncMock()
+    download_youtube_audio_mock.side_effect = YoutubeAudioDownloadFail
     drive_mock = AsyncMock()
-    drive_mock.side_effect = GoogleDriveUploadFail
 
     mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
     mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
 
+    # Run
+    with pytest.raises(YoutubeAudioDownloadFail):
+        await youtube_task(bot_mock, youtube_task_payload())
+    drive_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_youtube_task_failed_audio_download():
+    """The user is told when the audio download failed for good."""
+
+    bot_mock = AsyncMock()
+
+    await youtube_task_failed(bot_mock, youtube_task_payload(), YoutubeAudioDownloadFail())
+
+    assert bot_mock.edit_message_text.call_args.kwargs['text'] == "There was a problem downloading the audio from this Youtube link ❌."
+    assert bot_mock.edit_message_text.call_args.kwargs['chat_id'] == 15552
+    assert bot_mock.edit_message_text.call_args.kwargs['message_id'] == 1
+
+
+@pytest.mark.asyncio
+async def test_youtube_task_failed_drive_error():
+    """The user is told when the Google Drive upload failed for good."""
+
+    bot_mock = AsyncMock()
+
+    await youtube_task_failed(bot_mock, youtube_task_payload(), GoogleDriveUploadFail())
+
+    assert bot_mock.edit_message_text.call_args.kwargs['text'] == "We managed to download the audio but failed to upload on Google Drive ❌."
+
+
+def youtube_batch_task_payload() -> dict:
+    return {
+        **youtube_task_payload(),
+        "urls": ["https://www.youtube.com/watch?v=W2TE0DjdNqI", "https://youtu.be/lSooYPG-5Rg",
+                 "https://youtu.be/dQw4w9WgXcQ"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_youtube_batch_task(mocker):
+    """Normal flow - every link is downloaded and uploaded, and the summary counts the failed ones."""
+
+    bot_mock = AsyncMock()
+
+    async def download(metadata, message, directory):
+        if metadata.url == "https://youtu.be/lSooYPG-5Rg":
+            raise YoutubeAudioDownloadFail
+        await message.edit_text("Got it!\nDownloading from Youtube: 50%")
+        return YoutubeTrack("song-" + metadata.url[-11:], metadata.url[-11:], "filepath", "audio/mpeg")
+
+    download_youtube_audio_mock = AsyncMock(side_effect=download)
+    drive_mock = AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False))
+    get_folder_mock = Mock(return_value="folder_id")
+
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
+    mocker.patch.object(src.handlers, "upload_to_drive", drive_mock)
+    mocker.patch.object(src.handlers, "get_or_create_drive_folder", get_folder_mock)
+
+    # Run
+    await youtube_batch_task(bot_mock, youtube_batch_task_payload())
+
+    get_folder_mock.assert_called_once_with("porter")
+    assert download_youtube_audio_mock.call_count == 3
+    assert drive_mock.call_count == 2
+    assert all(call.args[4] == "porter" for call in drive_mock.call_args_list)
+
+    text = bot_mock.edit_message_text.call_args.kwargs['text']
+    assert "1. W2TE0DjdNqI - song-W2TE0DjdNqI - uploaded ✅" in text
+    assert "2. lSooYPG-5Rg - Download failed ❌" in text
+    assert text.endswith("Done! 2 of 3 songs are on Google Drive.")
+
+
+@pytest.mark.asyncio
+async def test_youtube_batch_task_concurrency(mocker):
+    """No more songs than the batch limit are processed at the same time."""
+
+    running = 0
+    max_running = 0
+
+    async def download(metadata, message, directory):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return YoutubeTrack("song", "id", "filepath", "audio/mpeg")
+
+    payload = {**youtube_batch_task_payload(),
+               "urls": [f"https://youtu.be/video{i:06d}" for i in range(6)]}
+
+    mocker.patch.object(src.handlers, "BATCH_MAX_CONCURRENCY", 2)
+    mocker.patch.object(src.handlers, "download_youtube_audio", AsyncMock(side_effect=download))
+    mocker.patch.object(src.handlers, "upload_to_drive",
+                        AsyncMock(return_value=DriveFile("file_id", "file_link", existing=True)))
+    mocker.patch.object(src.handlers, "get_or_create_drive_folder", Mock())
+
+    # Run
+    await youtube_batch_task(AsyncMock(), payload)
+
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_youtube_batch_task_song_slots(mocker, song_slots):
+    """Songs of different batches share the song slots, so they don't add up past them."""
+
+    running = 0
+    max_running = 0
+
+    async def download(metadata, message, directory):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+        return YoutubeTrack("song", "id", "filepath", "audio/mpeg")
+
+    song_slots.size = 2
+    mocker.patch.object(src.handlers, "download_youtube_audio", AsyncMock(side_effect=download))
+    mocker.patch.object(src.handlers, "upload_to_drive",
+                        AsyncMock(return_value=DriveFile("file_id", "file_link", existing=True)))
+    mocker.patch.object(src.handlers, "get_or_create_drive_folder", Mock())
+
+    # Run
+    await asyncio.gather(*[youtube_batch_task(AsyncMock(), {**youtube_batch_task_payload(), "user_id": user_id})
+                           for user_id in (1, 2)])
+
+    assert max_running == 2
+
+
+def youtube_playlist_task_payload() -> dict:
+    payload = youtube_task_payload()
+    payload["metadata"] = asdict(Metadata("https://www.youtube.com/playlist?list=PLx0", "", "", "", "", "", "", None))
+    payload["job_id"] = "job_id"
+    return payload
+
+
+def mocked_playlist(entries: list):
+    """
+    Mocks the listing of a Youtube playlist.
+    @param entries: IDs of the videos of the playlist.
+    @return: mocked 'list_youtube_playlist' function.
+    """
+
+    async def list_playlist(url):
+        for video_id in entries:
+            yield {'id': video_id, 'title': "song " + video_id, 'url': "https://www.youtube.com/watch?v=" + video_id}
+
+    return list_playlist
+
+
+@pytest.mark.asyncio
+async def test_youtube_playlist_task(mocker, tmp_path):
+    """Normal flow - every video of the playlist is uploaded, skipping the ones checkpointed by a previous attempt."""
+
+    checkpoints = Checkpoints(str(tmp_path / "checkpoints.sqlite3"))
+    checkpoints.add("job_id", "b")
+
+    download_youtube_audio_mock = AsyncMock(side_effect=lambda metadata, message, directory: YoutubeTrack(
+        "song", metadata.url[-1], "filepath", "audio/mpeg"))
+    bot_mock = AsyncMock()
+
+    mocker.patch.object(src.handlers, "get_checkpoints", Mock(return_value=checkpoints))
+    mocker.patch.object(src.handlers, "list_youtube_playlist", mocked_playlist(["a", "b", "c"]))
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
+    mocker.patch.object(src.handlers, "upload_to_drive",
+                        AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False)))
+
+    # Run
+    await youtube_playlist_task(bot_mock, youtube_playlist_task_payload())
+
+    assert sorted(call.args[0].url[-1] for call in download_youtube_audio_mock.call_args_list) == ["a", "c"]
+    assert bot_mock.edit_message_text.call_args.kwargs['text'].endswith("Done! 3 songs are on Google Drive.")
+    assert not checkpoints.contains("job_id", "a") and not checkpoints.contains("job_id", "b")
+
+
+@pytest.mark.asyncio
+async def test_youtube_playlist_task_failed_songs(mocker, tmp_path):
+    """Failed songs fail the task at the end, keeping the checkpoints of the uploaded ones for the retry."""
+
+    checkpoints = Checkpoints(str(tmp_path / "checkpoints.sqlite3"))
+
+    async def download(metadata, message, directory):
+        if metadata.url.endswith("b"):
+            raise YoutubeAudioDownloadFail
+        return YoutubeTrack("song", metadata.url[-1], "filepath", "audio/mpeg")
+
+    bot_mock = AsyncMock()
+
+    mocker.patch.object(src.handlers, "get_checkpoints", Mock(return_value=checkpoints))
+    mocker.patch.object(src.handlers, "list_youtube_playlist", mocked_playlist(["a", "b", "c"]))
+    mocker.patch.object(src.handlers, "download_youtube_audio", AsyncMock(side_effect=download))
+    mocker.patch.object(src.handlers, "upload_to_drive",
+                        AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False)))
+
+    # Run
+    with pytest.raises(YoutubeAudioDownloadFail):
+        await youtube_playlist_task(bot_mock, youtube_playlist_task_payload())
+
+    assert checkpoints.contains("job_id", "a") and checkpoints.contains("job_id", "c")
+    assert not checkpoints.contains("job_id", "b")
+    assert "trying the other 1 again later" in bot_mock.edit_message_text.call_args.kwargs['text']
+
+
+@pytest.mark.asyncio
+async def test_youtube_playlist_task_rate_limit(mocker, checkpoints):
+    """Listed videos are taken from the user's rate limit. Once it runs out, the task is deferred until it's refilled,
+    and picks up after the videos already uploaded."""
+
+    now = 0
+    mocker.patch.object(src.tasks, "_user_limits", TokenBuckets(capacity=2, rate=0.5, clock=lambda: now))
+    checkpoints.add("job_id", "b")
+
+    download_youtube_audio_mock = AsyncMock(side_effect=lambda metadata, message, directory: YoutubeTrack(
+        "song", metadata.url[-1], "filepath", "audio/mpeg"))
+    mocker.patch.object(src.handlers, "list_youtube_playlist", mocked_playlist(["a", "b", "c", "d", "e"]))
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
+    mocker.patch.object(src.handlers, "upload_to_drive",
+                        AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False)))
+    payload = {**youtube_playlist_task_payload(), "user_id": 7}
+
+    # Run
+    with pytest.raises(TaskDeferred) as deferred:
+        await youtube_playlist_task(AsyncMock(), payload)
+
+    assert deferred.value.delay == 4
+    assert [call.args[0].url[-1] for call in download_youtube_audio_mock.call_args_list] == ["a", "c"]
+    assert checkpoints.contains("job_id", "a") and checkpoints.contains("job_id", "c")
+
+    # Once the rate limit is refilled
+    now = 4
+    bot_mock = AsyncMock()
+    await youtube_playlist_task(bot_mock, payload)
+
+    assert [call.args[0].url[-1] for call in download_youtube_audio_mock.call_args_list] == ["a", "c", "d", "e"]
+    assert bot_mock.edit_message_text.call_args.kwargs['text'].endswith("Done! 5 songs are on Google Drive.")
+
+
+@pytest.mark.asyncio
+async def test_youtube_batch_task_rate_limit(mocker):
+    """Songs of a batch are taken from the user's rate limit. Once it runs out, the task is deferred until it's
+    refilled, skipping the songs already processed."""
+
+    now = 0
+    mocker.patch.object(src.tasks, "_user_limits", TokenBuckets(capacity=2, rate=0.5, clock=lambda: now))
+
+    async def download(metadata, message, directory):
+        if metadata.url == "https://youtu.be/lSooYPG-5Rg":
+            raise YoutubeAudioDownloadFail
+        return YoutubeTrack("song", metadata.url[-11:], "filepath", "audio/mpeg")
+
+    download_youtube_audio_mock = AsyncMock(side_effect=download)
+    mocker.patch.object(src.handlers, "download_youtube_audio", download_youtube_audio_mock)
+    mocker.patch.object(src.handlers, "upload_to_drive",
+                        AsyncMock(return_value=DriveFile("file_id", "file_link", existing=False)))
+    mocker.patch.object(src.handlers, "get_or_create_drive_folder", Mock())
+    payload = {**youtube_batch_task_payload(), "user_id": 7}
+
+    # Run
+    with pytest.raises(TaskDeferred):
+        await youtube_batch_task(AsyncMock(), payload)
+    assert download_youtube_audio_mock.call_count == 2
+
+    # Once the rate limit is refilled, only the last song is processed (the failed one isn't attempted again)
+    now = 4
+    bot_mock = AsyncMock()
+    await youtube_batch_task(bot_mock, payload)
+
+    assert download_youtube_audio_mock.call_count == 3
+    assert bot_mock.edit_message_text.call_args.kwargs['text'].endswith("Done! 2 of 3 songs are on Google Drive.")
+
+
+@pytest.mark.asyncio
+async def test_url_handler_youtube_playlist():
+    """Youtube playlist links queue a playlist task."""
+
+    message_mock = AsyncMock()
+    message_mock.text = "https://www.youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG && folder: porter"
+
+    update_mock = AsyncMock()
+    update_mock.message = message_mock
+
+    bot_mock = AsyncMock()
+    bot_mock.send_message.return_value = Mock(message_id=1)
+    tasks_mock = mocked_tasks()
+
+    context_mock = Mock()
+    context_mock.bot = bot_mock
+    context_mock.bot_data = {'tasks': tasks_mock}
+
     # Run
     await url_handler(update_mock, context_mock)
-    assert update_mock.message.reply_text.call_args[0][0] == "We are yet to support URLs from this place 😕."
+
+    tasks_mock.enqueue.assert_called_once()
+    assert tasks_mock.enqueue.call_args[0][0] == YOUTUBE_PLAYLIST_TASK
+    assert tasks_mock.enqueue.call_args[0][1]['job_id']
+    assert tasks_mock.enqueue.call_args[0][1]['metadata']['folder'] == "porter"
+
+
+def tracklist_task_payload() -> dict:
+    return {
+        "chat_id": 1,
+        "chat_type": "private",
+        "message_id": 2,
+        "file": asdict(File(Action.TRACKLIST, "set.mp3", "12345", "audio/mpeg", "1", "unique", 3600)) | {
+            "action": "tracklist"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_tracklist_task(mocker):
+    """Normal flow - the tracklist of the mix is sent on the status message."""
+
+    bot_mock = AsyncMock()
+    bot_mock.getFile.return_value = Mock(file_path="https://api.telegram.org/file/bot123/music/set.mp3")
+
+    recognize_tracklist_mock = AsyncMock(return_value=[
+        TracklistEntry(0, 182, "Goodbye To a World", "Porter Robinson"),
+        TracklistEntry(3590, 3702, "Language", "Porter Robinson"),
+    ])
+    mocker.patch.object(src.handlers, "recognize_tracklist", recognize_tracklist_mock)
+
+    # Run
+    await tracklist_task(bot_mock, tracklist_task_payload())
+
+    assert recognize_tracklist_mock.call_args[0][0] == "https://api.telegram.org/file/bot123/music/set.mp3"
+    assert bot_mock.edit_message_text.call_args.kwargs['text'] == (
+        "Tracklist 📜\n"
+        "00:00 - 03:02  Porter Robinson - Goodbye To a World\n"
+        "59:50 - 1:01:42  Porter Robinson - Language")
+
+
+@pytest.mark.asyncio
+async def test_tracklist_task_no_songs(mocker):
+    """No song was recognized in the mix."""
+
+    bot_mock = AsyncMock()
+    mocker.patch.object(src.handlers, "recognize_tracklist", AsyncMock(return_value=[]))
+
+    # Run
+    await tracklist_task(bot_mock, tracklist_task_payload())
+
+    assert "couldn't detect any song" in bot_mock.edit_message_text.call_args.kwargs['text']
+
+
+def test_format_tracklist_too_long():
+    """Tracklists are cut to fit a Telegram message."""
+
+    text = format_tracklist([TracklistEntry(i * 10, i * 10 + 12, "a" * 50, "b") for i in range(200)])
+
+    assert len(text) == 4096
+    assert text.endswith("…")
+
+
+@pytest.mark.asyncio
+async def test_drive_upload_task(mocker):
+    """Normal flow - downloads the audio file sent to the chat and uploads it."""
+
+    payload = {
+        "chat_id": 15552,
+        "chat_type": "group",
+        "message_id": 1,
+        "file": {"action": "gdrive", "file_title": "sample.mp3", "file_id": "12345", "mime_type": "mpeg/audio",
+                 "chat_id": "15552"},
+    }
+
+    context_file_mock = AsyncMock()
+    context_file_mock.file_path = "https://api.telegram.org/file/sample.mp3"
+    context_file_mock.file_size = 1024
+    context_file_mock.file_unique_id = "unique_12345"
+    bot_mock = AsyncMock()
+    bot_mock.getFile.return_value = context_file_mock
+
+    stream_to_drive_mock = AsyncMock()
+    stream_to_drive_mock.return_value = DriveFile("file_id", "file_link", existing=False)
+    mocker.patch.object(src.handlers, "stream_to_drive", stream_to_drive_mock)
+
+    await drive_upload_task(bot_mock, payload)
+
+    bot_mock.getFile.assert_called_once_with("12345")
+    context_file_mock.download_to_drive.assert_not_called()
+    stream_to_drive_mock.assert_called_once()
+    assert stream_to_drive_mock.call_args.args[:2] == ("https://api.telegram.org/file/sample.mp3", 1024)
+    assert stream_to_drive_mock.call_args.kwargs['telegram_id'] == "unique_12345"
+    assert bot_mock.edit_message_text.call_args.kwargs['text'] == "Song uploaded!"
 
 
 # Inline query audio files
@@ -300,6 +951,7 @@ async def test_audio_file_handler_button_shazam(mocker):
     # Context mock
     context_file_mock = AsyncMock()
     context_file_mock.download.return_value = None
+    context_file_mock.file_size = 1024
 
     bot_mock = AsyncMock()
     bot_mock.send_photo.return_value = None
@@ -311,7 +963,7 @@ async def test_audio_file_handler_button_shazam(mocker):
     # Updater mock
     query_mock = AsyncMock()
     query_mock.answer.return_value = None
-    query_mock.data = file
+    query_mock.data = button_data(file)
     query_mock.edit_message_text.return_value = None
 
     update_mock = AsyncMock()
@@ -322,10 +974,12 @@ async def test_audio_file_handler_button_shazam(mocker):
     shazam_mock.shazam.return_value = return_track
 
     mocker.patch.object(src.handlers, "shazam", shazam_mock)
+    mocker.patch.object(src.handlers, "shazam_excerpt", AsyncMock(side_effect=AudioDecodeFail))
 
     await audio_file_handler_button(update_mock, callback_mock)
 
     # Assertions
+    context_file_mock.download_to_drive.assert_called_once()
     assert "found a track" in query_mock.edit_message_text.call_args[0][0]
 
 @pytest.mark.asyncio
@@ -341,6 +995,7 @@ async def test_audio_file_handler_button_shazam_error(mocker):
     # Context mock
     context_file_mock = AsyncMock()
     context_file_mock.download.return_value = None
+    context_file_mock.file_size = 1024
 
     bot_mock = AsyncMock()
     bot_mock.send_photo.return_value = None
@@ -352,7 +1007,7 @@ async def test_audio_file_handler_button_shazam_error(mocker):
     # Updater mock
     query_mock = AsyncMock()
     query_mock.answer.return_value = None
-    query_mock.data = file
+    query_mock.data = button_data(file)
     query_mock.edit_message_text.return_value = None
 
     update_mock = AsyncMock()
@@ -363,12 +1018,106 @@ async def test_audio_file_handler_button_shazam_error(mocker):
     shazam_mock.side_effect = TrackNotFound
 
     mocker.patch.object(src.handlers, "shazam", shazam_mock)
+    mocker.patch.object(src.handlers, "shazam_excerpt", AsyncMock(side_effect=AudioDecodeFail))
 
     await audio_file_handler_button(update_mock, callback_mock)
 
     # Asserts
     assert "Unfortunately we couldn\'t detect a song" in query_mock.edit_message_text.call_args[0][0]
 
+@pytest.mark.asyncio
+async def test_audio_file_handler_button_shazam_excerpt(mocker):
+    """Only an excerpt of the file is recognized, without downloading the file."""
+
+    file: File = File(Action.SHAZAM, "sample.mp3", "12345", "mpeg/audio", "15552", "unique", 3600)
+
+    context_file_mock = AsyncMock()
+    context_file_mock.file_path = "https://api.telegram.org/file/bot123/music/file_0.mp3"
+
+    bot_mock = AsyncMock()
+    bot_mock.getFile.return_value = context_file_mock
+
+    callback_mock = AsyncMock()
+    callback_mock.bot = bot_mock
+
+    query_mock = AsyncMock()
+    query_mock.data = button_data(file)
+
+    update_mock = AsyncMock()
+    update_mock.callback_query = query_mock
+
+    shazam_mock = AsyncMock()
+    shazam_excerpt_mock = AsyncMock(return_value=Mock(title="Goodbye To A World", subtitle="Porter Robinson",
+                                                      image="www.randomurl.com"))
+
+    mocker.patch.object(src.handlers, "shazam", shazam_mock)
+    mocker.patch.object(src.handlers, "shazam_excerpt", shazam_excerpt_mock)
+    mocker.patch.object(src.handlers, "cached_recognition", AsyncMock(return_value=None))
+
+    await audio_file_handler_button(update_mock, callback_mock)
+
+    # Assertions
+    shazam_excerpt_mock.assert_called_once_with(file, context_file_mock.file_path)
+    shazam_mock.assert_not_called()
+    context_file_mock.download_to_drive.assert_not_called()
+    assert "found a track" in query_mock.edit_message_text.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_audio_file_handler_button_shazam_cached(mocker):
+    """Files that were recognized before aren't downloaded nor sent to Shazam again."""
+
+    file: File = File(Action.SHAZAM, "sample.mp3", "12345", "mpeg/audio", "15552", "unique")
+
+    bot_mock = AsyncMock()
+    callback_mock = AsyncMock()
+    callback_mock.bot = bot_mock
+
+    query_mock = AsyncMock()
+    query_mock.data = button_data(file)
+
+    update_mock = AsyncMock()
+    update_mock.callback_query = query_mock
+
+    shazam_mock = AsyncMock()
+    cached_track = Mock(title="Goodbye To A World", subtitle="Porter Robinson", image="www.randomurl.com")
+
+    mocker.patch.object(src.handlers, "shazam", shazam_mock)
+    mocker.patch.object(src.handlers, "cached_recognition", AsyncMock(return_value=cached_track))
+
+    await audio_file_handler_button(update_mock, callback_mock)
+
+    # Assertions
+    shazam_mock.assert_not_called()
+    bot_mock.getFile.assert_not_called()
+    assert "found a track" in query_mock.edit_message_text.call_args[0][0]
+    assert bot_mock.send_photo.call_args.kwargs['photo'] == "www.randomurl.com"
+
+
+@pytest.mark.asyncio
+async def test_audio_file_handler_button_tracklist():
+    """Tests when the tracklist button is pressed - a tracklist task is queued."""
+
+    file: File = File(Action.TRACKLIST, "set.mp3", "12345", "mpeg/audio", "15552", "unique", 3600)
+
+    tasks_mock = mocked_tasks()
+    callback_mock = AsyncMock()
+    callback_mock.bot_data = {'tasks': tasks_mock}
+
+    query_mock = AsyncMock()
+    query_mock.data = button_data(file)
+
+    update_mock = AsyncMock()
+    update_mock.callback_query = query_mock
+
+    await audio_file_handler_button(update_mock, callback_mock)
+
+    tasks_mock.enqueue.assert_called_once()
+    assert tasks_mock.enqueue.call_args[0][0] == TRACKLIST_TASK
+    assert tasks_mock.enqueue.call_args[0][1]['file']['action'] == "tracklist"
+    assert "tracklist" in query_mock.edit_message_text.call_args[0][0]
+
+
 @pytest.mark.asyncio
 async def test_audio_file_handler_button_google_drive(mocker):
     """Tests when Google Drive button is pressed."""
@@ -382,32 +1131,58 @@ async def test_audio_file_handler_button_google_drive(mocker):
     # Context mock
     context_file_mock = AsyncMock()
     context_file_mock.download.return_value = None
+    context_file_mock.file_size = 1024
 
     bot_mock = AsyncMock()
     bot_mock.send_photo.return_value = None
     bot_mock.getFile.return_value = context_file_mock
 
+    tasks_mock = mocked_tasks()
+
     callback_mock = AsyncMock()
     callback_mock.bot = bot_mock
+    callback_mock.bot_data = {'tasks': tasks_mock}
 
     # Updater mock
     query_mock = AsyncMock()
     query_mock.answer.return_value = None
-    query_mock.data = file
+    query_mock.data = button_data(file)
     query_mock.edit_message_text.return_value = None
 
     update_mock = AsyncMock()
     update_mock.callback_query = query_mock
 
-    # Google drive
-    upload_to_drive_mock = AsyncMock()
+    await audio_file_handler_button(update_mock, callback_mock)
+
+    # Asserts
+    tasks_mock.enqueue.assert_called_once()
+    assert tasks_mock.enqueue.call_args[0][0] == DRIVE_UPLOAD_TASK
+    assert tasks_mock.enqueue.call_args[0][1]['file']['action'] == "gdrive"
+
+
+@pytest.mark.asyncio
+async def test_audio_file_handler_button_rate_limited():
+    """The buttons are kept when the user can't queue the upload yet."""
 
-    mocker.patch.object(src.handlers, "upload_to_drive", upload_to_drive_mock)
+    file: File = File(Action.GDRIVE_UPLOAD, "sample.mp3", "12345", "mpeg/audio", "15552")
+
+    tasks_mock = mocked_tasks()
+    tasks_mock.admit.side_effect = TaskRateLimited(30)
+    callback_mock = AsyncMock()
+    callback_mock.bot_data = {'tasks': tasks_mock}
+
+    query_mock = AsyncMock()
+    query_mock.data = button_data(file)
+
+    update_mock = AsyncMock()
+    update_mock.callback_query = query_mock
 
     await audio_file_handler_button(update_mock, callback_mock)
 
-    # Asserts
-    upload_to_drive_mock.assert_called_once()
+    tasks_mock.enqueue.assert_not_called()
+    query_mock.edit_message_text.assert_not_called()
+    assert "try again in 30 seconds" in update_mock.effective_message.reply_text.call_args.args[0]
+
 
 @pytest.mark.asyncio
 async def test_audio_file_handler_button_action_not_permitted(mocker):
@@ -422,6 +1197,7 @@ async def test_audio_file_handler_button_action_not_permitted(mocker):
     # Context mock
     context_file_mock = AsyncMock()
     context_file_mock.download.return_value = None
+    context_file_mock.file_size = 1024
 
     bot_mock = AsyncMock()
     bot_mock.send_photo.return_value = None
@@ -433,7 +1209,7 @@ async def test_audio_file_handler_button_action_not_permitted(mocker):
     # Updater mock
     query_mock = AsyncMock()
     query_mock.answer.return_value = None
-    query_mock.data = file
+    query_mock.data = button_data(file)
     query_mock.edit_message_text.return_value = None
 
     update_mock = AsyncMock()
@@ -444,6 +1220,51 @@ async def test_audio_file_handler_button_action_not_permitted(mocker):
     # Asserts
     assert "That action is not permitted" in query_mock.edit_message_text.call_args[0][0]
 
+@pytest.mark.asyncio
+async def test_audio_file_handler_button_expired():
+    """Buttons whose record expired (or is unknown) ask for the file again."""
+
+    query_mock = AsyncMock()
+    query_mock.data = "unknown:shazam"
+
+    update_mock = AsyncMock()
+    update_mock.callback_query = query_mock
+
+    await audio_file_handler_button(update_mock, AsyncMock())
+
+    assert "expired" in query_mock.edit_message_text.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_callback_store_is_used_off_the_event_loop(mocker, callback_store):
+    """The button records are stored and looked up on another thread, as the store is on disk."""
+
+    threads = []
+    add, get = callback_store.add, callback_store.get
+    mocker.patch.object(callback_store, "add", lambda record: threads.append(threading.get_ident()) or add(record))
+    mocker.patch.object(callback_store, "get", lambda key: threads.append(threading.get_ident()) or get(key))
+
+    message_mock = AsyncMock()
+    message_mock.audio = Mock(title="title", file_id="file_id", mime_type="audio/mpeg", file_unique_id="unique",
+                              duration=200)
+    message_mock.voice = None
+    update_mock = AsyncMock()
+    update_mock.message = message_mock
+    update_mock.effective_chat.id = 15552
+
+    query_mock = AsyncMock()
+    query_mock.data = "unknown:shazam"
+    button_update_mock = AsyncMock()
+    button_update_mock.callback_query = query_mock
+
+    # Run
+    await audio_file_handler(update_mock, AsyncMock())
+    await audio_file_handler_button(button_update_mock, AsyncMock())
+
+    assert len(threads) == 2
+    assert threading.get_ident() not in threads
+
+
 @pytest.mark.asyncio
 async def test_audio_file_handler_audio(mocker):
     """Tests when a voice audio is sent and handled."""
@@ -453,6 +1274,8 @@ async def test_audio_file_handler_audio(mocker):
     audio_mock.title = "title"
     audio_mock.file_id = "file_id"
     audio_mock.mime_type = "mime_type"
+    audio_mock.file_unique_id = "file_unique_id"
+    audio_mock.duration = 200
 
     message_mock = AsyncMock()
     message_mock.audio = audio_mock
@@ -474,6 +1297,15 @@ async def test_audio_file_handler_audio(mocker):
     # Asserts
     message_mock.reply_text.assert_called_once()
 
+    # All buttons act on the same record
+    keyboard = message_mock.reply_text.call_args.kwargs['reply_markup'].inline_keyboard
+    data = [button.callback_data for row in keyboard for button in row]
+    assert [item.split(":")[1] for item in data] == ["shazam", "gdrive", "tracklist"]
+    assert len({item.split(":")[0] for item in data}) == 1
+
+    record = get_callback_store().get(data[0].split(":")[0])
+    assert (record.file_title, record.file_id, record.duration) == ("title", "file_id", 200)
+
 
 @pytest.mark.asyncio
 async def test_audio_file_handler_voice(mocker):
@@ -484,6 +1316,7 @@ async def test_audio_file_handler_voice(mocker):
     voice_mock.file_unique_id = "file_unique_id"
     voice_mock.file_id = "file_id"
     voice_mock.mime_type = "mime_type"
+    voice_mock.duration = 20
 
     message_mock = AsyncMock()
     message_mock.voice = voice_mock
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from unittest.mock import Mock, AsyncMock
+
+import src.main
+from src.definitions.definitions import ROOT_DIR
+from src.main import Warmup
+
+# Modules that have to be imported lazily, as they make up most of the startup time
+HEAVY_MODULES = ["src.handlers", "yt_dlp", "shazamio", "googleapiclient", "mutagen", "magic", "aiohttp"]
+
+
+def test_main_imports_no_heavy_modules():
+    """The handlers, services and their dependencies aren't imported with the entrypoint."""
+    # On a new interpreter, as the tests import them
+    result = subprocess.run([sys.executable, "-c", "import sys, src.main; print('\\n'.join(sys.modules))"],
+                            cwd=ROOT_DIR, env={**os.environ, 'PYTHONPATH': ROOT_DIR}, capture_output=True, text=True,
+                            check=True)
+    imported = {name if name.startswith("src.") else name.split(".")[0] for name in result.stdout.splitlines()}
+
+    assert "src.main" in imported
+    assert [module for module in HEAVY_MODULES if module in imported] == []
+
+
+@pytest.mark.asyncio
+async def test_lazy_handler(mocker):
+    """Handlers registered by the entrypoint call the real ones once the handlers module is imported."""
+    url_handler = AsyncMock(return_value="done")
+    mocker.patch("src.handlers.url_handler", url_handler)
+    mocker.patch.object(src.main, "_warmup", None)
+
+    update, context = Mock(), Mock()
+
+    assert await src.main.url_handler(update, context) == "done"
+    url_handler.assert_awaited_once_with(update, context)
+
+
+@pytest.mark.asyncio
+async def test_warmup(mocker):
+    """The warm-up imports the handlers and then validates the Google Drive credentials."""
+    credentials = mocker.patch("src.services.gdrive.drive_client.credentials")
+    warmup = Warmup()
+    mocker.patch.object(src.main, "_warmup", warmup)
+
+    warmup.start()
+
+    assert (await src.main.get_handlers()).__name__ == "src.handlers"
+    warmup.credentials.result(timeout=5)
+    credentials.assert_called_once()
+
+
+def test_warmup_credentials_fail(mocker):
+    """A credentials error is kept for the bot's initialization to raise."""
+    mocker.patch("src.services.gdrive.drive_client.credentials", side_effect=FileNotFoundError)
+    warmup = Warmup()
+
+    warmup.start()
+
+    with pytest.raises(FileNotFoundError):
+        warmup.credentials.result(timeout=5)
+    assert warmup.handlers.result(timeout=5).__name__ == "src.handlers"
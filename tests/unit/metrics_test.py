@@ -0,0 +1,66 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from unittest.mock import Mock, AsyncMock
+
+import src.storage
+from src.metrics import collect_metrics, log_metrics
+from src.storage import ScratchSpace
+
+
+@pytest.fixture
+def application(mocker, tmp_path):
+    mocker.patch.object(src.storage, "_scratch_space", ScratchSpace(str(tmp_path), quota=1024))
+
+    application_mock = Mock()
+    application_mock.update_queue = asyncio.Queue()
+    application_mock.bot_data = {}
+    return application_mock
+
+
+@pytest.mark.asyncio
+async def test_collect_metrics(application):
+    """Normal flow - the metrics tell the pending updates and the scratch space usage, and the task queue metrics once
+    the task workers are started."""
+
+    await application.update_queue.put(Mock())
+    assert await collect_metrics(application) == {
+        'pending_updates': 1, 'scratch': {'jobs': 0, 'reserved': 0, 'used': 0, 'quota': 1024}}
+
+    workers = Mock()
+    workers.metrics = AsyncMock(return_value={'pending': 3, 'running': 1})
+    application.bot_data['tasks'] = workers
+
+    assert (await collect_metrics(application))['tasks'] == {'pending': 3, 'running': 1}
+
+
+@pytest.mark.asyncio
+async def test_log_metrics(application, caplog):
+    """The metrics are logged as JSON periodically, and a failure to collect them doesn't stop the logging."""
+
+    calls = 0
+
+    async def metrics():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError
+        return {'pending': 0}
+
+    workers = Mock()
+    workers.metrics = metrics
+    application.bot_data['tasks'] = workers
+
+    with caplog.at_level(logging.INFO, logger="src.metrics"):
+        logging_task = asyncio.create_task(log_metrics(application, interval=0.01))
+        await asyncio.sleep(0.1)
+        logging_task.cancel()
+        await asyncio.gather(logging_task, return_exceptions=True)
+
+    lines = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Metrics: ")]
+    assert lines
+    assert json.loads(lines[0][len("Metrics: "):])['tasks'] == {'pending': 0}
+    assert any(record.levelno == logging.ERROR for record in caplog.records)
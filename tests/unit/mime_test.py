@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pytest_mock import MockerFixture
+
+import src.mime
+from src.definitions.definitions import FILES_DIR
+from src.mime import resolve_mime_type, sniff_mime_type, get_magic, SNIFF_SIZE
+
+
+@pytest.fixture(autouse=True)
+def run_around_tests(mocker: MockerFixture):
+    # Every test loads its own libmagic handle
+    mocker.patch.object(src.mime, "_magic", None)
+    yield
+
+
+def sample_head() -> bytes:
+    with open(FILES_DIR + "sample.mp3", 'rb') as file:
+        return file.read(SNIFF_SIZE)
+
+
+def test_declared_mime_type_is_trusted(mocker: MockerFixture):
+    """A specific MIME type the file came with is used without looking at the file."""
+    magic = mocker.patch.object(src.mime, "get_magic")
+
+    assert resolve_mime_type("audio/mpeg", audio_format="opus-160", head=b"audio") == "audio/mpeg"
+    magic.assert_not_called()
+
+
+def test_audio_format_mime_type(mocker: MockerFixture):
+    """The MIME type of a known format is used without reading the file."""
+    magic = mocker.patch.object(src.mime, "get_magic")
+    file_open = mocker.patch("builtins.open")
+
+    assert resolve_mime_type(audio_format="mp3-320", path="/not/read.mp3") == "audio/mpeg"
+    assert resolve_mime_type("application/octet-stream", audio_format="opus-129") == "audio/ogg"
+    magic.assert_not_called()
+    file_open.assert_not_called()
+
+
+def test_generic_mime_type_is_sniffed():
+    """Generic MIME types and unknown formats fall through to the content of the file."""
+    assert resolve_mime_type("application/octet-stream", audio_format="unknown", head=sample_head()) == "audio/mpeg"
+    assert resolve_mime_type(path=FILES_DIR + "sample.mp3") == "audio/mpeg"
+
+
+def test_unknown_mime_type():
+    """Files nothing is known about get the default MIME type."""
+    assert resolve_mime_type() == "application/octet-stream"
+    assert resolve_mime_type("", head=b"") == "application/octet-stream"
+
+
+def test_sniff_mime_type():
+    """Only the first bytes of a file are sniffed, and MP3s are told even with a big ID3 tag."""
+    with open(FILES_DIR + "sample.mp3", 'rb') as file:
+        content = file.read()
+
+    assert sniff_mime_type(content) == "audio/mpeg"
+    assert sniff_mime_type(b"%PDF-1.4\n" + bytes(SNIFF_SIZE)) == "application/pdf"
+
+
+def test_magic_handle_is_shared(mocker: MockerFixture):
+    """A single libmagic handle is loaded, even when it's first used from several threads at once."""
+    magic = mocker.spy(src.mime.magic, "Magic")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        handles = list(executor.map(lambda _: get_magic(), range(16)))
+
+    magic.assert_called_once_with(mime=True)
+    assert all(handle is handles[0] for handle in handles)
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from src.exceptions import JobTimeout, JobFailed
+from src.pool import ProcessPool
+
+
+# Jobs (module-level so they can be run on job processes) -----------------
+def add_job(report, a, b):
+    return a + b
+
+
+def progress_job(report, steps):
+    for step in range(steps):
+        report(step)
+    return "done"
+
+
+def failing_job(report):
+    raise ValueError("failed")
+
+
+def unpicklable_failing_job(report):
+    error = ValueError("failed")
+    error.callback = lambda: None
+    raise error
+
+
+def sleeping_job(report, seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def pid_job(report):
+    return os.getpid()
+
+
+def unpicklable_result_job(report):
+    return lambda: None
+
+
+def streaming_job(report, count):
+    # Sends when each value was sent, to tell if sending was held back
+    for i in range(count):
+        report(time.monotonic())
+    return "done"
+
+
+# Process pool -----------------
+@pytest.mark.asyncio
+async def test_run_returns_result():
+    """Normal flow - the job runs on another process and its result is returned."""
+
+    pool = ProcessPool(1)
+
+    assert await pool.run(add_job, 1, 2) == 3
+
+
+@pytest.mark.asyncio
+async def test_run_reports_progress():
+    """Progress sent by the job is handed to the callback, in order."""
+
+    pool = ProcessPool(1)
+    progress = []
+
+    async def on_progress(value):
+        progress.append(value)
+
+    result = await pool.run(progress_job, 5, on_progress=on_progress)
+
+    assert result == "done"
+    assert progress == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_run_raises_job_exception():
+    """Exceptions raised by the job are raised on the caller."""
+
+    pool = ProcessPool(1)
+
+    with pytest.raises(ValueError):
+        await pool.run(failing_job)
+
+
+@pytest.mark.asyncio
+async def test_run_timeout():
+    """Jobs taking longer than the timeout are killed."""
+
+    pool = ProcessPool(1)
+
+    start = time.monotonic()
+    with pytest.raises(JobTimeout):
+        await pool.run(sleeping_job, 30, timeout=0.5)
+
+    assert time.monotonic() - start < 10
+
+
+@pytest.mark.asyncio
+async def test_run_cancel():
+    """Cancelled jobs are killed and free their slot for the next job."""
+
+    pool = ProcessPool(1)
+
+    task = asyncio.create_task(pool.run(sleeping_job, 30))
+    await asyncio.sleep(0.5)
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert await asyncio.wait_for(pool.run(add_job, 2, 2), timeout=10) == 4
+
+
+@pytest.mark.asyncio
+async def test_run_parallel():
+    """Jobs run in parallel up to the pool size."""
+
+    pool = ProcessPool(2)
+
+    start = time.monotonic()
+    results = await asyncio.gather(pool.run(sleeping_job, 1), pool.run(sleeping_job, 1))
+    parallel = time.monotonic() - start
+
+    assert results == [1, 1]
+
+    pool = ProcessPool(1)
+
+    start = time.monotonic()
+    await asyncio.gather(pool.run(sleeping_job, 1), pool.run(sleeping_job, 1))
+    sequential = time.monotonic() - start
+
+    assert parallel < sequential
+
+
+@pytest.mark.asyncio
+async def test_run_unpicklable_exception():
+    """Exceptions that can't be sent back are turned into a generic failure."""
+
+    pool = ProcessPool(1)
+
+    with pytest.raises(JobFailed):
+        await pool.run(unpicklable_failing_job)
+
+
+@pytest.mark.asyncio
+async def test_workers_are_reused():
+    """Jobs run on the same worker process, instead of a new one each."""
+
+    pool = ProcessPool(1)
+    try:
+        pids = [await pool.run(pid_job) for _ in range(3)]
+        with pytest.raises(ValueError):
+            await pool.run(failing_job)
+
+        # A job raising an exception doesn't take its worker down
+        assert await pool.run(pid_job) == pids[0]
+        assert len(set(pids)) == 1 and pids[0] != os.getpid()
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_timed_out_worker_is_replaced():
+    """The worker of a job that timed out is killed, and the next job gets a new one."""
+
+    pool = ProcessPool(1)
+    try:
+        pid = await pool.run(pid_job)
+        with pytest.raises(JobTimeout):
+            await pool.run(sleeping_job, 30, timeout=0.5)
+
+        assert await pool.run(pid_job) != pid
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_are_recycled():
+    """Workers are replaced after 'max_jobs' jobs."""
+
+    pool = ProcessPool(1, max_jobs=2)
+    try:
+        pids = [await pool.run(pid_job) for _ in range(4)]
+
+        assert pids[0] == pids[1] != pids[2] == pids[3]
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_run_unpicklable_result():
+    """Results that can't be sent back fail the job, instead of leaving it waiting."""
+
+    pool = ProcessPool(1)
+    try:
+        with pytest.raises(JobFailed):
+            await asyncio.wait_for(pool.run(unpicklable_result_job), timeout=10)
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_progress_backpressure():
+    """A job sending progress faster than it's handled is held back once 'buffer' values are waiting."""
+
+    count, buffer, handling_seconds = 10, 2, 0.05
+    handled = []
+
+    async def on_progress(sent_at):
+        await asyncio.sleep(handling_seconds)
+        handled.append(sent_at)
+
+    pool = ProcessPool(1, buffer=buffer)
+    try:
+        assert await pool.run(streaming_job, count, on_progress=on_progress) == "done"
+    finally:
+        pool.close()
+
+    # Without a buffer, every value would be sent right away
+    assert len(handled) == count
+    assert handled[-1] - handled[0] >= (count - buffer - 3) * handling_seconds
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+
+import pytest
+from unittest.mock import AsyncMock
+
+from telegram.error import BadRequest, RetryAfter
+
+from src.progress import ProgressReporter, BatchProgress
+
+
+def sent_texts(message_mock) -> list:
+    return [call.args[0] for call in message_mock.edit_text.call_args_list]
+
+
+@pytest.mark.asyncio
+async def test_updates_are_merged():
+    """Normal flow - many updates in a short time result in a single edit with the latest text."""
+
+    message_mock = AsyncMock()
+    reporter = ProgressReporter(message_mock, interval=0.2)
+
+    for progress in range(100):
+        reporter.post(f"Uploading: {progress}%")
+    await asyncio.sleep(0.05)
+
+    assert sent_texts(message_mock) == ["Uploading: 99%"]
+
+
+@pytest.mark.asyncio
+async def test_edits_are_throttled():
+    """Edits are at least 'interval' seconds apart."""
+
+    message_mock = AsyncMock()
+    reporter = ProgressReporter(message_mock, interval=0.2)
+
+    reporter.post("Uploading: 10%")
+    await asyncio.sleep(0.05)
+    reporter.post("Uploading: 20%")
+    reporter.post("Uploading: 30%")
+    await asyncio.sleep(0.05)
+
+    assert sent_texts(message_mock) == ["Uploading: 10%"]
+
+    await asyncio.sleep(0.2)
+
+    assert sent_texts(message_mock) == ["Uploading: 10%", "Uploading: 30%"]
+
+
+@pytest.mark.asyncio
+async def test_unchanged_text_is_skipped():
+    """The message is not edited with the text it already shows."""
+
+    message_mock = AsyncMock()
+    reporter = ProgressReporter(message_mock, interval=0.05)
+
+    reporter.post("Uploading: 10%")
+    await asyncio.sleep(0.1)
+    reporter.post("Uploading: 10%")
+    await asyncio.sleep(0.1)
+    await reporter.finish("Uploading: 10%")
+
+    assert sent_texts(message_mock) == ["Uploading: 10%"]
+
+
+@pytest.mark.asyncio
+async def test_final_state_is_always_sent():
+    """The final state is sent right away and later updates are ignored."""
+
+    message_mock = AsyncMock()
+    reporter = ProgressReporter(message_mock, interval=10)
+
+    reporter.post("Uploading: 10%")
+    await asyncio.sleep(0.05)
+    reporter.post("Uploading: 90%")
+    await reporter.finish("Upload complete!")
+    reporter.post("Uploading: 95%")
+    await asyncio.sleep(0.05)
+
+    assert sent_texts(message_mock) == ["Uploading: 10%", "Upload complete!"]
+
+
+@pytest.mark.asyncio
+async def test_final_state_error_is_not_raised():
+    """A failed final edit, e.g. on flood control, doesn't fail the job that finished."""
+
+    message_mock = AsyncMock()
+    message_mock.edit_text.side_effect = RetryAfter(30)
+    reporter = ProgressReporter(message_mock, interval=10)
+
+    await reporter.finish("Upload complete!")
+
+    assert sent_texts(message_mock) == ["Upload complete!"]
+
+
+@pytest.mark.asyncio
+async def test_updates_from_threads():
+    """Updates can be posted from worker threads."""
+
+    message_mock = AsyncMock()
+    reporter = ProgressReporter(message_mock, interval=0.05)
+
+    threads = [threading.Thread(target=reporter.post, args=(f"Uploading: {i}%",)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    await asyncio.sleep(0.1)
+
+    assert len(sent_texts(message_mock)) == 1
+    assert sent_texts(message_mock)[0].startswith("Uploading:")
+
+
+@pytest.mark.asyncio
+async def test_failed_edits_are_ignored():
+    """Telegram errors on progress edits don't stop later updates."""
+
+    message_mock = AsyncMock()
+    message_mock.edit_text.side_effect = [BadRequest("flood"), None]
+    reporter = ProgressReporter(message_mock, interval=0.05)
+
+    reporter.post("Uploading: 10%")
+    await asyncio.sleep(0.01)
+    reporter.post("Uploading: 20%")
+    await asyncio.sleep(0.1)
+
+    assert sent_texts(message_mock) == ["Uploading: 10%", "Uploading: 20%"]
+
+
+@pytest.mark.asyncio
+async def test_close_drops_pending_updates():
+    """Closing the reporter drops updates waiting to be sent."""
+
+    message_mock = AsyncMock()
+    reporter = ProgressReporter(message_mock, interval=0.1)
+
+    reporter.post("Uploading: 10%")
+    await asyncio.sleep(0.01)
+    reporter.post("Uploading: 20%")
+    reporter.close()
+    await asyncio.sleep(0.2)
+
+    assert sent_texts(message_mock) == ["Uploading: 10%"]
+
+
+@pytest.mark.asyncio
+async def test_batch_progress():
+    """Every item of a batch is shown on the same message, with the last line of its updates as its state."""
+
+    message_mock = AsyncMock()
+    batch = BatchProgress(message_mock, "Downloading 2 songs", ["first", "second"], interval=0.05)
+
+    await batch.item(0).edit_text("Got it!\nDownloading from Youtube: 50%", parse_mode="Markdown")
+    await asyncio.sleep(0.01)
+
+    assert sent_texts(message_mock) == ["Downloading 2 songs\n1. first - Downloading from Youtube: 50%\n"
+                                        "2. second - Waiting ⏳"]
+    assert message_mock.edit_text.call_args.kwargs['parse_mode'] is None
+
+    batch.set(1, "Download failed ❌")
+    await batch.finish("Done!")
+
+    assert sent_texts(message_mock)[-1] == "Downloading 2 songs\n1. first - Downloading from Youtube: 50%\n" \
+                                           "2. second - Download failed ❌\n\nDone!"
+
+
+@pytest.mark.asyncio
+async def test_batch_progress_max_lines():
+    """With a maximum number of lines, finished items are only counted."""
+
+    message_mock = AsyncMock()
+    batch = BatchProgress(message_mock, "Playlist", interval=0.01, max_lines=2)
+
+    for name in ["first", "second", "third"]:
+        batch.add(name)
+    batch.set(0, "uploaded ✅", finished=True)
+    await batch.finish("Done!")
+
+    assert sent_texts(message_mock)[-1] == "Playlist\n1 of 3 done\n2. second - Waiting ⏳\n3. third - Waiting ⏳\n\nDone!"
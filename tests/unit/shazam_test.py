@@ -1,16 +1,47 @@
 import asyncio
+import io
+import shutil
+import threading
 
 import pytest
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, AsyncMock, patch
 
+import src.models
 import src.services.shazam
-from src.exceptions import RemoveFileFailed, TrackNotFound
-from src.services.shazam import shazam
-from src.models import File, Action, ShazamTrack
+from src.definitions.definitions import FILES_DIR
+from src.exceptions import RemoveFileFailed, TrackNotFound, AudioDecodeFail
+from src.services.shazam import shazam, shazam_excerpt, cached_recognition, RecognitionCache, ShazamClient, \
+    RateLimiter, recognize_tracklist, merge_tracklist, split_windows, _fingerprint_windows
+from src.models import File, Action, ShazamTrack, TracklistEntry
 from telegram.ext import (
     CallbackContext
 )
 
+RECOGNIZED_SONG = {
+    "track": {
+        "title": 'Goodbye To a World',
+        "subtitle": 'Porter Robinson',
+        "images": {"coverarthq": "www.randomurl.com"},
+        "hub": {"providers": [{"caption": "randomcaption", "actions": [{"uri": "randomuri"}]}]}
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def recognition_cache(mocker, tmp_path):
+    """Empty cache of recognitions for each test."""
+    cache = RecognitionCache(str(tmp_path / "shazam.sqlite3"))
+    mocker.patch.object(src.services.shazam, "_recognition_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def sample_file(mocker, tmp_path) -> File:
+    """Copy of the sample song, sent with a Telegram file ID."""
+    mocker.patch("src.models.FILES_DIR", str(tmp_path) + "/")
+    shutil.copy(FILES_DIR + "sample.mp3", tmp_path / "sample.mp3")
+    return File(Action.SHAZAM, "sample.mp3", "19029395", "audio/mpeg", "81298222", "unique")
+
 
 def test_normal():
     """Normal behaviour - receives the path of a file and checks it on Shazam."""
@@ -133,3 +164,295 @@ def test_error_while_serializing_track(mocker):
             )
 
 
+
+
+def test_recognition_cache(tmp_path):
+    """Recognitions are found by any of their keys, also by a new cache on the same file."""
+
+    cache = RecognitionCache(str(tmp_path / "shazam.sqlite3"))
+    cache.add(["telegram:a", "sha256:a"], ShazamTrack(RECOGNIZED_SONG))
+
+    assert cache.get(["telegram:b", "sha256:a"]).title == 'Goodbye To a World'
+    assert cache.get(["telegram:b"]) is None
+
+    cache = RecognitionCache(str(tmp_path / "shazam.sqlite3"))
+    assert cache.get(["telegram:a"]).subtitle == 'Porter Robinson'
+
+
+def test_recognition_cache_not_found(tmp_path, mocker):
+    """Songs that weren't found are cached for a shorter time."""
+
+    cache = RecognitionCache(str(tmp_path / "shazam.sqlite3"), ttl=100, not_found_ttl=10)
+    cache.add(["sha256:found"], ShazamTrack(RECOGNIZED_SONG))
+    cache.add(["sha256:not-found"], None)
+
+    with pytest.raises(TrackNotFound):
+        cache.get(["sha256:not-found"])
+
+    time_mock = mocker.patch.object(src.services.shazam.time, "time")
+    time_mock.return_value = 10 ** 12
+
+    assert cache.get(["sha256:not-found"]) is None
+    assert cache.get(["sha256:found"]) is None
+
+
+def test_recognition_cache_lru(tmp_path):
+    """Only the most recently used recognitions are kept in memory."""
+
+    cache = RecognitionCache(str(tmp_path / "shazam.sqlite3"), max_entries=2)
+    cache.add(["a"], ShazamTrack(RECOGNIZED_SONG))
+    cache.add(["b"], ShazamTrack(RECOGNIZED_SONG))
+    cache.get(["a"])
+    cache.add(["c"], None)
+
+    assert list(cache._entries) == ["a", "c"]
+
+    # Evicted entries are still found on disk
+    assert cache.get(["b"]) is not None
+
+
+@pytest.mark.asyncio
+async def test_cached_recognition(mocker, sample_file):
+    """The same song is only sent to Shazam once, whether it's sent again as the same Telegram file or as another."""
+
+    client_mock = AsyncMock()
+    client_mock.recognize_song.return_value = RECOGNIZED_SONG
+    mocker.patch.object(src.services.shazam, "_shazam_client", client_mock)
+
+    track = await shazam(sample_file, Mock())
+    assert track.title == 'Goodbye To a World'
+
+    # Same Telegram file - found without downloading it
+    assert (await cached_recognition(sample_file)).title == 'Goodbye To a World'
+
+    # Another Telegram file with the same content
+    shutil.copy(FILES_DIR + "sample.mp3", src.models.FILES_DIR + "sample.mp3")
+    other_file = File(Action.SHAZAM, "sample.mp3", "1", "audio/mpeg", "81298222", "other")
+    assert await cached_recognition(other_file) is None
+    assert (await shazam(other_file, Mock())).title == 'Goodbye To a World'
+
+    client_mock.recognize_song.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_cached_recognition_off_the_event_loop(mocker, recognition_cache, sample_file):
+    """The cache is on disk, so it's looked up on another thread."""
+
+    threads = []
+    get = recognition_cache.get
+    mocker.patch.object(recognition_cache, "get", lambda keys: threads.append(threading.get_ident()) or get(keys))
+
+    assert await cached_recognition(sample_file) is None
+    assert threads and threading.get_ident() not in threads
+
+
+@pytest.mark.asyncio
+async def test_cached_recognition_not_found(mocker, sample_file):
+    """Songs Shazam didn't find aren't sent again while cached."""
+
+    client_mock = AsyncMock()
+    client_mock.recognize_song.return_value = {"matches": []}
+    mocker.patch.object(src.services.shazam, "_shazam_client", client_mock)
+
+    with pytest.raises(TrackNotFound):
+        await shazam(sample_file, Mock())
+
+    with pytest.raises(TrackNotFound):
+        await cached_recognition(sample_file)
+
+    client_mock.recognize_song.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_shazam_client_session():
+    """The HTTP session is shared by all requests made on the same event loop."""
+
+    client = ShazamClient()
+    session = client._get_session()
+
+    assert client._get_session() is session
+
+    await client.close()
+    assert session.closed
+    assert client._get_session() is not session
+    await client.close()
+
+
+def mocked_ffmpeg(mocker, samples: bytes, returncode: int = 0, errors: bytes = b""):
+    """
+    Mocks the ffmpeg process decoding the excerpts.
+    @return: mocked 'create_subprocess_exec' function.
+    """
+    process_mock = AsyncMock()
+    process_mock.communicate.return_value = (samples, errors)
+    process_mock.returncode = returncode
+
+    exec_mock = AsyncMock(return_value=process_mock)
+    mocker.patch.object(src.services.shazam.asyncio, "create_subprocess_exec", exec_mock)
+    return exec_mock
+
+
+@pytest.mark.asyncio
+async def test_shazam_excerpt(mocker):
+    """Only a few seconds from the middle of the song are decoded and recognized."""
+
+    exec_mock = mocked_ffmpeg(mocker, b"\x00\x00" * 16000 * 12)
+
+    client_mock = AsyncMock()
+    client_mock.recognize_song.return_value = RECOGNIZED_SONG
+    mocker.patch.object(src.services.shazam, "_shazam_client", client_mock)
+
+    file = File(Action.SHAZAM, "set.mp3", "1", "audio/mpeg", "81298222", "unique", 3600)
+    track = await shazam_excerpt(file, "https://api.telegram.org/file/bot123/music/set.mp3", seconds=12)
+
+    assert track.title == 'Goodbye To a World'
+
+    args = exec_mock.call_args[0]
+    assert args[args.index('-ss') + 1] == "1794.0"
+    assert args[args.index('-t') + 1] == "12"
+    assert args[args.index('-i') + 1] == "https://api.telegram.org/file/bot123/music/set.mp3"
+
+    audio = client_mock.recognize_song.call_args[0][0]
+    assert audio.duration_seconds == 12
+
+    # Cached by the Telegram file
+    assert (await cached_recognition(file)).title == 'Goodbye To a World'
+
+
+@pytest.mark.asyncio
+async def test_shazam_excerpt_decode_error(mocker):
+    """Erroring because ffmpeg couldn't fetch or decode the excerpt."""
+
+    url = "https://api.telegram.org/file/bot123:SECRET-token_x/music/set.mp3"
+    mocked_ffmpeg(mocker, b"", returncode=1, errors=url.encode() + b": Server returned 404 Not Found\n")
+
+    client_mock = AsyncMock()
+    mocker.patch.object(src.services.shazam, "_shazam_client", client_mock)
+
+    file = File(Action.SHAZAM, "set.mp3", "1", "audio/mpeg", "81298222", "unique", 3600)
+    with pytest.raises(AudioDecodeFail, match="404") as error:
+        await shazam_excerpt(file, url)
+
+    # The bot token in the URL isn't leaked to the logs
+    assert "SECRET" not in repr(error.value)
+    client_mock.recognize_song.assert_not_called()
+
+
+def recognized_song(title: str) -> dict:
+    return {"track": {**RECOGNIZED_SONG["track"], "title": title}}
+
+
+def test_split_windows():
+    """Windows overlap, and the end of the stream is only split off if it's not in the last window already."""
+
+    windows = list(split_windows([b"0123", b"45", b"6789"], window_size=4, step_size=3))
+    assert windows == [(0, b"0123"), (3, b"3456"), (6, b"6789")]
+
+    windows = list(split_windows([b"012345678"], window_size=4, step_size=3))
+    assert windows == [(0, b"0123"), (3, b"3456"), (6, b"678")]
+
+    # Shorter than a window
+    assert list(split_windows([b"01"], window_size=4, step_size=3)) == [(0, b"01")]
+
+
+def test_merge_tracklist():
+    """The same song recognized on consecutive windows is one entry, even with unrecognized windows in between."""
+
+    a = ShazamTrack(recognized_song("A"))
+    b = ShazamTrack(recognized_song("B"))
+
+    entries = merge_tracklist({0: a, 10: a, 20: None, 30: a, 40: b, 50: None, 60: a}, window=12)
+
+    assert entries == [TracklistEntry(0, 42, "A", "Porter Robinson"),
+                       TracklistEntry(40, 52, "B", "Porter Robinson"),
+                       TracklistEntry(60, 72, "A", "Porter Robinson")]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter():
+    """Calls are spaced out by the rate."""
+
+    limiter = RateLimiter(rate=20)
+    loop = asyncio.get_running_loop()
+
+    start = loop.time()
+    for _ in range(5):
+        await limiter.wait()
+
+    assert loop.time() - start >= 0.19
+
+
+@pytest.mark.asyncio
+async def test_recognize_tracklist(mocker):
+    """Normal flow - fingerprinted windows are recognized concurrently and merged into a tracklist."""
+
+    async def fingerprint(fn, source, window, step, on_progress):
+        assert source == "https://api.telegram.org/file/bot123/music/set.mp3"
+        for start, signature in [(0, "a"), (10, "a"), (20, None), (30, "b"), (40, "error")]:
+            on_progress((start, signature))
+
+    def send_recognize_request(signature):
+        if signature == "error":
+            raise ValueError("Shazam is down")
+        return recognized_song(signature)
+
+    client_mock = AsyncMock()
+    client_mock.send_recognize_request.side_effect = send_recognize_request
+    mocker.patch.object(src.services.shazam, "_shazam_client", client_mock)
+    mocker.patch.object(src.services.shazam.tracklist_pool, "run", fingerprint)
+
+    progress = []
+    entries = await recognize_tracklist("https://api.telegram.org/file/bot123/music/set.mp3", on_progress=progress.append,
+                                        window=12, step=10, concurrency=2, rate=1000)
+
+    assert entries == [TracklistEntry(0, 22, "a", "Porter Robinson"), TracklistEntry(30, 42, "b", "Porter Robinson")]
+    assert client_mock.send_recognize_request.call_count == 4
+    assert sorted(progress) == [1, 2, 3, 4, 5]
+
+
+def test_fingerprint_windows(mocker):
+    """The mix is decoded by one ffmpeg process and each window is fingerprinted."""
+
+    process_mock = Mock()
+    process_mock.stdout = io.BytesIO(b"\x00\x00" * 16000 * 25)
+    process_mock.stderr = io.BytesIO(b"")
+    process_mock.wait.return_value = 0
+    process_mock.poll.return_value = 0
+
+    popen_mock = mocker.patch.object(src.services.shazam.subprocess, "Popen", return_value=process_mock)
+    mocker.patch.object(src.services.shazam, "_signature", lambda audio: audio.duration_seconds)
+
+    reports = []
+    _fingerprint_windows(reports.append, "set.mp3", 12, 10)
+
+    popen_mock.assert_called_once()
+    assert reports == [(0, 12), (10, 12), (20, 5)]
+
+
+def test_fingerprint_windows_decode_error(mocker):
+    """Erroring because ffmpeg couldn't decode the mix."""
+
+    process_mock = Mock()
+    process_mock.stdout = io.BytesIO(b"")
+    process_mock.stderr = io.BytesIO(b"[https @ 0x1] Opening 'https://api.telegram.org/file/bot123:SECRET/set.mp3'\n"
+                                     b"https://api.telegram.org/file/bot123:SECRET/set.mp3: Invalid data found when "
+                                     b"processing input\n")
+    process_mock.wait.return_value = 1
+    process_mock.poll.return_value = 1
+    process_mock.returncode = 1
+
+    mocker.patch.object(src.services.shazam.subprocess, "Popen", return_value=process_mock)
+
+    with pytest.raises(AudioDecodeFail, match="Invalid data") as error:
+        _fingerprint_windows(Mock(), "https://api.telegram.org/file/bot123:SECRET/set.mp3", 12, 10)
+
+    assert "SECRET" not in repr(error.value)
+
+
+def test_decode_error_masks_bot_tokens():
+    """Tokens are masked even where ffmpeg writes the URL differently than it was given."""
+
+    error = src.services.shazam._decode_error("https://api.telegram.org/file/bot123:SECRET/a%20b.mp3", 1,
+                                              b"https://api.telegram.org/file/bot123:SECRET/a b.mp3: 404 Not Found")
+
+    assert str(error) == "ffmpeg failed with code 1: https://api.telegram.org/file/bot<token>/a b.mp3: 404 Not Found"
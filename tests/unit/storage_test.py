@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+import pytest
+
+from src.storage import ScratchSpace
+
+
+@pytest.mark.asyncio
+async def test_job_paths(tmp_path):
+    """Each job gets its own directory, removed when the job is done."""
+
+    scratch = ScratchSpace(str(tmp_path / "scratch"), quota=1024)
+
+    async with scratch.job(10) as first, scratch.job(10) as second:
+        assert first.path("song.mp3") != second.path("song.mp3")
+
+        # Titles can't point out of the job's directory
+        assert os.path.dirname(first.path("../../song/name.mp3")) == first.directory
+        assert first.path("..") == os.path.join(first.directory, "file")
+
+        with open(first.path("song.mp3"), 'wb') as file:
+            file.write(b"audio")
+
+        assert scratch.usage() == {'jobs': 2, 'reserved': 20, 'used': 5, 'quota': 1024}
+
+    assert os.listdir(tmp_path / "scratch") == []
+    assert scratch.usage() == {'jobs': 0, 'reserved': 0, 'used': 0, 'quota': 1024}
+
+
+@pytest.mark.asyncio
+async def test_job_cleaned_up_on_failure(tmp_path):
+    """The files of a job that failed are removed."""
+
+    scratch = ScratchSpace(str(tmp_path / "scratch"), quota=1024)
+
+    with pytest.raises(ValueError):
+        async with scratch.job(10) as job:
+            with open(job.path("song.mp3"), 'wb') as file:
+                file.write(b"audio")
+            raise ValueError
+
+    assert os.listdir(tmp_path / "scratch") == []
+    assert scratch.usage()['reserved'] == 0
+
+
+@pytest.mark.asyncio
+async def test_quota_backpressure(tmp_path):
+    """Jobs wait for others to end if they'd exceed the quota."""
+
+    scratch = ScratchSpace(str(tmp_path / "scratch"), quota=100)
+    order = []
+
+    async def run(name: str, size: int, duration: float):
+        async with scratch.job(size):
+            order.append(name + " started")
+            await asyncio.sleep(duration)
+        order.append(name + " done")
+
+    await asyncio.gather(run("a", 60, 0.05), run("b", 60, 0), run("c", 1000, 0))
+
+    assert order == ["a started", "a done", "b started", "b done", "c started", "c done"]
+
+
+def test_leftovers_removed_on_start(tmp_path):
+    """Files left by the jobs of a previous run are removed."""
+
+    os.makedirs(tmp_path / "scratch" / "job")
+    (tmp_path / "scratch" / "job" / "song.mp3").write_bytes(b"audio")
+
+    ScratchSpace(str(tmp_path / "scratch"))
+
+    assert os.listdir(tmp_path / "scratch") == []
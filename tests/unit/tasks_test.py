@@ -0,0 +1,544 @@
+import asyncio
+import math
+import sqlite3
+
+import pytest
+from unittest.mock import Mock, AsyncMock
+
+from src.exceptions import GoogleDriveUploadFail, TrackNotFound, TaskRateLimited, TaskDeferred
+from src.tasks import TaskQueue, TaskWorkers, Checkpoints, TokenBuckets, FairSlots, parse_chat_weights
+
+
+@pytest.fixture
+def queue(tmp_path):
+    task_queue = TaskQueue(str(tmp_path / "tasks.sqlite3"))
+    yield task_queue
+    task_queue.close()
+
+
+# Task queue -----------------
+def test_put_and_claim(queue):
+    """Normal flow - tasks are claimed in order, one at a time."""
+
+    first_id = queue.put("youtube", {"url": "first"})
+    second_id = queue.put("youtube", {"url": "second"})
+
+    first = queue.claim()
+    second = queue.claim()
+
+    assert (first.id, first.kind, first.payload, first.attempts) == (first_id, "youtube", {"url": "first"}, 1)
+    assert second.id == second_id
+    assert queue.claim() is None
+
+
+def test_complete(queue):
+    """Completed tasks are removed from the queue."""
+
+    queue.put("youtube", {})
+    task = queue.claim()
+    queue.complete(task.id)
+
+    queue.recover()
+    assert queue.claim() is None
+
+
+def test_retry(queue):
+    """Retried tasks are only available after the delay and keep their number of attempts."""
+
+    queue.put("youtube", {})
+    task = queue.claim()
+
+    queue.retry(task.id, delay=60)
+    assert queue.claim() is None
+    assert queue.pending_count() == 1
+
+    queue.retry(task.id, delay=0)
+    assert queue.claim().attempts == 2
+
+
+def test_fail(queue):
+    """Failed tasks are not claimed again."""
+
+    queue.put("youtube", {})
+    task = queue.claim()
+    queue.fail(task.id, "error")
+
+    queue.recover()
+    assert queue.claim() is None
+    assert queue.pending_count() == 0
+
+
+def test_recover_after_restart(tmp_path):
+    """Tasks left running when the bot stopped are picked up again."""
+
+    path = str(tmp_path / "tasks.sqlite3")
+
+    queue = TaskQueue(path)
+    queue.put("youtube", {"url": "unfinished"})
+    queue.claim()
+    queue.close()
+
+    queue = TaskQueue(path)
+    assert queue.claim() is None
+    assert queue.recover() == 1
+    assert queue.claim().payload == {"url": "unfinished"}
+    queue.close()
+
+
+def test_claim_is_fair_across_users(queue):
+    """A user queueing many tasks doesn't hold up the other users of the chat."""
+
+    for i in range(5):
+        queue.put("youtube", {"user": 1, "i": i}, chat_id=10, user_id=1)
+    queue.put("youtube", {"user": 2, "i": 0}, chat_id=10, user_id=2)
+    queue.put("youtube", {"user": 3, "i": 0}, chat_id=10, user_id=3)
+
+    claimed = [queue.claim().payload for _ in range(7)]
+
+    assert [payload["user"] for payload in claimed] == [1, 2, 3, 1, 1, 1, 1]
+    assert [payload["i"] for payload in claimed if payload["user"] == 1] == list(range(5))
+
+
+def test_claim_is_fair_across_chats(tmp_path):
+    """Chats take turns in proportion to their weights, whatever their number of users."""
+
+    queue = TaskQueue(str(tmp_path / "tasks.sqlite3"), chat_weights={20: 2})
+    for user_id in range(1, 4):
+        for _ in range(4):
+            queue.put("youtube", {"chat": 10}, chat_id=10, user_id=user_id)
+    for _ in range(8):
+        queue.put("youtube", {"chat": 20}, chat_id=20, user_id=1)
+
+    claimed = [queue.claim().payload["chat"] for _ in range(9)]
+    queue.close()
+
+    assert claimed.count(20) == 6
+    assert claimed.count(10) == 3
+
+
+def test_idle_lanes_do_not_build_up_turns(queue):
+    """A user that had nothing queued takes turns with the others, instead of catching up on the missed ones."""
+
+    for _ in range(4):
+        queue.put("youtube", {"user": 1}, chat_id=10, user_id=1)
+    for _ in range(3):
+        queue.claim()
+
+    for _ in range(3):
+        queue.put("youtube", {"user": 2}, chat_id=10, user_id=2)
+    queue.put("youtube", {"user": 1}, chat_id=10, user_id=1)
+
+    assert [queue.claim().payload["user"] for _ in range(5)] == [2, 1, 2, 2, 1]
+
+
+def test_position(tmp_path):
+    """The position of a new task counts the tasks of every lane that would be claimed before it."""
+
+    queue = TaskQueue(str(tmp_path / "tasks.sqlite3"), chat_weights={20: 2})
+    assert queue.position(10, 1) == 0
+
+    for _ in range(5):
+        queue.put("youtube", {}, chat_id=10, user_id=1)
+    queue.put("youtube", {}, chat_id=10, user_id=2)
+    for _ in range(5):
+        queue.put("youtube", {}, chat_id=20, user_id=3)
+
+    # A task of a new user of chat 10 goes after the first tasks of users 1 and 2, and the 5 of chat 20, which takes
+    # two turns for each one of chat 10
+    assert queue.position(10, 4) == 7
+    # User 1's task goes after their 5, the one of user 2 and the 5 of chat 20
+    assert queue.position(10, 1) == 11
+    # A new chat only waits for the next task of each of the others
+    assert queue.position(30, 5) == 2
+    queue.close()
+
+
+def test_claim_reports_wait(queue):
+    """Claimed tasks tell how long they waited on the queue."""
+
+    queue.put("youtube", {})
+    task = queue.claim()
+
+    assert 0 <= task.waited < 1
+
+
+def test_stats(queue):
+    """The stats tell the depth of the queue and the wait of its oldest available task."""
+
+    assert queue.stats() == {'pending': 0, 'lanes': 0, 'oldest_wait': 0}
+
+    queue.put("youtube", {}, chat_id=10, user_id=1)
+    queue.put("youtube", {}, chat_id=10, user_id=1)
+    queue.put("youtube", {}, chat_id=10, user_id=2)
+
+    stats = queue.stats()
+    assert (stats['pending'], stats['lanes']) == (3, 2)
+    assert 0 <= stats['oldest_wait'] < 1
+
+
+def test_queue_without_lanes_is_migrated(tmp_path):
+    """Queues made before tasks had lanes get the columns added, and their tasks are still claimed."""
+
+    path = str(tmp_path / "tasks.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            error TEXT
+        )""")
+    connection.execute("INSERT INTO tasks (kind, payload, status, available_at, created_at) "
+                       "VALUES ('youtube', '{\"url\": \"old\"}', 'pending', 0, 0)")
+    connection.commit()
+    connection.close()
+
+    queue = TaskQueue(path)
+    queue.put("youtube", {"url": "new"}, chat_id=10, user_id=1)
+
+    assert [queue.claim().payload["url"] for _ in range(2)] == ["old", "new"]
+    queue.close()
+
+
+def test_parse_chat_weights():
+    assert parse_chat_weights("") == {}
+    assert parse_chat_weights("-1001234:2, 15552:0.5") == {-1001234: 2, 15552: 0.5}
+
+    with pytest.raises(ValueError):
+        parse_chat_weights("15552:0")
+
+
+# Rate limits -----------------
+def test_token_buckets():
+    """Each key can take up to the capacity at once, and then at the refill rate."""
+
+    now = 0
+    buckets = TokenBuckets(capacity=3, rate=0.5, clock=lambda: now)
+
+    assert [buckets.take("user") for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("user") == 2
+    assert buckets.take("other_user", 3) == 0
+
+    now = 1
+    assert buckets.take("user") == 1
+    now = 2
+    assert buckets.take("user") == 0
+
+    # Taking more than the capacity is never allowed, and leaves the bucket as it was
+    now = 10
+    assert buckets.take("user", 5) == math.inf
+    assert buckets.take("user", 3) == 0
+
+
+def test_token_buckets_forget_full_buckets():
+    now = 0
+    buckets = TokenBuckets(capacity=2, rate=1, clock=lambda: now)
+
+    buckets.take("user")
+    now = 5
+    buckets.take("other_user")
+
+    assert list(buckets._buckets) == ["other_user"]
+
+
+def test_token_buckets_disabled():
+    buckets = TokenBuckets(capacity=0, rate=0)
+
+    assert all(buckets.take("user") == 0 for _ in range(100))
+
+
+def test_token_buckets_wait_time():
+    """The time until a bucket holds enough tokens is worked out without taking them."""
+
+    now = 0
+    buckets = TokenBuckets(capacity=3, rate=0.5, clock=lambda: now)
+
+    assert buckets.wait_time("user", 3) == 0
+    assert buckets.take("user", 2) == 0
+    assert buckets.wait_time("user", 3) == 4
+    assert buckets.wait_time("user", 3) == 4
+    assert buckets.wait_time("user", 4) == math.inf
+
+
+# Song slots -----------------
+@pytest.mark.asyncio
+async def test_fair_slots():
+    """Parts waiting for a slot get them in turns across users, not in the order they asked for them."""
+
+    slots = FairSlots(1, chat_weights={})
+    order = []
+
+    async def part(user_id, name):
+        async with slots.slot(10, user_id):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    parts = [asyncio.create_task(part(1, name)) for name in ("a1", "a2", "a3")]
+    await asyncio.sleep(0)
+    parts.append(asyncio.create_task(part(2, "b1")))
+    await asyncio.gather(*parts)
+
+    assert order == ["a1", "b1", "a2", "a3"]
+    assert (slots.used, slots.waiting) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_fair_slots_cancelled():
+    """Parts cancelled while waiting don't take a slot, and the ones holding a slot give it back."""
+
+    slots = FairSlots(1, chat_weights={})
+    release = asyncio.Event()
+
+    async def part():
+        async with slots.slot(10, 1):
+            await release.wait()
+
+    holding = asyncio.create_task(part())
+    waiting = asyncio.create_task(part())
+    await asyncio.sleep(0)
+    assert (slots.used, slots.waiting) == (1, 1)
+
+    waiting.cancel()
+    holding.cancel()
+    await asyncio.gather(holding, waiting, return_exceptions=True)
+
+    assert (slots.used, slots.waiting) == (0, 0)
+
+
+# Task workers -----------------
+@pytest.mark.asyncio
+async def test_workers_process_tasks(queue):
+    """Normal flow - queued tasks are processed by the registered function and removed."""
+
+    run_mock = AsyncMock()
+    bot_mock = Mock()
+
+    workers = TaskWorkers(queue, bot_mock, concurrency=2)
+    workers.register("youtube", run_mock)
+    await workers.start()
+
+    for i in range(5):
+        await workers.enqueue("youtube", {"i": i})
+    await asyncio.sleep(0.5)
+    await workers.stop()
+
+    assert run_mock.call_count == 5
+    assert sorted(call.args[1]["i"] for call in run_mock.call_args_list) == list(range(5))
+    assert all(call.args[0] is bot_mock for call in run_mock.call_args_list)
+    assert queue.pending_count() == 0
+
+
+@pytest.mark.asyncio
+async def test_workers_concurrency(queue):
+    """No more tasks than the concurrency run at the same time."""
+
+    running = 0
+    max_running = 0
+
+    async def run(bot, payload):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+    workers = TaskWorkers(queue, Mock(), concurrency=3)
+    workers.register("youtube", run)
+    await workers.start()
+
+    for i in range(10):
+        await workers.enqueue("youtube", {})
+    await asyncio.sleep(1)
+    await workers.stop()
+
+    assert max_running == 3
+
+
+@pytest.mark.asyncio
+async def test_workers_retry_with_backoff(queue):
+    """Tasks failing with a retryable error are retried, and the failure callback is called once they give up."""
+
+    run_mock = AsyncMock(side_effect=GoogleDriveUploadFail)
+    on_failure_mock = AsyncMock()
+
+    workers = TaskWorkers(queue, Mock(), concurrency=1, max_attempts=3, backoff=0.2)
+    workers.register("youtube", run_mock, on_failure_mock)
+    await workers.start()
+
+    await workers.enqueue("youtube", {"url": "url"})
+    await asyncio.sleep(0.1)
+    assert run_mock.call_count == 1
+    on_failure_mock.assert_not_called()
+
+    await asyncio.sleep(1)
+    await workers.stop()
+
+    assert run_mock.call_count == 3
+    on_failure_mock.assert_called_once()
+    assert isinstance(on_failure_mock.call_args[0][2], GoogleDriveUploadFail)
+
+
+@pytest.mark.asyncio
+async def test_workers_other_errors_are_not_retried(queue):
+    """Tasks failing with other errors fail right away."""
+
+    run_mock = AsyncMock(side_effect=TrackNotFound)
+    on_failure_mock = AsyncMock()
+
+    workers = TaskWorkers(queue, Mock(), concurrency=1, backoff=0)
+    workers.register("youtube", run_mock, on_failure_mock)
+    await workers.start()
+
+    await workers.enqueue("youtube", {})
+    await asyncio.sleep(0.3)
+    await workers.stop()
+
+    run_mock.assert_called_once()
+    on_failure_mock.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_workers_deferred_tasks(queue):
+    """Deferred tasks free their worker and go back on the queue, without counting the attempt or failing."""
+
+    runs = []
+    on_failure_mock = AsyncMock()
+
+    async def run(bot, payload):
+        runs.append(payload["url"])
+        if payload["url"] == "deferred" and runs.count("deferred") == 1:
+            raise TaskDeferred(0.3)
+
+    workers = TaskWorkers(queue, Mock(), concurrency=1, max_attempts=1)
+    workers.register("youtube", run, on_failure_mock)
+    await workers.start()
+
+    await workers.enqueue("youtube", {"url": "deferred"})
+    await workers.enqueue("youtube", {"url": "other"})
+    await asyncio.sleep(0.1)
+
+    # The other task ran while the deferred one waits
+    assert runs == ["deferred", "other"]
+    assert queue.pending_count() == 1
+
+    await asyncio.sleep(0.5)
+    await workers.stop()
+
+    assert runs == ["deferred", "other", "deferred"]
+    assert queue.pending_count() == 0
+    on_failure_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_workers_unknown_kind(queue):
+    """Tasks of a kind nothing is registered for fail, and the worker keeps processing the next ones."""
+
+    run_mock = AsyncMock()
+
+    workers = TaskWorkers(queue, Mock(), concurrency=1)
+    workers.register("youtube", run_mock)
+    await workers.start()
+
+    await workers.enqueue("unknown", {"url": "first"})
+    await workers.enqueue("youtube", {"url": "second"})
+    await asyncio.sleep(0.2)
+    await workers.stop()
+
+    run_mock.assert_awaited_once()
+    status, error = queue._connection.execute("SELECT status, error FROM tasks WHERE kind = 'unknown'").fetchone()
+    assert status == "failed" and "unknown" in error
+
+
+@pytest.mark.asyncio
+async def test_workers_pick_up_unfinished_tasks(queue):
+    """Tasks left running by a previous run are processed on start."""
+
+    queue.put("youtube", {"url": "unfinished"})
+    queue.claim()
+
+    run_mock = AsyncMock()
+    workers = TaskWorkers(queue, Mock(), concurrency=1)
+    workers.register("youtube", run_mock)
+    await workers.start()
+    await asyncio.sleep(0.3)
+    await workers.stop()
+
+    run_mock.assert_called_once()
+    assert run_mock.call_args[0][1] == {"url": "unfinished"}
+
+
+@pytest.mark.asyncio
+async def test_workers_admit(queue):
+    """Jobs are admitted at their position on the queue, until the user runs out of their rate limit."""
+
+    workers = TaskWorkers(queue, Mock(), concurrency=1, limits=TokenBuckets(capacity=3, rate=1))
+
+    assert await workers.admit(10, 1) == 0
+
+    for _ in range(2):
+        queue.put("youtube", {}, chat_id=10, user_id=2)
+    assert await workers.admit(10, 1) == 1
+
+    with pytest.raises(TaskRateLimited) as error:
+        await workers.admit(10, 1, cost=2)
+    assert error.value.retry_after > 0
+
+    # Other users have their own limits
+    assert await workers.admit(10, 3, cost=3) == 1
+
+    # Jobs whose songs are counted as they're processed are admitted while the user has a job left, taking nothing
+    assert await workers.admit(10, 4, cost=0) == 1
+    assert await workers.admit(10, 4, cost=3) == 1
+    with pytest.raises(TaskRateLimited):
+        await workers.admit(10, 4, cost=0)
+
+
+@pytest.mark.asyncio
+async def test_workers_metrics(queue):
+    """The metrics tell the queue depth, the running tasks and how long the claimed tasks waited."""
+
+    release = asyncio.Event()
+
+    async def run(bot, payload):
+        await release.wait()
+
+    workers = TaskWorkers(queue, Mock(), concurrency=1)
+    workers.register("youtube", run)
+    await workers.start()
+
+    for user_id in (1, 1, 2):
+        await workers.enqueue("youtube", {}, chat_id=10, user_id=user_id)
+    await asyncio.sleep(0.2)
+
+    metrics = await workers.metrics()
+    release.set()
+    await asyncio.sleep(0.2)
+    await workers.stop()
+
+    assert (metrics['pending'], metrics['lanes'], metrics['running'], metrics['workers']) == (2, 2, 1, 1)
+    assert (metrics['songs'], metrics['songs_waiting']) == (0, 0)
+    assert 0 <= metrics['wait_p50'] <= metrics['wait_p95'] <= metrics['wait_max'] < 1
+
+
+# Checkpoints -----------------
+def test_checkpoints(tmp_path):
+    """Checkpoints are kept per job, across restarts, until they're cleared."""
+
+    path = str(tmp_path / "checkpoints.sqlite3")
+
+    checkpoints = Checkpoints(path)
+    checkpoints.add("job", "first")
+    checkpoints.add("job", "first")
+    checkpoints.add("other_job", "second")
+
+    checkpoints = Checkpoints(path)
+    assert checkpoints.contains("job", "first")
+    assert not checkpoints.contains("job", "second")
+
+    checkpoints.clear("job")
+    assert not checkpoints.contains("job", "first")
+    assert checkpoints.contains("other_job", "second")
@@ -1,4 +1,4 @@
-from src.utils import get_metadata_from_message
+from src.utils import get_metadata_from_message, format_timestamp
 
 
 def test_get_metadata_from_message():
@@ -36,3 +36,49 @@ def test_get_metadata_from_message():
     ret = get_metadata_from_message(message)
     assert ret.url is not "" and ret.url == "https://www.youtube.com/watch?v=lSooYPG-5Rg"
     assert ret.track is ""
+
+
+def test_get_metadata_from_message_quoted_values():
+    """Quoted values can have '&&' and spaces in them."""
+
+    message = 'https://www.youtube.com/watch?v=lSooYPG-5Rg && title: "Run && Hide" && folder: "  road trip "'
+    ret = get_metadata_from_message(message)
+    assert ret.url == "https://www.youtube.com/watch?v=lSooYPG-5Rg"
+    assert ret.title == "Run && Hide"
+    assert ret.folder == "road trip"
+
+    message = 'https://www.youtube.com/watch?v=lSooYPG-5Rg && title: 12" remix && artist: potaro'
+    ret = get_metadata_from_message(message)
+    assert ret.title == '12" remix'
+    assert ret.artist == "potaro"
+
+
+def test_get_metadata_from_message_repeated_tags():
+    """The last of a repeated tag is used, and values can have a single '&'."""
+
+    message = "https://www.youtube.com/watch?v=lSooYPG-5Rg && artist: potaro && ARTIST: Simon & Garfunkel"
+    ret = get_metadata_from_message(message)
+    assert ret.artist == "Simon & Garfunkel"
+
+
+def test_get_metadata_from_message_several_urls():
+    """All URLs are kept, in order, without the punctuation around them."""
+
+    message = "two bangers: https://youtu.be/lSooYPG-5Rg, (https://www.youtube.com/watch?v=W2TE0DjdNqI) " \
+              "&& folder: porter && https://en.wikipedia.org/wiki/Porter_(band)."
+    ret = get_metadata_from_message(message)
+    assert ret.url == "https://youtu.be/lSooYPG-5Rg"
+    assert ret.urls == ["https://youtu.be/lSooYPG-5Rg", "https://www.youtube.com/watch?v=W2TE0DjdNqI",
+                        "https://en.wikipedia.org/wiki/Porter_(band)"]
+    assert ret.folder == "porter"
+
+    ret = get_metadata_from_message("no links here && artist: potaro")
+    assert ret.url == "" and ret.urls == []
+
+
+def test_format_timestamp():
+    """Timestamps only show the hours of times longer than an hour."""
+
+    assert format_timestamp(0) == "00:00"
+    assert format_timestamp(205.7) == "03:25"
+    assert format_timestamp(3805) == "1:03:25"
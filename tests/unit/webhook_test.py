@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+from unittest.mock import Mock, AsyncMock
+
+from aiohttp.test_utils import TestServer, TestClient
+from telegram import Bot, Update
+
+import src.storage
+from src.storage import ScratchSpace
+from src.webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 2,
+        "date": 1690000000,
+        "chat": {"id": 15552, "type": "private"},
+        "text": "/start",
+    },
+}
+
+
+def mocked_application(running: bool = True) -> Mock:
+    """
+    Mocks the bot application the webhook server puts the updates on.
+    @param running: if the application is running or not.
+    @return: mocked Application object.
+    """
+    application = Mock()
+    application.running = running
+    application.bot = Bot("123:token")
+    application.update_queue = asyncio.Queue()
+    application.bot_data = {}
+    return application
+
+
+@pytest.fixture
+def server() -> WebhookServer:
+    return WebhookServer(mocked_application(), url="https://bot.example.com", secret_token="secret")
+
+
+async def client_for(server: WebhookServer) -> TestClient:
+    client = TestClient(TestServer(server.create_app()))
+    await client.start_server()
+    return client
+
+
+@pytest.mark.asyncio
+async def test_update_is_queued(server):
+    """Normal flow - updates posted with the secret token are put on the update queue."""
+
+    client = await client_for(server)
+    try:
+        response = await client.post("/telegram", json=UPDATE, headers={SECRET_TOKEN_HEADER: "secret"})
+    finally:
+        await client.close()
+
+    assert response.status == 200
+    update = server.application.update_queue.get_nowait()
+    assert isinstance(update, Update)
+    assert update.message.text == "/start"
+
+
+@pytest.mark.asyncio
+async def test_wrong_secret_token(server):
+    """Updates without the right secret token are rejected."""
+
+    client = await client_for(server)
+    try:
+        missing = await client.post("/telegram", json=UPDATE)
+        wrong = await client.post("/telegram", json=UPDATE, headers={SECRET_TOKEN_HEADER: "wrong"})
+    finally:
+        await client.close()
+
+    assert missing.status == wrong.status == 403
+    assert server.application.update_queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_invalid_update(server):
+    """Bodies that aren't JSON updates are rejected."""
+
+    client = await client_for(server)
+    try:
+        response = await client.post("/telegram", data="not json", headers={SECRET_TOKEN_HEADER: "secret"})
+    finally:
+        await client.close()
+
+    assert response.status == 400
+    assert server.application.update_queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_updates_rejected_while_stopping(server):
+    """Updates are rejected while the application stops, so Telegram sends them again later."""
+
+    server.application.running = False
+
+    client = await client_for(server)
+    try:
+        response = await client.post("/telegram", json=UPDATE, headers={SECRET_TOKEN_HEADER: "secret"})
+        health = await client.get("/health")
+    finally:
+        await client.close()
+
+    assert response.status == 503
+    assert health.status == 503
+
+
+@pytest.mark.asyncio
+async def test_health(server, mocker, tmp_path):
+    """The health endpoint reports the number of updates waiting to be handled and the scratch space usage."""
+
+    mocker.patch.object(src.storage, "_scratch_space", ScratchSpace(str(tmp_path), quota=1024))
+    await server.application.update_queue.put(Mock())
+
+    client = await client_for(server)
+    try:
+        response = await client.get("/health")
+        body = await response.json()
+    finally:
+        await client.close()
+
+    assert response.status == 200
+    assert body == {'status': 'ok', 'pending_updates': 1,
+                    'scratch': {'jobs': 0, 'reserved': 0, 'used': 0, 'quota': 1024}}
+
+
+@pytest.mark.asyncio
+async def test_health_task_metrics(server, mocker, tmp_path):
+    """The health endpoint reports the task queue metrics once the task workers are started."""
+
+    mocker.patch.object(src.storage, "_scratch_space", ScratchSpace(str(tmp_path), quota=1024))
+    workers = Mock()
+    workers.metrics = AsyncMock(return_value={'pending': 3, 'running': 1})
+    server.application.bot_data['tasks'] = workers
+
+    client = await client_for(server)
+    try:
+        response = await client.get("/health")
+        body = await response.json()
+    finally:
+        await client.close()
+
+    assert body['tasks'] == {'pending': 3, 'running': 1}
+
+
+@pytest.mark.asyncio
+async def test_start_sets_webhook(mocker):
+    """Starting the server tells Telegram where to send the updates, with the secret token."""
+
+    application = mocked_application()
+    application.bot = AsyncMock()
+    server = WebhookServer(application, url="https://bot.example.com/", listen="127.0.0.1", port=0,
+                           secret_token="secret")
+
+    await server.start()
+    await server.stop()
+
+    application.bot.set_webhook.assert_called_once()
+    assert application.bot.set_webhook.call_args.kwargs['url'] == "https://bot.example.com/telegram"
+    assert application.bot.set_webhook.call_args.kwargs['secret_token'] == "secret"
+
+
+def test_url_is_required():
+    """The webhook URL has to be set."""
+
+    with pytest.raises(ValueError):
+        WebhookServer(mocked_application(), url="")
+
+
+def test_random_secret_token():
+    """A random secret token is used if none is set."""
+
+    first = WebhookServer(mocked_application(), url="https://bot.example.com")
+    second = WebhookServer(mocked_application(), url="https://bot.example.com")
+
+    assert first.secret_token and first.secret_token != second.secret_token
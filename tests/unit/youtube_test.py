@@ -1,11 +1,18 @@
+import asyncio
 from unittest.mock import Mock, AsyncMock
 
 import pytest
 import os 
+import shutil
+import sys
 
-from src.models import Metadata
+import src.services.youtube
+from src.cache import AudioCache
+from src.definitions.definitions import FILES_DIR
+from src.models import Metadata, YoutubeSource
 from src.exceptions import YoutubeAudioDownloadFail
-from src.services.youtube import url_is_youtube_valid, download_youtube_audio
+from src.services.youtube import url_is_youtube_valid, download_youtube_audio, url_is_youtube_playlist, \
+    list_youtube_playlist, transcode_youtube_audio
 import yt_dlp
 
 
@@ -43,6 +50,125 @@ async def test_download_audio_normal(mocker):
     os.remove(youtube_track.filepath)
 
 
+@pytest.mark.asyncio
+async def test_download_audio_cached(mocker, tmp_path):
+    """Repeated downloads of the same video are served from the audio cache."""
+
+    def fake_download(fn, url, directory, mode, timeout, on_progress):
+        path = os.path.join(directory, "W2TE0DjdNqI.mp3")
+        shutil.copyfile(FILES_DIR + "sample.mp3", path)
+        return {'id': "W2TE0DjdNqI", 'title': "Goodbye To A World", 'filepath': path, 'format': "mp3-320"}
+
+    pool_run_mock = AsyncMock(side_effect=fake_download)
+    mocker.patch.object(src.services.youtube.download_pool, "run", pool_run_mock)
+    mocker.patch.object(src.services.youtube, "_audio_cache", AudioCache(str(tmp_path / "cache")))
+
+    metadata: Metadata = Metadata("https://www.youtube.com/watch?v=W2TE0DjdNqI", "Porter Robinson", "", "", "", "", "", "")
+
+    first = await download_youtube_audio(metadata, AsyncMock(), str(tmp_path))
+    second = await download_youtube_audio(metadata, AsyncMock(), str(tmp_path))
+
+    # Asserts
+    pool_run_mock.assert_called_once()
+    assert first.file_title == second.file_title == "Goodbye To A World"
+    assert first.filepath != second.filepath
+    assert os.path.dirname(first.filepath) == str(tmp_path)
+    assert first.mimetype == "audio/mpeg"
+    assert first.filepath.endswith(".mp3")
+    assert first.audio_format == second.audio_format == "mp3-320"
+
+    # Remove downloaded files
+    os.remove(first.filepath)
+    os.remove(second.filepath)
+
+
+def mocked_youtube_dl(info: dict, filepath: str) -> Mock:
+    """
+    Mocks a YoutubeDL object extracting 'info' and downloading it to 'filepath'.
+    @param info: info of the video.
+    @param filepath: path of the downloaded (and post-processed) file.
+    @return: mocked YoutubeDL object.
+    """
+    ydl_mock = Mock()
+    ydl_mock.__enter__ = Mock(return_value=ydl_mock)
+    ydl_mock.__exit__ = Mock(return_value=False)
+    ydl_mock.extract_info.return_value = info
+    ydl_mock.process_ie_result.return_value = {**info, 'requested_downloads': [{'filepath': filepath}]}
+    return ydl_mock
+
+
+def test_download_audio_job_native(mocker):
+    """On 'native' mode the audio keeps its codec, and the format records the source's bitrate."""
+    info = {'id': "W2TE0DjdNqI", 'title': "Goodbye To A World", 'acodec': "opus", 'abr': 129.472}
+    ydl_mock = mocked_youtube_dl(info, "files/W2TE0DjdNqI.opus")
+    mocker.patch.object(src.services.youtube, "YoutubeDL", Mock(return_value=ydl_mock))
+    pp_mock = mocker.patch.object(src.services.youtube, "FFmpegExtractAudioPP")
+
+    result = src.services.youtube._download_audio(Mock(), "https://www.youtube.com/watch?v=W2TE0DjdNqI", "files",
+                                                  "native")
+
+    assert result == {'id': "W2TE0DjdNqI", 'title': "Goodbye To A World", 'filepath': "files/W2TE0DjdNqI.opus",
+                      'format': "opus-129"}
+    assert pp_mock.call_args.kwargs['preferredcodec'] == "best"
+    ydl_mock.add_post_processor.assert_called_once_with(pp_mock.return_value)
+    ydl_mock.process_ie_result.assert_called_once_with(info, download=True)
+
+
+def test_download_audio_job_mp3(mocker):
+    """On 'mp3' mode the audio is transcoded at the source's bitrate at most."""
+    info = {'id': "W2TE0DjdNqI", 'title': "Goodbye To A World", 'acodec': "mp4a.40.2", 'abr': 129.5}
+    mocker.patch.object(src.services.youtube, "YoutubeDL",
+                        Mock(return_value=mocked_youtube_dl(info, "files/W2TE0DjdNqI.mp3")))
+    pp_mock = mocker.patch.object(src.services.youtube, "FFmpegExtractAudioPP")
+
+    result = src.services.youtube._download_audio(Mock(), "https://www.youtube.com/watch?v=W2TE0DjdNqI", "files",
+                                                  "mp3")
+
+    assert result['format'] == "mp3-128"
+    assert pp_mock.call_args.kwargs == {'preferredcodec': "mp3", 'preferredquality': "128"}
+
+
+def test_transcode_command():
+    """The audio is transcoded at the source's bitrate, with the headers Youtube needs and the tags in the header."""
+    source = YoutubeSource("W2TE0DjdNqI", "Goodbye To A World", "https://stream", {'User-Agent': "agent"}, 128, 200)
+    metadata = Metadata("https://www.youtube.com/watch?v=W2TE0DjdNqI", "Porter Robinson", 2014, 12, "", "Worlds",
+                        "Goodbye", "")
+
+    command = src.services.youtube._transcode_command(source, metadata)
+
+    assert command[command.index('-headers') + 1] == "User-Agent: agent\r\n"
+    assert command[command.index('-i') + 1] == "https://stream"
+    assert command[command.index('-b:a') + 1] == "128k"
+    assert [command[i + 1] for i, argument in enumerate(command) if argument == '-metadata'] == [
+        "artist=Porter Robinson", "date=2014", "track=12", "album=Worlds", "title=Goodbye"]
+    assert command[-3:] == ['-f', 'mp3', 'pipe:1']
+
+
+def test_transcode_youtube_audio_fails(mocker):
+    """A transcode that fails raises before the end of the file is read."""
+    mocker.patch.object(src.services.youtube, "_transcode_command", Mock(return_value=[
+        sys.executable, "-c", "import sys; sys.stdout.write('partial'); sys.stderr.write('broken'); sys.exit(1)"]))
+    source = YoutubeSource("W2TE0DjdNqI", "Goodbye To A World", "https://stream", {}, 128)
+    read = []
+
+    with pytest.raises(YoutubeAudioDownloadFail, match="broken"):
+        with transcode_youtube_audio(source, Mock()) as chunks:
+            for chunk in chunks:
+                read.append(chunk)
+
+    assert read == [b"partial"]
+
+
+def test_target_bitrate():
+    """MP3 bitrates are never above the source's, and native bitrates are the source's."""
+    assert src.services.youtube._target_bitrate({'abr': 160}, "mp3") == 160
+    assert src.services.youtube._target_bitrate({'abr': 250}, "mp3") == 192
+    assert src.services.youtube._target_bitrate({'abr': 48}, "mp3") == 64
+    assert src.services.youtube._target_bitrate({}, "mp3") == 320
+    assert src.services.youtube._target_bitrate({'tbr': 130.2}, "native") == 130
+    assert src.services.youtube._target_bitrate({}, "native") is None
+
+
 # @pytest.mark.asyncio
 # async def test_error_downloading_audio(mocker):
 #     """Errors because there was a problem downloading Youtube file"""
@@ -60,4 +186,106 @@ async def test_download_audio_normal(mocker):
 #     metadata: Metadata = Metadata("https://www.youtube.com/watch?v=W2TE0DjdNqI&ab_channel=PorterRobinsonVEVO", "", "", "", "", "", "", "")
 # 
 #     with pytest.raises(YoutubeAudioDownloadFail):
-#         await download_youtube_audio(metadata, message_mock)
\ No newline at end of file
+#         await download_youtube_audio(metadata, message_mock)
+
+def test_url_is_playlist():
+    """Test playlist and album links."""
+
+    assert url_is_youtube_playlist("https://www.youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG").group(1) \
+           == "PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG"
+    assert url_is_youtube_playlist("https://music.youtube.com/playlist?si=abc&list=OLAK5uy_abc").group(1) \
+           == "OLAK5uy_abc"
+    assert url_is_youtube_playlist("https://music.youtube.com/browse/MPREb_abc").group(1) == "MPREb_abc"
+    assert url_is_youtube_playlist("https://www.youtube.com/watch?v=lSooYPG-5Rg") is None
+    assert url_is_youtube_playlist("https://www.youtube.com/c/porterrobinson") is None
+
+
+def mocked_listing(entries: list, error: Exception = None):
+    """
+    Mocks the playlist listing job, reporting the given entries.
+    @param entries: entries reported by the job.
+    @param error: error raised by the job once the entries are reported.
+    @return: mocked 'ProcessPool.run' function.
+    """
+
+    async def run(fn, url, timeout=None, on_progress=None):
+        for entry in entries:
+            await on_progress(entry)
+        if error is not None:
+            raise error
+        return {'title': "playlist"}
+
+    return run
+
+
+@pytest.mark.asyncio
+async def test_list_playlist(mocker):
+    """Normal flow - playlist entries are yielded in order as they're listed."""
+
+    entries = [{'id': str(i), 'title': f"song {i}", 'url': f"https://www.youtube.com/watch?v={i}"} for i in range(25)]
+    mocker.patch.object(src.services.youtube.listing_pool, "run", mocked_listing(entries))
+
+    listed = [entry async for entry in list_youtube_playlist("https://www.youtube.com/playlist?list=PL")]
+
+    assert listed == entries
+
+
+@pytest.mark.asyncio
+async def test_list_playlist_reads_ahead_a_few_entries(mocker):
+    """Listing waits for the entries to be consumed."""
+
+    reported = []
+
+    async def run(fn, url, timeout=None, on_progress=None):
+        for i in range(100):
+            reported.append(i)
+            await on_progress({'id': str(i)})
+
+    mocker.patch.object(src.services.youtube.listing_pool, "run", run)
+
+    playlist = list_youtube_playlist("https://www.youtube.com/playlist?list=PL")
+    await playlist.__anext__()
+    await asyncio.sleep(0.05)
+
+    assert len(reported) <= src.services.youtube.PLAYLIST_READ_AHEAD + 2
+    await playlist.aclose()
+
+
+@pytest.mark.asyncio
+async def test_list_playlist_error(mocker):
+    """Errors listing the playlist are raised after the entries listed before them."""
+
+    entries = [{'id': "1", 'title': "song", 'url': "https://www.youtube.com/watch?v=1"}]
+    mocker.patch.object(src.services.youtube.listing_pool, "run", mocked_listing(entries, yt_dlp.DownloadError("")))
+
+    listed = []
+    with pytest.raises(YoutubeAudioDownloadFail):
+        async for entry in list_youtube_playlist("https://www.youtube.com/playlist?list=PL"):
+            listed.append(entry)
+
+    assert listed == entries
+
+
+def test_list_playlist_job(mocker):
+    """The listing job reports every video of the playlist as it goes through it."""
+
+    def entries():
+        yield {'id': "a", 'title': "first"}
+        yield None
+        yield {'id': "b", 'title': None}
+
+    ydl_mock = Mock()
+    ydl_mock.__enter__ = Mock(return_value=ydl_mock)
+    ydl_mock.__exit__ = Mock(return_value=False)
+    ydl_mock.extract_info.return_value = {'_type': "playlist", 'title': "playlist", 'entries': entries()}
+    mocker.patch.object(src.services.youtube, "YoutubeDL", Mock(return_value=ydl_mock))
+    report = Mock()
+
+    result = src.services.youtube._list_playlist(report, "https://www.youtube.com/playlist?list=PL")
+
+    assert result == {'title': "playlist"}
+    assert [call.args[0] for call in report.call_args_list] == [
+        {'id': "a", 'title': "first", 'url': "https://www.youtube.com/watch?v=a"},
+        {'id': "b", 'title': "b", 'url': "https://www.youtube.com/watch?v=b"},
+    ]
+    assert ydl_mock.extract_info.call_args.kwargs == {'download': False, 'process': False}